@@ -0,0 +1,32 @@
+import asyncio
+import click
+
+###########################################################################################################################
+#
+# Snapshot tabulky externalids (s typy a kategoriemi) do Arrow IPC streamu nebo Parquetu, viz src.Export
+# python export.py --format parquet --output externalids.parquet
+# pripojeni se sklada stejne jako v main.py (POSTGRES_* promenne), je-li definovana replika, cte se z ni
+#
+###########################################################################################################################
+
+@click.command()
+@click.option("--format", "format", type=click.Choice(["arrow", "parquet"]), default="parquet", show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), required=True)
+@click.option("--batch-size", type=int, default=65536, show_default=True)
+def export(format, output, batch_size):
+    from src.DBDefinitions import startEngine, ComposeConnectionString, startReplicaEngines, ComposeReplicaConnectionStrings
+    from src.Export import exportSnapshot
+
+    async def run():
+        replicas = startReplicaEngines(ComposeReplicaConnectionStrings())
+        if replicas:
+            sessionMaker = replicas[0]
+        else:
+            sessionMaker = await startEngine(ComposeConnectionString(), makeDrop=False, makeUp=False)
+        return await exportSnapshot(sessionMaker, output, format=format, batchSize=batch_size)
+
+    count = asyncio.run(run())
+    click.echo(f"{count} rows written to {output}")
+
+if __name__ == "__main__":
+    export()
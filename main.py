@@ -1,12 +1,16 @@
 import os
+import asyncio
+import datetime
 import strawberry
 import socket
 
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, WebSocketException, status
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.requests import HTTPConnection
+from typing import Optional, List, Union
 from strawberry.fastapi import GraphQLRouter
 from strawberry.asgi import GraphQL
 
@@ -14,8 +18,13 @@ import logging
 import logging.handlers
 
 from src.GraphTypeDefinitions import schema
-from src.DBDefinitions import startEngine, ComposeConnectionString
+from src.DBDefinitions import startEngine, ComposeConnectionString, startReplicaEngines, ComposeReplicaConnectionStrings
+from src.DBDefinitions import warmUpPool, ComposeEngineOptions, startPartitioning
 from src.DBFeeder import initDB
+from src.ReferenceVersion import isReferenceOnly, referenceVersion, requestETag, etagMatches
+from src.Responses import gqlResponse
+from src.Batch import checkBatch, executeBatch, BatchRejected
+from src.Metrics import measureStartupPhase, markReady
 from uoishelpers.authenticationMiddleware import createAuthentizationSentinel
 
 # region logging setup
@@ -54,13 +63,17 @@ connectionString = ComposeConnectionString()
 
 def singleCall(asyncFunc):
     """Dekorator, ktery dovoli, aby dekorovana funkce byla volana (vycislena) jen jednou. Navratova hodnota je zapamatovana a pri dalsich volanich vracena.
-    Dekorovana funkce je asynchronni.
+    Dekorovana funkce je asynchronni. Prvni volani je chraneno zamkem, soubezna volani (lifespan, prvni requesty) cekaji na jeho vysledek.
+    Skonci-li prvni volani vyjimkou, dalsi volani se pokusi funkci vycislit znovu.
     """
     resultCache = {}
+    lock = asyncio.Lock()
 
     async def result():
-        if resultCache.get("result", None) is None:
-            resultCache["result"] = await asyncFunc()
+        if "result" not in resultCache:
+            async with lock:
+                if "result" not in resultCache:
+                    resultCache["result"] = await asyncFunc()
         return resultCache["result"]
 
     return result
@@ -84,13 +97,42 @@ async def RunOnceAndReturnSessionMaker():
     #
     # zde definujte do funkce asyncio.gather
     # vlozte asynchronni funkce, ktere maji data uvest do prvotniho konzistentniho stavu
-    await initDB(result)
+    with measureStartupPhase("seed"):
+        await initDB(result)
+    if os.getenv("EXTERNALIDS_PARTITIONED", "False") == "True":
+        # prevod tabulky je samostatny prikaz (partition.py), zde se jen kontroluje a doplnuji partitions novych typu
+        partitioned, created = await startPartitioning(result)
+        if partitioned:
+            logging.info(f"externalids is partitioned, partitions created={created}")
+        else:
+            logging.warning(f"externalids is not partitioned, run python partition.py")
+    # tombstony smazanych externalids (external_ids_changed_since), klient starsi nez retence musi synchronizovat znovu
+    from src.Tombstones import pruneTombstones
+    await pruneTombstones(result, datetime.timedelta(days=float(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))))
     #
     #
     ###########################################################################################################################
     logging.info(f"all done")
     return result
 
+@singleCall
+async def RunOnceAndReturnReplicaSet():
+    """Vytvori SessionMakery read replik (viz ComposeReplicaConnectionStrings).
+    Neni-li zadna replika definovana, vraci prazdny ReplicaSet a vse jde na primarni databazi.
+    REPLICA_MAX_LAG (sekundy) zapina kontrolu zpozdeni repliky, prilis zpozdena replika neni pouzivana,
+    REPLICA_LAG_CHECK_INTERVAL (sekundy) urcuje, jak casto se zpozdeni kontroluje.
+    """
+    from src.SessionRouter import ReplicaSet
+
+    replicaConnectionStrings = ComposeReplicaConnectionStrings()
+    maxLag = os.getenv("REPLICA_MAX_LAG", None)
+    maxLag = None if maxLag is None else float(maxLag)
+    checkInterval = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+
+    logging.info(f"starting {len(replicaConnectionStrings)} replica engine(s), maxLag={maxLag}")
+    sessionMakers = startReplicaEngines(replicaConnectionStrings)
+    return ReplicaSet(sessionMakers, maxLag=maxLag, checkInterval=checkInterval)
+
 # endregion
 
 # region Sentinel setup
@@ -101,10 +143,12 @@ apolloQuery = "query __ApolloGetServiceDefinition__ { _service { sdl } }"
 graphiQLQuery = "\n    query IntrospectionQuery {\n      __schema {\n        \n        queryType { name }\n        mutationType { name }\n        subscriptionType { name }\n        types {\n          ...FullType\n        }\n        directives {\n          name\n          description\n          \n          locations\n          args(includeDeprecated: true) {\n            ...InputValue\n          }\n        }\n      }\n    }\n\n    fragment FullType on __Type {\n      kind\n      name\n      description\n      \n      fields(includeDeprecated: true) {\n        name\n        description\n        args(includeDeprecated: true) {\n          ...InputValue\n        }\n        type {\n          ...TypeRef\n        }\n        isDeprecated\n        deprecationReason\n      }\n      inputFields(includeDeprecated: true) {\n        ...InputValue\n      }\n      interfaces {\n        ...TypeRef\n      }\n      enumValues(includeDeprecated: true) {\n        name\n        description\n        isDeprecated\n        deprecationReason\n      }\n      possibleTypes {\n        ...TypeRef\n      }\n    }\n\n    fragment InputValue on __InputValue {\n      name\n      description\n      type { ...TypeRef }\n      defaultValue\n      isDeprecated\n      deprecationReason\n    }\n\n    fragment TypeRef on __Type {\n      kind\n      name\n      ofType {\n        kind\n        name\n        ofType {\n          kind\n          name\n          ofType {\n            kind\n            name\n            ofType {\n              kind\n              name\n              ofType {\n                kind\n                name\n                ofType {\n                  kind\n                  name\n                  ofType {\n                    kind\n                    name\n                  }\n                }\n              }\n            }\n          }\n        }\n      }\n    }\n  "
 
 
+queriesWOAuthentization = [apolloQuery, graphiQLQuery]
+
 sentinel = createAuthentizationSentinel(
     JWTPUBLICKEY=JWTPUBLICKEYURL,
     JWTRESOLVEUSERPATH=JWTRESOLVEUSERPATHURL,
-    queriesWOAuthentization=[apolloQuery, graphiQLQuery],
+    queriesWOAuthentization=queriesWOAuthentization,
     onAuthenticationError=lambda item: JSONResponse({"data": None, "errors": ["Unauthenticated", item.query, f"{item.variables}"]}, 
     status_code=401))
 
@@ -116,18 +160,30 @@ class Item(BaseModel):
     variables: dict = {}
     operationName: str = None
 
-async def get_context(request: Request):
-    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
-        
-    #from src.Dataloaders import createLoadersContext, createUgConnectionContext
-    from src.Dataloaders import createLoadersContext
-    context = createLoadersContext(asyncSessionMaker)
+async def get_context(request: HTTPConnection):
     i = Item(query = "")
     # i.query = ""
     # i.variables = {}
     logging.info(f"before sentinel current user is {request.scope.get('user', None)}")
-    await sentinel(request, i)
+    sentinelResult = await sentinel(request, i)
     logging.info(f"after sentinel current user is {request.scope.get('user', None)}")
+    if request.scope["type"] == "websocket":
+        # subscriptions nejdou pres apollo_gql, spojeni je overeno zde stejne jako v apollo_gql
+        DEMOE = os.getenv("DEMO", None)
+        if (DEMOE == "False") and sentinelResult:
+            logging.info(f"sentinel test failed for websocket request={request}")
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Unauthenticated")
+        if (DEMOE == "True") and (request.scope.get("user", None) is None):
+            request.scope["user"] = {"id": "2d9dc5ca-a4a2-11ed-b9df-0242ac120003"}
+
+    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
+    replicaSet = await RunOnceAndReturnReplicaSet()
+    await replicaSet.refresh()
+    markReady()
+        
+    #from src.Dataloaders import createLoadersContext, createUgConnectionContext
+    from src.Dataloaders import createLoadersContext
+    context = createLoadersContext(asyncSessionMaker, replicaSet)
     # connectionContext = createUgConnectionContext(request=request)
     # result = {**context, **connectionContext}
     result = {**context}
@@ -136,10 +192,59 @@ async def get_context(request: Request):
     logging.info(f"context created {result}")
     return result
 
+POOL_WARMUP = os.environ.get("POOL_WARMUP", "False") == "True"
+# negativni cache internal_id (src.BloomFilter), zapisy jinych workeru jsou videt z proudu zmen (external_ids_changed_since)
+BLOOM_FILTER = os.environ.get("BLOOM_FILTER", "False") == "True"
+BLOOM_REBUILD_INTERVAL = float(os.environ.get("BLOOM_REBUILD_INTERVAL", "300"))
+BLOOM_REFRESH_INTERVAL = float(os.environ.get("BLOOM_REFRESH_INTERVAL", "1"))
+# rezidentni index cele tabulky externalids v pameti (src.ResidentIndex), zmeny jinych workeru jsou videt s odstupem
+RESIDENT_INDEX = os.environ.get("RESIDENT_INDEX", "False") == "True"
+RESIDENT_INDEX_REFRESH_INTERVAL = float(os.environ.get("RESIDENT_INDEX_REFRESH_INTERVAL", "1"))
+RESIDENT_INDEX_VERIFY_INTERVAL = float(os.environ.get("RESIDENT_INDEX_VERIFY_INTERVAL", "300"))
+RESIDENT_INDEX_VERIFY_SAMPLE = int(os.environ.get("RESIDENT_INDEX_VERIFY_SAMPLE", "100"))
+
+async def warmUp(asyncSessionMaker, replicaSet):
+    """Naplni pool primarni databaze (a replik) na pool_size spojeni a pripravi na nich hot statementy (src.Lookups)"""
+    from src.Lookups import primeSession
+    from src.Metrics import measureStartupPhase
+
+    connections = ComposeEngineOptions(connectionString).get("pool_size", 1)
+    logging.info(f"warming up {connections} connection(s)")
+    with measureStartupPhase("warmup"):
+        await warmUpPool(asyncSessionMaker, connections, primers=[primeSession])
+        for replica in replicaSet.replicas:
+            await warmUpPool(replica.sessionMaker, connections, primers=[primeSession])
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     initizalizedEngine = await RunOnceAndReturnSessionMaker()
+    replicaSet = await RunOnceAndReturnReplicaSet()
+    if POOL_WARMUP:
+        await warmUp(initizalizedEngine, replicaSet)
+    bloomTasks = []
+    if BLOOM_FILTER:
+        from src.BloomFilter import negativeLookupCache
+        from src.Metrics import measureStartupPhase
+        with measureStartupPhase("bloom"):
+            await negativeLookupCache.build(initizalizedEngine)
+        bloomTasks = [
+            asyncio.create_task(negativeLookupCache.rebuildPeriodically(initizalizedEngine, BLOOM_REBUILD_INTERVAL)),
+            asyncio.create_task(negativeLookupCache.refreshPeriodically(initizalizedEngine, BLOOM_REFRESH_INTERVAL)),
+        ]
+    residentIndexTasks = []
+    if RESIDENT_INDEX:
+        from src.ResidentIndex import startResidentIndex
+        with measureStartupPhase("resident_index"):
+            residentIndexTasks = await startResidentIndex(
+                initizalizedEngine,
+                refreshInterval=RESIDENT_INDEX_REFRESH_INTERVAL,
+                verifyInterval=RESIDENT_INDEX_VERIFY_INTERVAL,
+                verifySample=RESIDENT_INDEX_VERIFY_SAMPLE)
     yield
+    for task in bloomTasks:
+        task.cancel()
+    for task in residentIndexTasks:
+        task.cancel()
 
 app = FastAPI(lifespan=lifespan)
 # app.mount("/gql", graphql_app)
@@ -156,29 +261,29 @@ graphql_app = GraphQLRouter(
 async def graphiql(request: Request):
     return await graphql_app.render_graphql_ide(request)
 
-@app.post("/gql")
-async def apollo_gql(request: Request, item: Item):
-    DEMOE = os.getenv("DEMO", None)
+DEBUGHEADER = os.environ.get("GQL_DEBUG_HEADER", "x-gql-debug")
+# podminene dotazy (ETag, If-None-Match) nad referencnimi daty, viz src.ReferenceVersion
+REFERENCE_ETAG = os.environ.get("REFERENCE_ETAG", "True") == "True"
+REFERENCE_CACHE_CONTROL = "private, no-cache"
 
-    sentinelResult = await sentinel(request, item)
-    if DEMOE == "False":
-        if sentinelResult:
-            logging.info(f"sentinel test failed for query={item} \n request={request}")
-            print(f"sentinel test failed for query={item} \n request={request}")
-            return sentinelResult
-        logging.info(f"sentinel test passed for query={item} for user {request.scope.get('user', None)}")
-    else:
-        request.scope["user"] = {"id": "2d9dc5ca-a4a2-11ed-b9df-0242ac120003"}
-        logging.info(f"sentinel skippend because of DEMO mode for query={item} for user {request.scope['user']}")
-    try:
-        context = await get_context(request)
-        schemaresult = await schema.execute(query=item.query, variable_values=item.variables, operation_name=item.operationName, context_value=context)
-    except Exception as e:
-        logging.info(f"error during schema execute {e}")
-        return {"data": None, "errors": [{f"{type(e).__name__}": "{e}"}]}
-    
+async def referenceETag(request: Request, item: Item):
+    """ETag dotazu, ktery cte jen referencni data (typy a kategorie), jinak None"""
+    if not (REFERENCE_ETAG and isReferenceOnly(schema._schema, item.query, item.operationName)):
+        return None
+    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
+    version = await referenceVersion.get(asyncSessionMaker)
+    return requestETag(version, item.query, item.variables, item.operationName, request.scope.get("user", None))
+
+def formatResult(request: Request, schemaresult):
     # logging.info(f"schema execute result \n{schemaresult}")
     result = {"data": schemaresult.data}
+    extensions = schemaresult.extensions or {}
+    if request.headers.get(DEBUGHEADER, None) is None:
+        # cena dotazu (QueryCostLimiter) je soucasti kazde odpovedi,
+        # souhrn SQL prikazu (SqlStatsExtension) jen na vyzadani (debug header)
+        extensions = {key: value for key, value in extensions.items() if key == "cost"}
+    if extensions:
+        result["extensions"] = extensions
     if schemaresult.errors:
         result["errors"] = [
             {
@@ -193,6 +298,168 @@ async def apollo_gql(request: Request, item: Item):
             } for error in schemaresult.errors]
     return result
 
+def resultCost(schemaresult):
+    return ((schemaresult.extensions or {}).get("cost", None) or {}).get("cost", 0)
+
+def exceptionResult(e):
+    return {"data": None, "errors": [{f"{type(e).__name__}": f"{e}"}]}
+
+async def createRequestContext(request: Request):
+    """Vraci (context, None), pri vyjimce (None, odpoved s chybou)"""
+    try:
+        return await get_context(request), None
+    except Exception as e:
+        logging.info(f"error during context creation {e}")
+        return None, exceptionResult(e)
+
+async def executeItem(context, item: Item):
+    """Vraci (schemaresult, None), pri vyjimce (None, odpoved s chybou)"""
+    try:
+        schemaresult = await schema.execute(query=item.query, variable_values=item.variables, operation_name=item.operationName, context_value=context)
+    except Exception as e:
+        logging.info(f"error during schema execute {e}")
+        return None, exceptionResult(e)
+    return schemaresult, None
+
+async def authorizeOperations(request: Request, operations: List[Item]):
+    """Sentinel overi pozadavek jednou pro vsechny operace (autentizace nezavisi na operaci),
+    rozhoduje prvni operace, ktera neni volne dostupna. Vraci odpoved s chybou nebo None.
+    """
+    DEMOE = os.getenv("DEMO", None)
+    operation = next((operation for operation in operations if operation.query not in queriesWOAuthentization), operations[0])
+    sentinelResult = await sentinel(request, operation)
+    if DEMOE == "False":
+        if sentinelResult:
+            logging.info(f"sentinel test failed for query={operation} \n request={request}")
+            print(f"sentinel test failed for query={operation} \n request={request}")
+            return sentinelResult
+        logging.info(f"sentinel test passed for query={operation} for user {request.scope.get('user', None)}")
+    else:
+        request.scope["user"] = {"id": "2d9dc5ca-a4a2-11ed-b9df-0242ac120003"}
+        logging.info(f"sentinel skippend because of DEMO mode for query={operation} for user {request.scope['user']}")
+    return None
+
+async def apollo_gql_batch(request: Request, items: List[Item], sequential: bool):
+    """Pole operaci se sdilenym kontextem (dataloadery), viz src.Batch"""
+    context, failure = await createRequestContext(request)
+    if failure is not None:
+        # odpoved je pole zarovnane s operacemi i pri chybe
+        return await gqlResponse(request, [failure for _ in items])
+
+    async def execute(item):
+        schemaresult, failure = await executeItem(context, item)
+        if failure is not None:
+            return failure, 0
+        return formatResult(request, schemaresult), resultCost(schemaresult)
+
+    results = await executeBatch(execute, items, sequential=sequential)
+    return await gqlResponse(request, [result for result, _ in results], cost=sum(cost for _, cost in results))
+
+@app.post("/gql")
+async def apollo_gql(request: Request, item: Union[Item, List[Item]]):
+    if isinstance(item, list):
+        # limity jsou kontrolovany pred autentizaci jednotlivych operaci
+        try:
+            sequential = checkBatch(schema._schema, item)
+        except BatchRejected as e:
+            return JSONResponse({"data": None, "errors": [{"msg": f"{e}", "extensions": {"code": "BATCH_REJECTED"}}]}, status_code=400)
+    sentinelResult = await authorizeOperations(request, item if isinstance(item, list) else [item])
+    if sentinelResult:
+        return sentinelResult
+    if isinstance(item, list):
+        return await apollo_gql_batch(request, item, sequential)
+
+    etag = await referenceETag(request, item)
+    if (etag is not None) and etagMatches(request.headers.get("if-none-match", None), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REFERENCE_CACHE_CONTROL})
+    context, failure = await createRequestContext(request)
+    if failure is not None:
+        return failure
+    if etag is not None:
+        # verze je ctena z primarni databaze, data nesmi byt starsi (replika)
+        context["sessionRouter"].markWritten()
+    schemaresult, failure = await executeItem(context, item)
+    if failure is not None:
+        return failure
+
+    result = formatResult(request, schemaresult)
+    headers = None
+    if (etag is not None) and not schemaresult.errors:
+        headers = {"ETag": etag, "Cache-Control": REFERENCE_CACHE_CONTROL}
+    # odhad velikosti vysledku je cena dotazu (QueryCostLimiter), velke vysledky jsou serializovany mimo event loop
+    return await gqlResponse(request, result, headers=headers, cost=resultCost(schemaresult))
+
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))
+
+@app.get("/gql/changes")
+async def entity_changes_sse(request: Request, offset: Optional[int] = None, entity: Optional[str] = None):
+    """Proud zmen (src.Outbox) jako server sent events, pri znovupripojeni prehrava od Last-Event-ID"""
+    from src.Outbox import getOutboxFeed, sseStream
+
+    DEMOE = os.getenv("DEMO", None)
+    sentinelResult = await sentinel(request, Item(query=""))
+    if (DEMOE == "False") and sentinelResult:
+        return sentinelResult
+
+    lastEventId = request.headers.get("last-event-id", None)
+    if lastEventId:
+        offset = int(lastEventId)
+    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
+    feed = getOutboxFeed(asyncSessionMaker)
+    return StreamingResponse(
+        sseStream(feed, offset=offset, entity=entity, heartbeat=SSE_HEARTBEAT),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/ids/resolve")
+async def ids_resolve(request: Request):
+    """Hromadne internal_id / external_ids bez GQL (json nebo msgpack), viz src.Resolve"""
+    from src.Resolve import decodeRequest, parseRequest, resolveIds, encodeResponse, acceptsMsgpack, ResolveRequestError
+
+    DEMOE = os.getenv("DEMO", None)
+    sentinelResult = await sentinel(request, Item(query=""))
+    if (DEMOE == "False") and sentinelResult:
+        return sentinelResult
+
+    try:
+        payload = decodeRequest(await request.body(), request.headers.get("content-type", None))
+        internalKeys, externalKeys = parseRequest(payload)
+    except ResolveRequestError as e:
+        return JSONResponse({"errors": [{"msg": f"{e}"}]}, status_code=400)
+    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
+    replicaSet = await RunOnceAndReturnReplicaSet()
+    from src.Dataloaders import createLoadersContext
+    lookups = createLoadersContext(asyncSessionMaker, replicaSet)["lookups"]
+    result = await resolveIds(lookups, internalKeys, externalKeys)
+    body, mediaType = encodeResponse(result, acceptsMsgpack(request.headers.get("accept", None)))
+    return Response(body, media_type=mediaType)
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "65536"))
+
+@app.get("/export/externalids")
+async def export_externalids(request: Request, format: str = "arrow"):
+    """Snapshot externalids (s typy a kategoriemi) jako Arrow IPC stream nebo Parquet, viz src.Export"""
+    from src.Export import FORMATS, streamSnapshot
+
+    DEMOE = os.getenv("DEMO", None)
+    sentinelResult = await sentinel(request, Item(query=""))
+    if (DEMOE == "False") and sentinelResult:
+        return sentinelResult
+
+    if format not in FORMATS:
+        return JSONResponse({"errors": [{"msg": f"unknown format {format}, expected one of {list(FORMATS)}"}]}, status_code=400)
+    # snapshot je cten z repliky, je-li k dispozici
+    asyncSessionMaker = await RunOnceAndReturnSessionMaker()
+    replicaSet = await RunOnceAndReturnReplicaSet()
+    sessionMaker = replicaSet.pick() or asyncSessionMaker
+    return StreamingResponse(
+        streamSnapshot(sessionMaker, format=format, batchSize=EXPORT_BATCH_SIZE),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="externalids.{format}"'})
+
+# websockety (subscriptions), GET a POST na /gql obsluhuji funkce vyse
+app.include_router(graphql_app, prefix="/gql")
+
 logging.info("All initialization is done")
 
 # @app.get('/hello')
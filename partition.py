@@ -0,0 +1,26 @@
+import asyncio
+import click
+
+###########################################################################################################################
+#
+# Prevod tabulky externalids na partitioned (list partitions podle typeid_id), viz src.DBDefinitions.Partitioning
+# python partition.py --batch-size 50000
+# kopiruje po davkach za behu aplikace, jen zaverecne dokopirovani zmen drzi zamek proti zapisu,
+# pripojeni se sklada stejne jako v main.py (POSTGRES_* promenne), migrace bezi proti primarni databazi
+#
+###########################################################################################################################
+
+@click.command()
+@click.option("--batch-size", type=int, default=50000, show_default=True)
+def partition(batch_size):
+    from src.DBDefinitions import startEngine, ComposeConnectionString, migrateToPartitioned
+
+    async def run():
+        sessionMaker = await startEngine(ComposeConnectionString(), makeDrop=False, makeUp=False)
+        return await migrateToPartitioned(sessionMaker, batchSize=batch_size, log=click.echo)
+
+    if not asyncio.run(run()):
+        click.echo("nothing to migrate, externalids is already partitioned (or the database is not postgres)")
+
+if __name__ == "__main__":
+    partition()
@@ -0,0 +1,67 @@
+"""Batched GQL operations (a json array of operations in one POST /gql).
+
+All operations of a batch share one context, so dataloaders of createLoadersContext deduplicate and batch loads
+across them. Batches of queries run concurrently. A batch containing a mutation runs in the order of the array,
+so later operations see the effect of earlier ones. Results are returned as an array aligned with the operations.
+
+The batch is rejected before execution when it has more than GQL_MAX_BATCH_SIZE operations or when the summed
+cost of its operations (see QueryCostLimiter) exceeds GQL_MAX_BATCH_COST. Every operation is still limited on its own.
+"""
+import asyncio
+import os
+
+from graphql import GraphQLError, OperationDefinitionNode, OperationType, parse
+
+from src.GraphTypeDefinitions._GraphCost import QueryCost, QueryCostLimiter
+
+MAX_BATCH_SIZE = int(os.environ.get("GQL_MAX_BATCH_SIZE", "20"))
+MAX_BATCH_COST = int(os.environ.get("GQL_MAX_BATCH_COST", f"{QueryCostLimiter.maxCost * 2}"))
+
+
+class BatchRejected(Exception):
+    pass
+
+
+def parseOperation(query, operationName=None):
+    """Returns (document, operation node) of the selected operation, (None, None) if it can not be selected"""
+    try:
+        document = parse(query)
+    except GraphQLError:
+        return None, None
+    operations = [definition for definition in document.definitions if isinstance(definition, OperationDefinitionNode)]
+    if operationName is not None:
+        operations = [operation for operation in operations if (operation.name is not None) and (operation.name.value == operationName)]
+    if len(operations) != 1:
+        return document, None
+    return document, operations[0]
+
+
+def checkBatch(schema, items):
+    """Raises BatchRejected for batches over limits, returns True when the batch contains a mutation"""
+    if len(items) == 0:
+        raise BatchRejected("batch is empty")
+    if len(items) > MAX_BATCH_SIZE:
+        raise BatchRejected(f"batch has {len(items)} operations, limit is {MAX_BATCH_SIZE}")
+    cost = 0
+    hasMutation = False
+    for item in items:
+        document, operation = parseOperation(item.query, item.operationName)
+        if operation is None:
+            # invalid operations are reported by their own execution
+            continue
+        if operation.operation != OperationType.QUERY:
+            hasMutation = True
+        cost += QueryCost(
+            schema, document, operationName=item.operationName, variables=item.variables,
+            defaultListSize=QueryCostLimiter.defaultListSize
+        ).compute().cost
+    if cost > MAX_BATCH_COST:
+        raise BatchRejected(f"batch cost {cost} exceeds limit {MAX_BATCH_COST}")
+    return hasMutation
+
+
+async def executeBatch(execute, items, sequential=False):
+    """execute(item) is awaited for every item, results keep the order of items"""
+    if sequential:
+        return [await execute(item) for item in items]
+    return list(await asyncio.gather(*(execute(item) for item in items)))
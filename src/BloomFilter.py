@@ -0,0 +1,209 @@
+"""Negative lookup cache for internal_id.
+
+Every type has its own Bloom filter over normalized outer ids (see src.Normalization). A key which is not in the filter
+is a definite miss and is answered without a query. Filters are built by a streaming scan of externalids
+(NegativeLookupCache.build), keys inserted by this process are added immediately (also into filters being built),
+deletes are absorbed by a periodic rebuild (BLOOM_REBUILD_INTERVAL seconds).
+
+Keys inserted by other processes (other gunicorn workers) are added by polling the change feed
+(src.Tombstones.fetchChangesSince, BLOOM_REFRESH_INTERVAL seconds), they are unknown to the filter until
+the safety window of the feed has passed, so the cache is optional (BLOOM_FILTER=True).
+"""
+import asyncio
+import datetime
+import hashlib
+import logging
+import math
+import os
+import time
+
+from sqlalchemy import select, func, DateTime
+
+from src.DBDefinitions import ExternalIdModel, ExternalIdTypeModel
+
+
+class BloomFilter:
+    """Bloom filter over strings, positions are derived from one blake2b digest (double hashing)"""
+    def __init__(self, capacity, fpRate=0.01):
+        capacity = max(1, int(capacity))
+        self.size = max(8, math.ceil(-capacity * math.log(fpRate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(first + index * second) % size for index in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    @property
+    def estimatedFalsePositiveRate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class NegativeLookupCache:
+    """Bloom filters of all types, until the first build every key is passed to the database"""
+    def __init__(self, fpRate=0.01, headroom=2.0, minCapacity=1000):
+        self.fpRate = fpRate
+        self.headroom = headroom
+        self.minCapacity = minCapacity
+        self.filters = {}
+        self.suspended = set()
+        self.addedDuringBuild = None
+        self.watermark = None
+        self.ready = False
+
+    def _newFilter(self, count):
+        return BloomFilter(max(self.minCapacity, count * self.headroom), self.fpRate)
+
+    async def build(self, asyncSessionMaker, batchSize=10000):
+        """Builds new filters by a streaming scan and swaps them in, keys added during the scan are added again"""
+        from src.Metrics import bloomFilterBuildSeconds
+        start = time.perf_counter()
+        self.addedDuringBuild = []
+        try:
+            filters, watermark = await self._scan(asyncSessionMaker, batchSize)
+        finally:
+            added, self.addedDuringBuild = self.addedDuringBuild, None
+        self.filters = filters
+        self.watermark = watermark
+        self.ready = True
+        for typeid_id, outer_id_normalized in added:
+            self.add(typeid_id, outer_id_normalized)
+        bloomFilterBuildSeconds.set(time.perf_counter() - start)
+        self.exportMetrics()
+
+    async def _scan(self, asyncSessionMaker, batchSize):
+        """Returns (filters, watermark of the change feed)"""
+        from src.Tombstones import SAFETY_SECONDS
+        table = ExternalIdModel.__table__
+        async with asyncSessionMaker() as session:
+            # changes committed during the scan may have lastchange up to the safety window before its start
+            current = func.localtimestamp(type_=DateTime) if session.bind.dialect.name == "postgresql" else func.now()
+            now = (await session.execute(select(current))).scalar()
+            watermark = (now - datetime.timedelta(seconds=SAFETY_SECONDS), None)
+            typeIds = (await session.execute(select(ExternalIdTypeModel.id))).scalars().all()
+            counts = dict((await session.execute(
+                select(table.c.typeid_id, func.count()).group_by(table.c.typeid_id))).all())
+            filters = {typeid_id: self._newFilter(counts.get(typeid_id, 0)) for typeid_id in typeIds}
+            statement = (
+                select(table.c.typeid_id, table.c.outer_id_normalized)
+                .where(table.c.outer_id_normalized.is_not(None))
+                .execution_options(yield_per=batchSize)
+            )
+            result = await session.stream(statement)
+            async for partition in result.partitions(batchSize):
+                for typeid_id, outer_id_normalized in partition:
+                    bloomFilter = filters.get(typeid_id, None)
+                    if bloomFilter is None:
+                        bloomFilter = filters[typeid_id] = self._newFilter(counts.get(typeid_id, 0))
+                    bloomFilter.add(outer_id_normalized)
+        return filters, watermark
+
+    def exportMetrics(self):
+        from src.Metrics import bloomFilterBytes, bloomFilterEstimatedFalsePositiveRate
+        for typeid_id, bloomFilter in self.filters.items():
+            bloomFilterBytes.labels(f"{typeid_id}").set(bloomFilter.nbytes)
+            bloomFilterEstimatedFalsePositiveRate.labels(f"{typeid_id}").set(bloomFilter.estimatedFalsePositiveRate)
+
+    def add(self, typeid_id, outer_id_normalized):
+        """Registers a stored key (written by this process or found in the change feed)"""
+        if outer_id_normalized is None:
+            return
+        if self.addedDuringBuild is not None:
+            self.addedDuringBuild.append((typeid_id, outer_id_normalized))
+        if not self.ready:
+            return
+        bloomFilter = self.filters.get(typeid_id, None)
+        if bloomFilter is None:
+            bloomFilter = self.filters[typeid_id] = self._newFilter(0)
+        bloomFilter.add(outer_id_normalized)
+
+    def definitelyMissing(self, typeid_id, outer_id_normalized):
+        """True when the key is surely not stored (as far as this process knows)"""
+        from src.Metrics import bloomFilterChecks
+        if not self.ready:
+            return False
+        if typeid_id in self.suspended:
+            return False
+        bloomFilter = self.filters.get(typeid_id, None)
+        if bloomFilter is None:
+            # unknown type (created by another process), ask the database
+            return False
+        missing = outer_id_normalized not in bloomFilter
+        bloomFilterChecks.labels("negative" if missing else "positive").inc()
+        return missing
+
+    def suspend(self, typeid_id):
+        """Keys of the type are passed to the database (stored values of the type are being normalized again)"""
+        self.suspended.add(typeid_id)
+
+    def resume(self, typeid_id):
+        self.suspended.discard(typeid_id)
+
+    def falsePositives(self, count):
+        from src.Metrics import bloomFilterFalsePositives
+        if self.ready and count > 0:
+            bloomFilterFalsePositives.inc(count)
+
+    def reset(self):
+        self.filters = {}
+        self.suspended = set()
+        self.watermark = None
+        self.ready = False
+
+    async def pollChanges(self, asyncSessionMaker, limit=10000):
+        """Adds keys of rows changed after the watermark (writes of other processes), returns number of changes"""
+        from src.Tombstones import fetchChangesSince
+        count = 0
+        while self.ready:
+            lastchange, id = self.watermark
+            async with asyncSessionMaker() as session:
+                changes, hasMore = await fetchChangesSince(session, lastchange, id, limit=limit)
+            for change in changes:
+                if not change.deleted:
+                    self.add(change.typeid_id, change.outer_id_normalized)
+            if len(changes) > 0:
+                self.watermark = (changes[-1].lastchange, changes[-1].id)
+            count += len(changes)
+            if not hasMore:
+                break
+        return count
+
+    async def refreshPeriodically(self, asyncSessionMaker, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.pollChanges(asyncSessionMaker)
+            except Exception as e:
+                logging.warning(f"bloom filter refresh failed {e}")
+
+    async def rebuildPeriodically(self, asyncSessionMaker, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.build(asyncSessionMaker)
+            except Exception as e:
+                logging.warning(f"bloom filter rebuild failed {e}")
+
+
+negativeLookupCache = NegativeLookupCache(fpRate=float(os.environ.get("BLOOM_FP_RATE", "0.01")))
@@ -20,3 +20,6 @@ class ExternalIdCategoryModel(BaseModel):
     lastchange = Column(DateTime, server_default=sqlalchemy.sql.func.now())
     changedby = UUIDFKey(nullable=True)#Column(ForeignKey("users.id"), index=True, nullable=True)
     createdby = UUIDFKey(nullable=True)#Column(ForeignKey("users.id"), index=True, nullable=True)
+
+    # lastchange nastavuje databaze (src.Tombstones.lastchangeFromDatabase), hodnota je po flush nactena pres RETURNING
+    __mapper_args__ = {"eager_defaults": True}
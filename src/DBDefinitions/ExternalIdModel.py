@@ -7,6 +7,9 @@ from sqlalchemy import (
     String,
     DateTime,
     ForeignKey,
+    Index,
+    DDL,
+    event,
 )
 from .UUID import UUIDColumn, UUIDFKey
 from .Base import BaseModel
@@ -18,6 +21,7 @@ class ExternalIdModel(BaseModel):
     typeid_id = Column(ForeignKey("externalidtypes.id"), index=True)
     inner_id = UUIDFKey(nullable=True)#Column(String, index=True)
     outer_id = Column(String, index=True)
+    outer_id_normalized = Column(String, comment="outer_id normalized by rules of the type, see src.Normalization")
     urlformat = Column(String, index=True)
 
     created = Column(DateTime, server_default=sqlalchemy.sql.func.now())
@@ -25,4 +29,24 @@ class ExternalIdModel(BaseModel):
     changedby = UUIDFKey(nullable=True)#Column(ForeignKey("users.id"), index=True, nullable=True)
     createdby = UUIDFKey(nullable=True)#Column(ForeignKey("users.id"), index=True, nullable=True)
 
-    type = relationship("ExternalIdTypeModel", viewonly=True)    
\ No newline at end of file
+    type = relationship("ExternalIdTypeModel", viewonly=True)
+
+    # lastchange nastavuje databaze (src.Tombstones.lastchangeFromDatabase), hodnota je po flush nactena pres RETURNING
+    __mapper_args__ = {"eager_defaults": True}
+
+    __table_args__ = (
+        # lookup (typeid_id, normalizovane outer_id) je jedna sonda do indexu, viz src.Lookups
+        Index("ix_externalids_typeid_normalized", "typeid_id", "outer_id_normalized"),
+        # keyset strankovani zmen (external_ids_changed_since)
+        Index("ix_externalids_lastchange_id", "lastchange", "id"),
+        # fulltextove (trigramove) hledani nad outer_id, viz src.Lookups.searchByOuterId
+        Index(
+            "ix_externalids_outer_id_trgm", "outer_id",
+            postgresql_using="gin", postgresql_ops={"outer_id": "gin_trgm_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
+
+event.listen(
+    BaseModel.metadata, "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
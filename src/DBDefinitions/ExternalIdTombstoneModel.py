@@ -0,0 +1,24 @@
+import sqlalchemy
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+    Index,
+    Uuid,
+)
+from .Base import BaseModel
+
+class ExternalIdTombstoneModel(BaseModel):
+    """Smazane externalids (posledni hodnoty), pro inkrementalni synchronizaci, viz src.Tombstones"""
+    __tablename__ = "externalidtombstones"
+
+    id = Column(Uuid, primary_key=True, comment="id of deleted externalids row")
+    typeid_id = Column(Uuid)
+    inner_id = Column(Uuid)
+    outer_id = Column(String)
+
+    deleted = Column(DateTime, server_default=sqlalchemy.sql.func.now())
+
+    __table_args__ = (
+        Index("ix_externalidtombstones_deleted_id", "deleted", "id"),
+    )
@@ -17,6 +17,7 @@ class ExternalIdTypeModel(BaseModel):
     name = Column(String)
     name_en = Column(String)
     urlformat = Column(String)
+    normalization = Column(String, nullable=True, comment="json list of outer_id normalization steps, see src.Normalization")
 
     category_id = Column(ForeignKey("externalidcategories.id"), index=True, nullable=True)
 
@@ -26,4 +27,7 @@ class ExternalIdTypeModel(BaseModel):
     createdby = UUIDFKey(nullable=True)#Column(ForeignKey("users.id"), index=True, nullable=True)
 
     category = relationship("ExternalIdCategoryModel", viewonly=True)
-    ids = relationship("ExternalIdModel", viewonly=True)    
\ No newline at end of file
+    ids = relationship("ExternalIdModel", viewonly=True)
+
+    # lastchange nastavuje databaze (src.Tombstones.lastchangeFromDatabase), hodnota je po flush nactena pres RETURNING
+    __mapper_args__ = {"eager_defaults": True}
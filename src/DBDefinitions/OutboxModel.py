@@ -0,0 +1,32 @@
+import sqlalchemy
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+    BigInteger,
+    Integer,
+    JSON,
+    Uuid,
+    Index,
+)
+from .Base import BaseModel
+
+class OutboxModel(BaseModel):
+    """Zmeny provedene mutacemi (encapsulateInsert/Update/Delete), zapisovane ve stejne transakci, viz src.Outbox.
+    id je offset, od ktereho lze zmeny prehrat. txid je transakce zapisu (jen postgres, jinde 0),
+    zmeny jsou ctenarum vydavany v poradi (txid, id) az po skonceni vsech starsich transakci.
+    """
+    __tablename__ = "outbox"
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    entity = Column(String, index=True)
+    entity_id = Column(Uuid)
+    operation = Column(String)
+    payload = Column(JSON)
+
+    created = Column(DateTime, server_default=sqlalchemy.sql.func.now(), index=True)
+    txid = Column(BigInteger, server_default="0", nullable=False)
+
+    __table_args__ = (
+        Index("ix_outbox_txid_id", "txid", "id"),
+    )
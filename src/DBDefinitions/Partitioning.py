@@ -0,0 +1,195 @@
+import datetime
+import uuid
+
+import sqlalchemy
+from sqlalchemy import text, select, event
+
+from .ExternalIdModel import ExternalIdModel
+from .ExternalIdTypeModel import ExternalIdTypeModel
+from .ExternalIdTombstoneModel import ExternalIdTombstoneModel
+
+###########################################################################################################################
+#
+# Volitelne (EXTERNALIDS_PARTITIONED=True, jen postgres) rozdeleni tabulky externalids na list partitions podle typeid_id.
+# Kazdy typ ma svou partition, radky neznamych typu jsou v default partition.
+# Dotazy filtrujici typeid_id (lookupy) tak pracuji jen s partition sveho typu (partition pruning),
+# vacuum a indexy malych typu jsou nezavisle na velkych.
+#
+# Prevod existujici (ploche) tabulky je samostatny prikaz (python partition.py), start aplikace jen kontroluje usporadani
+# a doplnuje partitions novych typu. migrateToPartitioned kopiruje radky do nove partitioned tabulky po davkach
+# (keyset podle id, kazda davka ve vlastni transakci), plocha tabulka je po celou dobu kopirovani pouzivana.
+# Indexy nove tabulky vznikaji pod docasnymi jmeny. Zaverecna transakce zamkne plochou tabulku proti zapisu,
+# dokopiruje zmeny provedene behem kopirovani (lastchange, tombstony smazanych radku), plochou tabulku odstrani
+# a novou prejmenuje, zamek tedy trva jen po dobu dokopirovani zmen.
+#
+# Primarni klic partitioned tabulky je (id, typeid_id), ORM nadale pracuje jen s id. Partition noveho typu je vytvorena
+# pri vlozeni ExternalIdTypeModel (ORM udalost after_insert), typy vlozene mimo ORM doplni ensurePartitions pri startu.
+#
+###########################################################################################################################
+
+PARTITIONED_TABLE = ExternalIdModel.__tablename__
+DEFAULT_PARTITION = f"{PARTITIONED_TABLE}_default"
+# nova tabulka behem migrace
+MIGRATED_TABLE = f"{PARTITIONED_TABLE}_partitioned"
+# pripona docasnych jmen indexu nove tabulky
+INDEX_SUFFIX = "_partitioned"
+
+
+def partitionName(typeid_id):
+    return f"{PARTITIONED_TABLE}_p_{uuid.UUID(f'{typeid_id}').hex}"
+
+
+def isPartitioned(connection):
+    """Synchronni, pro conn.run_sync"""
+    if connection.dialect.name != "postgresql":
+        return False
+    statement = text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))")
+    return connection.execute(statement, {"name": PARTITIONED_TABLE}).scalar()
+
+
+def createPartition(connection, typeid_id, parent=PARTITIONED_TABLE):
+    """Vytvori partition typu, radky typu z default partition jsou do ni presunuty. Vraci False, pokud jiz existuje."""
+    name = partitionName(typeid_id)
+    if connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar():
+        return False
+    # uuid je validovano partitionName, do DDL nelze predat parametr
+    value = uuid.UUID(f"{typeid_id}")
+    connection.execute(text(f'CREATE TABLE "{name}" (LIKE "{parent}" INCLUDING DEFAULTS)'))
+    connection.execute(text(
+        f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE typeid_id = :typeid_id RETURNING *) '
+        f'INSERT INTO "{name}" SELECT * FROM moved'), {"typeid_id": value})
+    connection.execute(text(f"ALTER TABLE \"{parent}\" ATTACH PARTITION \"{name}\" FOR VALUES IN ('{value}')"))
+    return True
+
+
+def ensurePartitions(connection, parent=PARTITIONED_TABLE):
+    """Vytvori chybejici partitions vsech typu, vraci pocet vytvorenych"""
+    typeIds = connection.execute(select(ExternalIdTypeModel.id)).scalars().all()
+    return sum(1 for typeid_id in typeIds if createPartition(connection, typeid_id, parent=parent))
+
+
+def migrationIndexes():
+    """Indexy ExternalIdModel nad MIGRATED_TABLE pod docasnymi jmeny, [(index, puvodni jmeno)]"""
+    source = ExternalIdModel.__table__
+    table = sqlalchemy.Table(
+        MIGRATED_TABLE, sqlalchemy.MetaData(),
+        *[sqlalchemy.Column(column.name, column.type) for column in source.columns])
+    return [
+        (sqlalchemy.Index(
+            f"{index.name}{INDEX_SUFFIX}", *[table.c[column.name] for column in index.columns],
+            unique=index.unique, **index.dialect_kwargs), index.name)
+        for index in source.indexes
+    ]
+
+
+def prepareMigration(connection):
+    """Vytvori prazdnou partitioned tabulku MIGRATED_TABLE (predchozi nedokoncena migrace je zahozena),
+    vraci cas zacatku migrace (pro dokopirovani zmen) nebo None, pokud neni co prevadet
+    """
+    if (connection.dialect.name != "postgresql") or isPartitioned(connection):
+        return None
+    hasNullType = connection.execute(text(
+        f'SELECT EXISTS (SELECT 1 FROM "{PARTITIONED_TABLE}" WHERE typeid_id IS NULL)')).scalar()
+    if hasNullType:
+        raise ValueError(f"{PARTITIONED_TABLE} has rows without typeid_id, they can not be partitioned")
+    connection.execute(text(f'DROP TABLE IF EXISTS "{MIGRATED_TABLE}" CASCADE'))
+    connection.execute(text(
+        f'CREATE TABLE "{MIGRATED_TABLE}" (LIKE "{PARTITIONED_TABLE}" INCLUDING DEFAULTS INCLUDING COMMENTS) '
+        f'PARTITION BY LIST (typeid_id)'))
+    connection.execute(text(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{MIGRATED_TABLE}" DEFAULT'))
+    ensurePartitions(connection, parent=MIGRATED_TABLE)
+    return connection.execute(text("SELECT localtimestamp")).scalar()
+
+
+def copyBatch(connection, last, batchSize):
+    """Zkopiruje az batchSize radku s id > last, vraci (nejvetsi zkopirovane id nebo None, pocet radku)"""
+    copied = connection.execute(text(
+        f'WITH batch AS (SELECT * FROM "{PARTITIONED_TABLE}" WHERE id > :last ORDER BY id LIMIT :limit) '
+        f'INSERT INTO "{MIGRATED_TABLE}" SELECT * FROM batch RETURNING id'),
+        {"last": last, "limit": batchSize}).scalars().all()
+    return (max(copied) if copied else None), len(copied)
+
+
+def createMigrationConstraints(connection):
+    """Primarni klic, cizi klic a indexy nove tabulky (zamyka jen novou tabulku)"""
+    connection.execute(text(f'ALTER TABLE "{MIGRATED_TABLE}" ADD PRIMARY KEY (id, typeid_id)'))
+    connection.execute(text(
+        f'ALTER TABLE "{MIGRATED_TABLE}" ADD FOREIGN KEY (typeid_id) REFERENCES "{ExternalIdTypeModel.__tablename__}" (id)'))
+    for index, _ in migrationIndexes():
+        index.create(connection)
+
+
+def finishMigration(connection, since):
+    """Pod zamkem proti zapisu dokopiruje zmeny od since a nahradi plochou tabulku novou, vraci pocet dokopirovanych radku"""
+    tombstones = ExternalIdTombstoneModel.__tablename__
+    connection.execute(text(f'LOCK TABLE "{PARTITIONED_TABLE}" IN EXCLUSIVE MODE'))
+    # smazane radky a prepsane radky (zmena typeid_id meni partition, proto delete a insert)
+    connection.execute(text(
+        f'DELETE FROM "{MIGRATED_TABLE}" WHERE id IN (SELECT id FROM "{tombstones}" WHERE deleted >= :since)'),
+        {"since": since})
+    connection.execute(text(
+        f'DELETE FROM "{MIGRATED_TABLE}" WHERE id IN (SELECT id FROM "{PARTITIONED_TABLE}" WHERE lastchange >= :since)'),
+        {"since": since})
+    changed = connection.execute(text(
+        f'INSERT INTO "{MIGRATED_TABLE}" SELECT * FROM "{PARTITIONED_TABLE}" WHERE lastchange >= :since'),
+        {"since": since}).rowcount
+    connection.execute(text(f'DROP TABLE "{PARTITIONED_TABLE}"'))
+    connection.execute(text(f'ALTER TABLE "{MIGRATED_TABLE}" RENAME TO "{PARTITIONED_TABLE}"'))
+    connection.execute(text(
+        f'ALTER TABLE "{PARTITIONED_TABLE}" RENAME CONSTRAINT "{MIGRATED_TABLE}_pkey" TO "{PARTITIONED_TABLE}_pkey"'))
+    for index, name in migrationIndexes():
+        connection.execute(text(f'ALTER INDEX "{index.name}" RENAME TO "{name}"'))
+    return changed
+
+
+async def migrateToPartitioned(asyncSessionMaker, batchSize=50000, log=print):
+    """Prevede plochou tabulku externalids na partitioned (viz vyse), vraci False, pokud neni co prevadet.
+    Zmeny provedene behem kopirovani jsou dokopirovany podle lastchange s rezervou src.Tombstones.SAFETY_SECONDS.
+    """
+    from src.Tombstones import SAFETY_SECONDS
+    from . import SCHEMA_LOCK_KEY
+
+    async def run(function, *args, lock=False):
+        async with asyncSessionMaker() as session:
+            async with session.begin():
+                connection = await session.connection()
+                if lock:
+                    await connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+                return await connection.run_sync(function, *args)
+
+    started = await run(prepareMigration, lock=True)
+    if started is None:
+        return False
+    last, copied = uuid.UUID(int=0), 0
+    while True:
+        nextLast, count = await run(copyBatch, last, batchSize)
+        if nextLast is None:
+            break
+        copied += count
+        last = nextLast
+        log(f"copied up to {copied} rows, last id {last}")
+    log("creating primary key and indexes")
+    await run(createMigrationConstraints)
+    changed = await run(finishMigration, started - datetime.timedelta(seconds=SAFETY_SECONDS), lock=True)
+    log(f"{changed} rows changed during the copy, {PARTITIONED_TABLE} is partitioned")
+    return True
+
+
+async def startPartitioning(asyncSessionMaker):
+    """Kontrola pri startu, vraci (partitioned, pocet vytvorenych partitions), tabulku neprevadi (viz partition.py)"""
+    from . import SCHEMA_LOCK_KEY
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            connection = await session.connection()
+            if connection.dialect.name != "postgresql":
+                return False, 0
+            await connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            if not await connection.run_sync(isPartitioned):
+                return False, 0
+            return True, await connection.run_sync(ensurePartitions)
+
+
+@event.listens_for(ExternalIdTypeModel, "after_insert")
+def createPartitionOfNewType(mapper, connection, target):
+    if isPartitioned(connection):
+        createPartition(connection, target.id)
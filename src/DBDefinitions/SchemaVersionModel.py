@@ -0,0 +1,16 @@
+import sqlalchemy
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+)
+from .Base import BaseModel
+
+class SchemaVersionModel(BaseModel):
+    """Hash schematu (BaseModel.metadata), pro ktery bylo naposledy provedeno DDL, viz startEngine"""
+    __tablename__ = "schemaversions"
+
+    name = Column(String, primary_key=True)
+    hash = Column(String)
+
+    lastchange = Column(DateTime, server_default=sqlalchemy.sql.func.now())
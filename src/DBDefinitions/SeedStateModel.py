@@ -0,0 +1,16 @@
+import sqlalchemy
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+)
+from .Base import BaseModel
+
+class SeedStateModel(BaseModel):
+    """Stav naplneni databaze systemovymi daty, viz src.DBFeeder.seedOnce"""
+    __tablename__ = "seedstates"
+
+    name = Column(String, primary_key=True)
+    checksum = Column(String)
+
+    lastchange = Column(DateTime, server_default=sqlalchemy.sql.func.now())
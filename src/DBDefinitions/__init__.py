@@ -11,6 +11,10 @@ from .Base import BaseModel
 from .ExternalIdCategoryModel import ExternalIdCategoryModel
 from .ExternalIdTypeModel import ExternalIdTypeModel
 from .ExternalIdModel import ExternalIdModel
+from .SeedStateModel import SeedStateModel
+from .SchemaVersionModel import SchemaVersionModel
+from .OutboxModel import OutboxModel
+from .ExternalIdTombstoneModel import ExternalIdTombstoneModel
 
 
 
@@ -21,22 +25,105 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 
 
-async def startEngine(connectionstring, makeDrop=False, makeUp=True):
-    """Provede nezbytne ukony a vrati asynchronni SessionMaker"""
-    asyncEngine = create_async_engine(connectionstring)
+def createEngine(connectionstring, engineOptions=None, engineLabel="primary"):
+    """Vytvori asynchronni engine s parametry poolu (viz ComposeEngineOptions)
+    a zaregistruje metriky poolu pod jmenem engineLabel.
+    """
+    from src.Metrics import createTimedPoolClass, instrumentEnginePool, instrumentEngineStatements
+
+    if engineOptions is None:
+        engineOptions = ComposeEngineOptions(connectionstring)
+    if connectionstring.startswith("postgresql"):
+        engineOptions = {"poolclass": createTimedPoolClass(engineLabel), **engineOptions}
+    asyncEngine = create_async_engine(connectionstring, **engineOptions)
+    instrumentEnginePool(asyncEngine, engineLabel)
+    instrumentEngineStatements(asyncEngine, engineLabel)
+    return asyncEngine
+
+
+import hashlib
+
+SCHEMA_LOCK_KEY = int.from_bytes(hashlib.sha256(b"gql_externalids.schema").digest()[:8], "big", signed=True)
+
+def metadataHash(metadata, dialect):
+    """Hash DDL (tabulky a indexy) metadat pro dany dialekt"""
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    result = hashlib.sha256()
+    for table in metadata.sorted_tables:
+        result.update(str(CreateTable(table).compile(dialect=dialect)).encode("utf-8"))
+        for index in sorted(table.indexes, key=lambda index: index.name or ""):
+            result.update(str(CreateIndex(index).compile(dialect=dialect)).encode("utf-8"))
+    return result.hexdigest()
+
+
+def readSchemaHash(connection, name="BaseModel"):
+    """Vrati zaznamenany hash schematu nebo None (synchronni, pro conn.run_sync)"""
+    if not sqlalchemy.inspect(connection).has_table(SchemaVersionModel.__tablename__):
+        return None
+    statement = sqlalchemy.select(SchemaVersionModel.hash).where(SchemaVersionModel.name == name)
+    return connection.execute(statement).scalar()
+
 
-    async with asyncEngine.begin() as conn:
-        if makeDrop:
-            await conn.run_sync(BaseModel.metadata.drop_all)
-            print("BaseModel.metadata.drop_all finished")
-        if makeUp:
-            try:
-                await conn.run_sync(BaseModel.metadata.create_all)
-                print("BaseModel.metadata.create_all finished")
-            except sqlalchemy.exc.NoReferencedTableError as e:
-                print(e)
-                print("Unable automaticaly create tables")
-                return None
+def writeSchemaHash(connection, schemaHash, name="BaseModel"):
+    """Zaznamena hash schematu (synchronni, pro conn.run_sync)"""
+    table = SchemaVersionModel.__table__
+    connection.execute(table.delete().where(table.c.name == name))
+    connection.execute(table.insert().values(name=name, hash=schemaHash))
+
+
+def createMissingColumnsAndIndexes(connection):
+    """create_all vytvori jen chybejici tabulky, u existujicich tabulek doplni (synchronni, pro conn.run_sync)
+    chybejici sloupce (vzdy nullable, existujici radky dostanou server_default sloupce) a indexy
+    """
+    inspector = sqlalchemy.inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in BaseModel.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            columnType = column.type.compile(dialect=connection.dialect)
+            default = column.server_default
+            if isinstance(default, sqlalchemy.DefaultClause) and isinstance(default.arg, str):
+                columnType = f"{columnType} DEFAULT '{default.arg}'"
+            connection.execute(sqlalchemy.text(
+                f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {columnType}"))
+            print(f"column {table.name}.{column.name} added")
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+async def startEngine(connectionstring, makeDrop=False, makeUp=True, engineOptions=None):
+    """Provede nezbytne ukony a vrati asynchronni SessionMaker.
+    DDL (create_all) se provadi jen tehdy, pokud se hash BaseModel.metadata lisi od hashe zaznamenaneho v databazi,
+    na postgresu je kontrola drzena pod advisory lockem, soubezne startujici procesy DDL neprovadeji soucasne.
+    """
+    from src.Metrics import measureStartupPhase
+
+    with measureStartupPhase("engine"):
+        asyncEngine = createEngine(connectionstring, engineOptions=engineOptions)
+
+    with measureStartupPhase("ddl"):
+        schemaHash = metadataHash(BaseModel.metadata, asyncEngine.dialect)
+        async with asyncEngine.begin() as conn:
+            if asyncEngine.dialect.name == "postgresql":
+                await conn.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            if makeDrop:
+                await conn.run_sync(BaseModel.metadata.drop_all)
+                print("BaseModel.metadata.drop_all finished")
+            if makeUp:
+                if (not makeDrop) and (await conn.run_sync(readSchemaHash)) == schemaHash:
+                    print("BaseModel.metadata is up to date, create_all skipped")
+                else:
+                    try:
+                        await conn.run_sync(BaseModel.metadata.create_all)
+                        await conn.run_sync(createMissingColumnsAndIndexes)
+                        print("BaseModel.metadata.create_all finished")
+                    except sqlalchemy.exc.NoReferencedTableError as e:
+                        print(e)
+                        print("Unable automaticaly create tables")
+                        return None
+                    await conn.run_sync(writeSchemaHash, schemaHash)
 
     async_sessionMaker = sessionmaker(
         asyncEngine, expire_on_commit=False, class_=AsyncSession
@@ -44,6 +131,32 @@ async def startEngine(connectionstring, makeDrop=False, makeUp=True):
     return async_sessionMaker
 
 
+def startReplicaEngines(connectionstrings, engineOptions=None):
+    """Vytvori SessionMakery pro read repliky, nad replikami se neprovadi zadne DDL"""
+    result = []
+    for index, connectionstring in enumerate(connectionstrings):
+        asyncEngine = createEngine(connectionstring, engineOptions=engineOptions, engineLabel=f"replica{index}")
+        result.append(sessionmaker(asyncEngine, expire_on_commit=False, class_=AsyncSession))
+    return result
+
+
+from .Partitioning import startPartitioning, migrateToPartitioned, partitionName
+
+
+async def warmUpPool(asyncSessionMaker, connections=1, primers=()):
+    """Otevre soucasne `connections` spojeni (pool je tak naplnen) a na kazdem spusti primers,
+    coroutine funkce s parametrem session (napr. pripravi statementy, viz src.Lookups.primeSession).
+    """
+    import contextlib
+
+    async with contextlib.AsyncExitStack() as stack:
+        for _ in range(connections):
+            session = await stack.enter_async_context(asyncSessionMaker())
+            await session.execute(sqlalchemy.text("SELECT 1"))
+            for primer in primers:
+                await primer(session)
+
+
 import os
 
 
@@ -61,3 +174,54 @@ def ComposeConnectionString():
     connectionstring = os.environ.get("CONNECTION_STRING", connectionstring)
 
     return connectionstring
+
+
+def ComposeReplicaConnectionStrings():
+    """Odvozuje connectionStringy read replik z promennych prostredi.
+    REPLICA_CONNECTION_STRINGS obsahuje connectionStringy oddelene carkou,
+    alternativne POSTGRES_REPLICA_HOSTS obsahuje hosty (host:port) oddelene carkou,
+    ostatni parametry jsou stejne jako u primarni databaze.
+    Neni-li nic definovano, vraci prazdny list.
+    """
+    connectionstrings = os.environ.get("REPLICA_CONNECTION_STRINGS", None)
+    if connectionstrings is not None:
+        return [item.strip() for item in connectionstrings.split(",") if item.strip()]
+
+    hosts = os.environ.get("POSTGRES_REPLICA_HOSTS", None)
+    if hosts is None:
+        return []
+    user = os.environ.get("POSTGRES_USER", "postgres")
+    password = os.environ.get("POSTGRES_PASSWORD", "example")
+    database = os.environ.get("POSTGRES_DB", "data")
+
+    driver = "postgresql+asyncpg"
+    return [
+        f"{driver}://{user}:{password}@{hostWithPort.strip()}/{database}"
+        for hostWithPort in hosts.split(",") if hostWithPort.strip()
+    ]
+
+
+def ComposeEngineOptions(connectionstring=None):
+    """Odvozuje parametry poolu a driveru z promennych prostredi (obdobne jako ComposeConnectionString).
+    Parametry poolu maji smysl jen pro postgres, pro ostatni (sqlite v testech) se vraci prazdny dict.
+
+    POSTGRES_POOL_SIZE, POSTGRES_MAX_OVERFLOW, POSTGRES_POOL_TIMEOUT, POSTGRES_POOL_RECYCLE,
+    POSTGRES_POOL_PRE_PING (True/False), POSTGRES_STATEMENT_CACHE_SIZE (prepared statement cache asyncpg)
+    """
+    if connectionstring is None:
+        connectionstring = ComposeConnectionString()
+    if not connectionstring.startswith("postgresql"):
+        return {}
+
+    result = {
+        "pool_size": int(os.environ.get("POSTGRES_POOL_SIZE", "5")),
+        "max_overflow": int(os.environ.get("POSTGRES_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.environ.get("POSTGRES_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.environ.get("POSTGRES_POOL_RECYCLE", "-1")),
+        "pool_pre_ping": os.environ.get("POSTGRES_POOL_PRE_PING", "False") == "True",
+    }
+    if connectionstring.startswith("postgresql+asyncpg"):
+        result["connect_args"] = {
+            "prepared_statement_cache_size": int(os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", "100"))
+        }
+    return result
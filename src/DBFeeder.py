@@ -1,4 +1,5 @@
 import uuid
+import itertools
 from functools import cache
 from src.DBDefinitions import (
     ExternalIdTypeModel,
@@ -67,9 +68,61 @@ def determineExternalIdsTypes():
     return idTypes
 
 
+import random
+
+def randomExternalIds(typeIds, count, seed=0, skew=1.2, idsPerEntity=3):
+    """Generuje `count` nahodnych (deterministickych dle seed) radku tabulky externalids.
+    Typy jsou voleny se Zipfovym rozdelenim (prvni typy v typeIds jsou nejcastejsi),
+    na jednu entitu (inner_id) pripada v prumeru idsPerEntity externich id.
+    """
+    rng = random.Random(seed)
+    weights = [1 / ((rank + 1) ** skew) for rank in range(len(typeIds))]
+    cumWeights = list(itertools.accumulate(weights))
+    entityCount = max(1, count // idsPerEntity)
+    newUUID = lambda: uuid.UUID(int=rng.getrandbits(128), version=4)
+    innerIds = [newUUID() for _ in range(entityCount)]
+    for index in range(count):
+        [typeid_id] = rng.choices(typeIds, cum_weights=cumWeights)
+        yield {
+            "id": newUUID(),
+            "typeid_id": typeid_id,
+            "inner_id": innerIds[rng.randrange(entityCount)],
+            "outer_id": f"{index:010d}",
+        }
+
+
+async def feedRandomExternalIds(asyncSessionMaker, count, seed=0, batchSize=10000, skew=1.2):
+    """Vlozi `count` nahodnych externalids (viz randomExternalIds) po davkach o velikosti batchSize.
+    Typy jsou prevzaty ze systemdata.json, musi byt v databazi jiz ulozeny.
+    """
+    from sqlalchemy import insert
+
+    from src.Normalization import typeNormalizers
+
+    typeIds = [row["id"] for row in get_demodata()["externalidtypes"]]
+    normalizers = {typeId: await typeNormalizers.normalizerFor(asyncSessionMaker, typeId) for typeId in typeIds}
+    statement = insert(ExternalIdModel)
+
+    async def saveBatch(batch):
+        async with asyncSessionMaker() as session:
+            async with session.begin():
+                await session.execute(statement, batch)
+
+    batch = []
+    for row in randomExternalIds(typeIds, count, seed=seed, skew=skew):
+        row["outer_id_normalized"] = normalizers[row["typeid_id"]](row["outer_id"])
+        batch.append(row)
+        if len(batch) >= batchSize:
+            await saveBatch(batch)
+            batch = []
+    if len(batch) > 0:
+        await saveBatch(batch)
+
+
 import os
 import json
 from uoishelpers.feeders import ImportModels
+from src.Normalization import normalizeOuterIds
 import datetime
 
 def get_demodata():
@@ -105,6 +158,287 @@ def get_demodata():
 
     return jsonData
 
+###########################################################################################################################
+#
+# Prubezne (streamovane) nacitani systemdata.json
+# soubor je cten po blocich v jednom pruchodu, radky tabulek jsou konvertovany a ukladany po davkach,
+# v pameti je tedy vzdy jen jedna davka; tabulka, ktera je v souboru drive nez tabulky, na kterych zavisi,
+# je preskocena a nactena pozdeji od zapamatovane pozice (byte offset) v souboru
+#
+###########################################################################################################################
+
+import io
+
+class JsonStream:
+    """Incremental reader of a json document, values are decoded one by one by json.JSONDecoder.raw_decode.
+    The file has to be utf-8 text without newline translation (see openJsonStream), so offset() is a byte position.
+    """
+    whitespace = " \t\r\n"
+
+    def __init__(self, file, chunkSize=1 << 16, offset=0):
+        self.file = file
+        self.chunkSize = chunkSize
+        self.buffer = ""
+        self.pos = 0
+        self.bufferOffset = offset
+        self.decoder = json.JSONDecoder()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def fill(self):
+        chunk = self.file.read(self.chunkSize)
+        if not chunk:
+            return False
+        self.bufferOffset += len(self.buffer[:self.pos].encode("utf-8"))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def offset(self):
+        """byte position of the next value in the file"""
+        self.peek()
+        return self.bufferOffset + len(self.buffer[:self.pos].encode("utf-8"))
+
+    def peek(self):
+        while True:
+            buffer = self.buffer
+            while self.pos < len(buffer) and buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(buffer):
+                return buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def take(self, char):
+        found = self.peek()
+        assert found == char, f"json: expected '{char}', found '{found}'"
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buffer) and self.fill():
+                # a number could have been cut by the chunk boundary
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """yields items of an array, the stream must be positioned at '['"""
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.take("]")
+            return
+
+    def skip(self):
+        """skips a value, arrays item by item, so they are never held in memory as a whole"""
+        if self.peek() == "[":
+            for _ in self.items():
+                pass
+        else:
+            self.value()
+
+    def tables(self):
+        """yields keys of the top level object, the stream is positioned at the value of the key.
+        A value which has not been read by the consumer is skipped.
+        """
+        self.take("{")
+        while self.peek() not in ("}", None):
+            key = self.value()
+            self.take(":")
+            yield key
+            if self.peek() not in (",", "}"):
+                self.skip()
+            if self.peek() == ",":
+                self.pos += 1
+
+
+def openJsonStream(filename, offset=0, chunkSize=1 << 16):
+    """Opens json file as JsonStream positioned at byte offset (a value of JsonStream.offset())"""
+    f = open(filename, "rb")
+    f.seek(offset)
+    return JsonStream(io.TextIOWrapper(f, encoding="utf-8", newline=""), chunkSize=chunkSize, offset=offset)
+
+
+def iterateTableRows(filename, tableName, chunkSize=1 << 16):
+    """Yields rows of top level list `tableName` from json file `filename`.
+    Other tables are skipped item by item, so they are never held in memory as a whole.
+    """
+    with openJsonStream(filename, chunkSize=chunkSize) as stream:
+        for key in stream.tables():
+            if key == tableName:
+                if stream.peek() == "[":
+                    yield from stream.items()
+                return
+
+
+def _toDatetime(value):
+    try:
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+    except Exception:
+        print("jsonconvert Error", value, flush=True)
+        return None
+
+def createRowConverter(DBModel):
+    """Returns function converting a json row into a dict of DBModel columns.
+    Converters are derived once from column types (Uuid, DateTime), keys which are not columns are dropped,
+    as well as None values (server defaults are applied).
+    """
+    from sqlalchemy import DateTime, Uuid
+    converters = {}
+    for column in DBModel.__table__.columns:
+        if isinstance(column.type, Uuid):
+            converters[column.name] = uuid.UUID
+        elif isinstance(column.type, DateTime):
+            converters[column.name] = _toDatetime
+        else:
+            converters[column.name] = None
+    converterItems = list(converters.items())
+
+    def convert(row):
+        result = {}
+        for name, converter in converterItems:
+            value = row.get(name, None)
+            if value is None or value == "":
+                continue
+            result[name] = value if (converter is None) or not isinstance(value, str) else converter(value)
+        return result
+    return convert
+
+
+async def importTableStreamed(asyncSessionMaker, DBModel, rows, batchSize=1000):
+    """Inserts rows in batches, rows with already existing id are skipped (same as ImportModels)"""
+    from sqlalchemy import insert, select
+
+    async def saveBatch(batch):
+        ids = [row["id"] for row in batch]
+        async with asyncSessionMaker() as session:
+            async with session.begin():
+                existing = set((await session.execute(select(DBModel.id).where(DBModel.id.in_(ids)))).scalars())
+                # executemany needs the same columns in every row
+                groups = {}
+                for row in batch:
+                    if row["id"] not in existing:
+                        groups.setdefault(tuple(row.keys()), []).append(row)
+                for group in groups.values():
+                    await session.execute(insert(DBModel), group)
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batchSize:
+            await saveBatch(batch)
+            batch = []
+    if len(batch) > 0:
+        await saveBatch(batch)
+
+
+async def ImportModelsStreamed(asyncSessionMaker, DBModels, filename="./systemdata.json", batchSize=1000, chunkSize=1 << 16):
+    """Streamed alternative of uoishelpers.feeders.ImportModels, tables are imported in the order of DBModels.
+    The file is read in one pass, a table is imported when it is reached and all tables before it in DBModels
+    are imported. Otherwise only its offset is recorded and the table is read from there as soon as its turn comes,
+    so every table is decoded once and tables not in DBModels are only skipped.
+    """
+    models = {DBModel.__tablename__: DBModel for DBModel in DBModels}
+    order = list(models.keys())
+    offsets = {}
+    done = 0
+
+    async def importTable(stream, tableName):
+        DBModel = models[tableName]
+        convert = createRowConverter(DBModel)
+        rows = (convert(row) for row in stream.items())
+        await importTableStreamed(asyncSessionMaker, DBModel, rows, batchSize=batchSize)
+
+    async def importRecorded(untilEnd=False):
+        # tables already passed in the file, a table missing in the file blocks the rest until the end of the pass
+        nonlocal done
+        while done < len(order):
+            tableName = order[done]
+            if tableName in offsets:
+                with openJsonStream(filename, offsets.pop(tableName), chunkSize=chunkSize) as recorded:
+                    await importTable(recorded, tableName)
+            elif not untilEnd:
+                return
+            done += 1
+
+    with openJsonStream(filename, chunkSize=chunkSize) as stream:
+        for key in stream.tables():
+            if key not in models or stream.peek() != "[":
+                continue
+            if done < len(order) and key == order[done]:
+                await importTable(stream, key)
+                done += 1
+                await importRecorded()
+            else:
+                offsets[key] = stream.offset()
+    await importRecorded(untilEnd=True)
+
+
+###########################################################################################################################
+#
+# Koordinace plneni databaze mezi procesy (gunicorn workery)
+# plneni provadi jen ten proces, ktery ziska advisory lock, ostatni na lock cekaji a pote zjisti,
+# ze kontrolni soucet systemdata.json je jiz zaznamenan, plneni tedy preskoci
+#
+###########################################################################################################################
+
+import hashlib
+from sqlalchemy import text
+
+SEED_LOCK_KEY = int.from_bytes(hashlib.sha256(b"gql_externalids.seed").digest()[:8], "big", signed=True)
+
+def systemdataChecksum(filename="./systemdata.json", extra=()):
+    """Kontrolni soucet souboru (a dalsich hodnot ovlivnujicich plneni, napr. seznamu tabulek)"""
+    result = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            result.update(chunk)
+    for item in extra:
+        result.update(f"\0{item}".encode("utf-8"))
+    return result.hexdigest()
+
+
+async def seedOnce(asyncSessionMaker, name, checksum, seed):
+    """Zavola seed() jen tehdy, pokud pro name neni v databazi zaznamenan stejny checksum.
+    Na postgresu je cela kontrola drzena pod transakcnim advisory lockem, soubezne startujici procesy
+    tedy cekaji, dokud prvni proces plneni nedokonci. Vraci True, pokud plneni probehlo.
+    """
+    from src.DBDefinitions import SeedStateModel
+
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            if session.bind.dialect.name == "postgresql":
+                await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SEED_LOCK_KEY})
+            state = await session.get(SeedStateModel, name)
+            if (state is not None) and (state.checksum == checksum):
+                return False
+            await seed()
+            if state is None:
+                session.add(SeedStateModel(name=name, checksum=checksum))
+            else:
+                state.checksum = checksum
+                state.lastchange = datetime.datetime.now()
+    return True
+
+
 async def initDB(asyncSessionMaker):
 
     defaultNoDemo = "False"
@@ -122,6 +456,22 @@ async def initDB(asyncSessionMaker):
             ExternalIdModel
         ]
 
-    jsonData = get_demodata()
-    await ImportModels(asyncSessionMaker, dbModels, jsonData)
-    pass
\ No newline at end of file
+    checksum = systemdataChecksum(extra=[DBModel.__tablename__ for DBModel in dbModels])
+    seeded = await seedOnce(
+        asyncSessionMaker, "systemdata", checksum,
+        lambda: ImportModelsStreamed(asyncSessionMaker, dbModels)
+    )
+    # radky bez outer_id_normalized (seed, data pred zavedenim normalizace) se doplnuji pod stejnym lockem,
+    # jen po zmene seedu nebo schematu, ne pri kazdem startu workeru
+    from src.DBDefinitions import BaseModel, metadataHash
+    async with asyncSessionMaker() as session:
+        schemaHash = metadataHash(BaseModel.metadata, session.bind.dialect)
+    normalized = await seedOnce(
+        asyncSessionMaker, "normalization", hashlib.sha256(f"{schemaHash}:{checksum}".encode("utf-8")).hexdigest(),
+        lambda: normalizeOuterIds(asyncSessionMaker)
+    )
+    # radky bez lastchange nejsou videt pro external_ids_changed_since
+    from src.Tombstones import fillMissingLastchange
+    filled = await fillMissingLastchange(asyncSessionMaker)
+    print(f"initDB seeded={seeded} normalized={normalized} lastchange={filled}", flush=True)
+    return seeded
\ No newline at end of file
@@ -11,8 +11,10 @@ from functools import cache
 
 def createLoaders(asyncSessionMaker):
 
+    from src.Metrics import instrumentLoader
+
     def createLambda(loaderName, DBModel):
-        return lambda self: createIdLoader(asyncSessionMaker, DBModel)
+        return lambda self: instrumentLoader(createIdLoader(asyncSessionMaker, DBModel), DBModel.__tablename__)
 
     attrs = {}
 
@@ -27,8 +29,14 @@ def createLoaders(asyncSessionMaker):
 
 
 def getUserFromInfo(info):
+    """Returns current user with parsed id.
+    The result is memoized in the context, the id is parsed only once per request.
+    """
     context = info.context
     #print(list(context.keys()))
+    result = context.get("__user", None)
+    if result is not None:
+        return result
     result = context.get("user", None)
     if result is None:
         request = context.get("request", None)
@@ -40,6 +48,7 @@ def getUserFromInfo(info):
     else:
         result = {**result, "id": uuid.UUID(result["id"])}
     # logging.debug("getUserFromInfo", result)
+    context["__user"] = result
     return result
 
 def getLoadersFromInfo(info):
@@ -50,7 +59,27 @@ def getLoadersFromInfo(info):
     assert loaders is not None, f"'loaders' key missing in context"
     return loaders
 
-def createLoadersContext(asyncSessionMaker):
+def markWrittenFromInfo(info):
+    """Reads of the rest of the request will be routed to the primary"""
+    sessionRouter = info.context.get("sessionRouter", None)
+    if sessionRouter is not None:
+        sessionRouter.markWritten()
+    lookups = info.context.get("lookups", None)
+    if lookups is not None:
+        lookups.clear_all()
+
+def getLookupsFromInfo(info):
+    context = info.context
+    lookups = context.get("lookups", None)
+    assert lookups is not None, f"'lookups' key missing in context"
+    return lookups
+
+def createLoadersContext(asyncSessionMaker, replicaSet=None):
+    from src.SessionRouter import SessionRouter
+    from src.Lookups import createLookups
+    sessionRouter = SessionRouter(asyncSessionMaker, replicaSet)
     return {
-        "loaders": createLoaders(asyncSessionMaker)
+        "loaders": createLoaders(sessionRouter),
+        "lookups": createLookups(sessionRouter),
+        "sessionRouter": sessionRouter
     }
@@ -0,0 +1,239 @@
+"""Columnar snapshot of the mapping (externalids joined with types and categories).
+
+The snapshot is written as Arrow IPC stream or Parquet. Rows are read in batches of batchSize rows, every batch
+is converted to one record batch (one row group in Parquet). The next batch is read while the previous one is converted
+and written (prefetched), so memory is bounded by a few batches. The order of rows is not defined (no sort of the whole
+table), the snapshot is consistent as it is read by one statement. UUIDs are stored as fixed_size_binary(16).
+Conversion and writing run in a worker thread.
+
+On postgres the rows are read by a server side cursor of asyncpg as raw records and UUIDs are selected
+as their 16 bytes (uuid_send), columns are built from the records without per value conversion in python.
+Other dialects read by yield_per of SQLAlchemy.
+
+pyarrow is an optional dependency, it is imported on the first export.
+"""
+import asyncio
+import contextlib
+import datetime
+
+from sqlalchemy import select, func, text, LargeBinary
+
+from src.DBDefinitions import ExternalIdModel, ExternalIdTypeModel, ExternalIdCategoryModel
+
+FORMATS = {"arrow": "application/vnd.apache.arrow.stream", "parquet": "application/vnd.apache.parquet"}
+
+externalIds = ExternalIdModel.__table__
+types = ExternalIdTypeModel.__table__
+categories = ExternalIdCategoryModel.__table__
+
+def _snapshotStatement(uuidColumn=lambda column: column):
+    return (
+        select(
+            uuidColumn(externalIds.c.id),
+            uuidColumn(externalIds.c.typeid_id),
+            uuidColumn(externalIds.c.inner_id),
+            externalIds.c.outer_id,
+            externalIds.c.outer_id_normalized,
+            externalIds.c.created,
+            externalIds.c.lastchange,
+            types.c.name.label("type_name"),
+            types.c.name_en.label("type_name_en"),
+            uuidColumn(types.c.category_id),
+            categories.c.name.label("category_name"),
+            categories.c.name_en.label("category_name_en"),
+        )
+        .select_from(externalIds)
+        .outerjoin(types, types.c.id == externalIds.c.typeid_id)
+        .outerjoin(categories, categories.c.id == types.c.category_id)
+    )
+
+snapshotStatement = _snapshotStatement()
+# uuid columns as bytea of 16 bytes
+rawSnapshotStatement = _snapshotStatement(lambda column: func.uuid_send(column, type_=LargeBinary).label(column.name))
+
+UUID_COLUMNS = ("id", "typeid_id", "inner_id", "category_id")
+TIMESTAMP_COLUMNS = ("created", "lastchange")
+
+
+def snapshotSchema():
+    import pyarrow
+    fields = []
+    for column in snapshotStatement.selected_columns:
+        if column.name in UUID_COLUMNS:
+            fieldType = pyarrow.binary(16)
+        elif column.name in TIMESTAMP_COLUMNS:
+            fieldType = pyarrow.timestamp("us")
+        else:
+            fieldType = pyarrow.string()
+        fields.append(pyarrow.field(column.name, fieldType, nullable=(column.name != "id")))
+    return pyarrow.schema(fields)
+
+
+def uuidArray(values):
+    """fixed_size_binary(16) array of 16 bytes values, without nulls it is built from one joined buffer"""
+    import pyarrow
+    if None not in values:
+        data = pyarrow.py_buffer(b"".join(values))
+        return pyarrow.Array.from_buffers(pyarrow.binary(16), len(values), [None, data])
+    return pyarrow.array(values, type=pyarrow.binary(16))
+
+
+def _timestamp(value):
+    # sqlite returns text for computed defaults in some versions, postgres returns datetime
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def pythonColumns(schema, rows):
+    """columns of rows with python values (uuid.UUID, datetime or text), converted as rawSnapshotStatement reads them"""
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    result = []
+    for field, values in zip(schema, columns):
+        if field.name in UUID_COLUMNS:
+            values = [None if value is None else value.bytes for value in values]
+        elif field.name in TIMESTAMP_COLUMNS:
+            values = [_timestamp(value) for value in values]
+        result.append(values)
+    return result
+
+
+def rawColumns(schema, records):
+    """columns of raw records of rawSnapshotStatement (transposed, values are not touched)"""
+    return list(zip(*records)) if records else [()] * len(schema)
+
+
+def recordBatch(schema, columns):
+    import pyarrow
+    arrays = [
+        uuidArray(values) if field.name in UUID_COLUMNS else pyarrow.array(values, type=field.type)
+        for field, values in zip(schema, columns)
+    ]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def openWriter(sink, schema, format):
+    if format == "arrow":
+        import pyarrow.ipc
+        return pyarrow.ipc.new_stream(sink, schema)
+    if format == "parquet":
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+    raise ValueError(f"unknown export format {format}, expected one of {list(FORMATS)}")
+
+
+async def prefetched(batches, depth=1):
+    """Iterates batches, up to depth next batches are read while the current one is processed"""
+    done = object()
+    queue = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        try:
+            async for batch in batches:
+                await queue.put((batch, None))
+            await queue.put((done, None))
+        except Exception as e:
+            await queue.put((done, e))
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            batch, error = await queue.get()
+            if error is not None:
+                raise error
+            if batch is done:
+                return
+            yield batch
+    finally:
+        task.cancel()
+        with contextlib.suppress(BaseException):
+            await task
+        await batches.aclose()
+
+
+async def readBatches(session, batchSize):
+    """Yields (toColumns, rows) of the snapshot, batchSize rows at once, toColumns(schema, rows) makes the columns"""
+    connection = await session.connection()
+    if connection.dialect.name != "postgresql":
+        result = await session.stream(snapshotStatement.execution_options(yield_per=batchSize))
+        async for rows in result.partitions(batchSize):
+            yield pythonColumns, rows
+        return
+
+    # the cursor of asyncpg lives in the transaction opened by SQLAlchemy
+    await connection.execute(text("SET TRANSACTION READ ONLY"))
+    sql = f"{rawSnapshotStatement.compile(dialect=connection.dialect)}"
+    driverConnection = (await connection.get_raw_connection()).driver_connection
+    cursor = await driverConnection.cursor(sql)
+    while True:
+        records = await cursor.fetch(batchSize)
+        if len(records) == 0:
+            return
+        yield rawColumns, records
+
+
+async def writeSnapshot(asyncSessionMaker, sink, format="arrow", batchSize=65536):
+    """Writes the snapshot into sink (path or writable binary file), yields number of rows after every batch"""
+    schema = snapshotSchema()
+    writer = await asyncio.to_thread(openWriter, sink, schema, format)
+    try:
+        async with asyncSessionMaker() as session:
+            async for toColumns, rows in prefetched(readBatches(session, batchSize)):
+                await asyncio.to_thread(lambda: writer.write_batch(recordBatch(schema, toColumns(schema, rows))))
+                yield len(rows)
+    finally:
+        await asyncio.to_thread(writer.close)
+
+
+async def exportSnapshot(asyncSessionMaker, sink, format="arrow", batchSize=65536):
+    """Writes the snapshot into sink, returns number of rows"""
+    count = 0
+    async for written in writeSnapshot(asyncSessionMaker, sink, format=format, batchSize=batchSize):
+        count += written
+    return count
+
+
+class ChunkSink:
+    """Writable file keeping written bytes until they are taken (streaming of the snapshot over http)"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return b"".join(chunks)
+
+
+async def streamSnapshot(asyncSessionMaker, format="arrow", batchSize=65536):
+    """Yields bytes of the snapshot, one chunk per batch, the next batch is read when the chunk has been sent"""
+    sink = ChunkSink()
+    batches = writeSnapshot(asyncSessionMaker, sink, format=format, batchSize=batchSize)
+    try:
+        async for _ in batches:
+            chunk = sink.take()
+            if chunk:
+                yield chunk
+    finally:
+        await batches.aclose()
+    chunk = sink.take()
+    if chunk:
+        yield chunk
@@ -0,0 +1,190 @@
+import os
+from graphql import (
+    ExecutionResult as GraphQLExecutionResult,
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLList,
+    GraphQLNonNull,
+    InlineFragmentNode,
+    OperationDefinitionNode,
+    SchemaMetaFieldDef,
+    TypeMetaFieldDef,
+    TypeNameMetaFieldDef,
+    Undefined,
+    get_named_type,
+    is_composite_type,
+    value_from_ast_untyped,
+)
+from strawberry.extensions import SchemaExtension
+
+###########################################################################################################################
+#
+# Cena dotazu je odhad poctu objektu, ktere budou behem dotazu resolvovany.
+# Kazde pole ma cenu (costHints, jinak 1 pro objekt a 0 pro skalar), cena listu je nasobena
+# argumentem limit (nebo delkou listoveho argumentu, napr. representations u _entities),
+# neni-li ani jedno k dispozici, pouzije se GQL_DEFAULT_LIST_SIZE.
+# Introspekce (__schema, __type) je zdarma, jeji hloubka (vlastni limit) a aliasy se ale pocitaji.
+#
+###########################################################################################################################
+
+costHints = {
+    "Query.externalIdsPage": 2,
+    "Query.searchExternalIds": 2,
+    "Query.externalIdsChangedSince": 2,
+    "Query.externalidtypePage": 2,
+    "Query.externalidcategoryPage": 2,
+    "Query._entities": 2,
+}
+
+
+def isListType(fieldType):
+    if isinstance(fieldType, GraphQLNonNull):
+        fieldType = fieldType.of_type
+    return isinstance(fieldType, GraphQLList)
+
+
+class QueryCost:
+    """Computes cost, depth and number of aliases of one operation of a validated document"""
+    def __init__(self, schema, document, operationName=None, variables=None, defaultListSize=10):
+        self.schema = schema
+        self.variables = variables or {}
+        self.defaultListSize = defaultListSize
+        self.fragments = {}
+        self.operation = None
+        for definition in document.definitions:
+            if isinstance(definition, FragmentDefinitionNode):
+                self.fragments[definition.name.value] = definition
+            elif isinstance(definition, OperationDefinitionNode):
+                name = None if definition.name is None else definition.name.value
+                if (self.operation is None) or (operationName is not None and name == operationName):
+                    self.operation = definition
+        self.cost = 0
+        self.depth = 0
+        # depth of data fields and of introspection (__schema, __type) have their own limits
+        self.dataDepth = 0
+        self.introspectionDepth = 0
+        self.aliases = 0
+
+    def compute(self):
+        if self.operation is not None:
+            rootType = self.schema.get_root_type(self.operation.operation)
+            self.cost, self.dataDepth = self.selectionCost(rootType, self.operation.selection_set, 0)
+            self.depth = max(self.dataDepth, self.introspectionDepth)
+        return self
+
+    def listSize(self, fieldDef, node):
+        arguments = {
+            argument.name.value: value_from_ast_untyped(argument.value, self.variables)
+            for argument in node.arguments
+        }
+        limit = arguments.get("limit", None)
+        if (limit is None) and ("limit" in fieldDef.args):
+            limit = fieldDef.args["limit"].default_value
+        if isinstance(limit, int):
+            return max(limit, 0)
+        for value in arguments.values():
+            if isinstance(value, list):
+                return len(value)
+        return self.defaultListSize
+
+    def fieldDefinition(self, parentType, name):
+        if name == "__typename":
+            return TypeNameMetaFieldDef
+        if parentType is self.schema.query_type:
+            if name == "__schema":
+                return SchemaMetaFieldDef
+            if name == "__type":
+                return TypeMetaFieldDef
+        return getattr(parentType, "fields", {}).get(name, None)
+
+    def selectionCost(self, parentType, selectionSet, depth):
+        cost = 0
+        maxDepth = depth
+        for selection in selectionSet.selections:
+            if isinstance(selection, FieldNode):
+                name = selection.name.value
+                if selection.alias is not None:
+                    self.aliases += 1
+                fieldDef = self.fieldDefinition(parentType, name)
+                if fieldDef is None:
+                    continue
+                namedType = get_named_type(fieldDef.type)
+                if name.startswith("__") or parentType.name.startswith("__"):
+                    # introspection is served from the schema, it costs nothing but its depth and aliases count
+                    fieldCost = 0
+                else:
+                    fieldCost = costHints.get(f"{parentType.name}.{name}", 1 if is_composite_type(namedType) else 0)
+                childCost, childDepth = 0, depth + 1
+                if selection.selection_set is not None:
+                    childCost, childDepth = self.selectionCost(namedType, selection.selection_set, depth + 1)
+                multiplier = self.listSize(fieldDef, selection) if isListType(fieldDef.type) else 1
+                cost += multiplier * (fieldCost + childCost)
+                if fieldDef in (SchemaMetaFieldDef, TypeMetaFieldDef):
+                    self.introspectionDepth = max(self.introspectionDepth, childDepth)
+                else:
+                    maxDepth = max(maxDepth, childDepth)
+            else:
+                if isinstance(selection, FragmentSpreadNode):
+                    fragment = self.fragments.get(selection.name.value, None)
+                    if fragment is None:
+                        continue
+                    typeCondition = fragment.type_condition
+                    selectionSet_ = fragment.selection_set
+                elif isinstance(selection, InlineFragmentNode):
+                    typeCondition = selection.type_condition
+                    selectionSet_ = selection.selection_set
+                else:
+                    continue
+                fragmentType = parentType if typeCondition is None else self.schema.get_type(typeCondition.name.value)
+                fragmentCost, fragmentDepth = self.selectionCost(fragmentType, selectionSet_, depth)
+                cost += fragmentCost
+                maxDepth = max(maxDepth, fragmentDepth)
+        return cost, maxDepth
+
+    def asDict(self):
+        return {"cost": self.cost, "depth": self.depth, "aliases": self.aliases}
+
+
+class QueryCostLimiter(SchemaExtension):
+    """Rejects operations over limits of depth (GQL_MAX_DEPTH), introspection depth (GQL_MAX_INTROSPECTION_DEPTH),
+    aliases (GQL_MAX_ALIASES) and cost (GQL_MAX_COST) before any resolver runs.
+    Computed values are returned in extensions under `cost`.
+    """
+    maxDepth = int(os.environ.get("GQL_MAX_DEPTH", "10"))
+    # the introspection query of GraphiQL (main.graphiQLQuery) has depth 13
+    maxIntrospectionDepth = int(os.environ.get("GQL_MAX_INTROSPECTION_DEPTH", "13"))
+    maxAliases = int(os.environ.get("GQL_MAX_ALIASES", "50"))
+    maxCost = int(os.environ.get("GQL_MAX_COST", "20000"))
+    defaultListSize = int(os.environ.get("GQL_DEFAULT_LIST_SIZE", "10"))
+
+    def on_execute(self):
+        execution_context = self.execution_context
+        self.queryCost = QueryCost(
+            execution_context.schema._schema,
+            execution_context.graphql_document,
+            operationName=execution_context.operation_name,
+            variables=execution_context.variables,
+            defaultListSize=self.defaultListSize
+        ).compute()
+
+        errors = [
+            GraphQLError(f"query {name} {value} exceeds limit {limit}", extensions={"code": "QUERY_TOO_COMPLEX", **self.queryCost.asDict()})
+            for name, value, limit in [
+                ("depth", self.queryCost.dataDepth, self.maxDepth),
+                ("introspection depth", self.queryCost.introspectionDepth, self.maxIntrospectionDepth),
+                ("aliases", self.queryCost.aliases, self.maxAliases),
+                ("cost", self.queryCost.cost, self.maxCost),
+            ]
+            if value > limit
+        ]
+        if errors:
+            # preset result, strawberry does not execute the operation
+            execution_context.result = GraphQLExecutionResult(data=None, errors=errors)
+            execution_context.errors = errors
+        yield
+
+    def get_results(self):
+        queryCost = getattr(self, "queryCost", None)
+        return {} if queryCost is None else {"cost": queryCost.asDict()}
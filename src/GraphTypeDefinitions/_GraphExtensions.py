@@ -0,0 +1,92 @@
+import strawberry
+from strawberry.extensions import SchemaExtension
+from strawberry.types.graphql import OperationType
+
+
+class PrimaryForMutations(SchemaExtension):
+    """Mutations are routed to the primary DB including their reads (uniqueness checks, lastchange checks, results)"""
+    def on_execute(self):
+        execution_context = self.execution_context
+        if execution_context.operation_type == OperationType.MUTATION:
+            context = execution_context.context
+            sessionRouter = context.get("sessionRouter", None) if isinstance(context, dict) else None
+            if sessionRouter is not None:
+                sessionRouter.markWritten()
+        yield
+
+
+import time
+from inspect import isawaitable
+from src.Metrics import (
+    graphqlOperationSeconds,
+    graphqlErrors,
+    graphqlResolverSeconds,
+    graphqlResolverErrors,
+    operationNameLabel,
+    SqlStats,
+    currentSqlStats,
+    operationSqlStatements,
+    operationSqlSeconds
+)
+
+class MetricsExtension(SchemaExtension):
+    """Records duration of operations (per operation name) and of asynchronous resolvers (per Type.field).
+    Synchronous resolvers (attributes of already loaded rows) are not measured, they are not worth it
+    and would cost a timer call per row and field.
+    """
+    def on_operation(self):
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+
+        execution_context = self.execution_context
+        operationName = operationNameLabel(execution_context.operation_name or "anonymous")
+        try:
+            operationType = execution_context.operation_type.value
+        except Exception:
+            # document has not been parsed
+            operationType = "unknown"
+        graphqlOperationSeconds.labels(operationName, operationType).observe(duration)
+
+        errors = execution_context.errors
+        if not errors and execution_context.result is not None:
+            errors = execution_context.result.errors
+        if errors:
+            graphqlErrors.labels(operationName).inc(len(errors))
+
+    def resolve(self, _next, root, info, *args, **kwargs):
+        result = _next(root, info, *args, **kwargs)
+        if isawaitable(result):
+            # the body of a coroutine runs when it is awaited, so the timer starts here
+            # and plain attribute fields pay only the isawaitable check
+            return self.awaitMeasured(result, time.perf_counter(), f"{info.parent_type.name}.{info.field_name}")
+        return result
+
+    async def awaitMeasured(self, result, start, field):
+        try:
+            return await result
+        except Exception:
+            graphqlResolverErrors.labels(field).inc()
+            raise
+        finally:
+            graphqlResolverSeconds.labels(field).observe(time.perf_counter() - start)
+
+
+class SqlStatsExtension(SchemaExtension):
+    """Counts SQL statements (count, total time, rows) executed during the operation.
+    The summary is exported as metrics and returned in result extensions under the key `sql`,
+    main.apollo_gql sends it to the client only when asked for (debug header).
+    """
+    def on_operation(self):
+        self.stats = SqlStats()
+        token = currentSqlStats.set(self.stats)
+        try:
+            yield
+        finally:
+            currentSqlStats.reset(token)
+        operationName = operationNameLabel(self.execution_context.operation_name or "anonymous")
+        operationSqlStatements.labels(operationName).observe(self.stats.count)
+        operationSqlSeconds.labels(operationName).observe(self.stats.duration)
+
+    def get_results(self):
+        return {"sql": self.stats.asDict()}
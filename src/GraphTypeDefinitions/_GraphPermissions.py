@@ -287,19 +287,34 @@ from src.Dataloaders import (
 
 from strawberry.type import StrawberryList
 class OnlyForAuthentized(strawberry.permission.BasePermission):
+    """Allows access only for authenticated user.
+
+    The decision is evaluated once per request and memoized in the context,
+    so a page with many rows does not repeat the check for every scalar field.
+    `has_permission` is synchronous, therefore synchronous resolvers (name, lastchange, ...)
+    stay synchronous and no coroutine is created per row.
+    """
     message = "User is not authenticated"
 
-    async def has_permission(
+    def has_permission(
         self, source, info: strawberry.types.Info, **kwargs
     ) -> bool:
+        context = info.context
+        result = context.get("__authorized", None)
+        if result is None:
+            result = self.isAuthorized(info)
+            context["__authorized"] = result
+        if not result:
+            self.defaultResult = [] if info._field.type.__class__ == StrawberryList else None
+        return result
+
+    def isAuthorized(self, info: strawberry.types.Info) -> bool:
         if self.isDEMO:
             print("DEMO Enabled, not for production")
             return True
-        
-        self.defaultResult = [] if info._field.type.__class__ == StrawberryList else None
         user = getUserFromInfo(info)
         return (False if user is None else True)
-    
+
     def on_unauthorized(self):
         return self.defaultResult
         
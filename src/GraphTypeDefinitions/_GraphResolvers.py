@@ -8,7 +8,8 @@ IDType = uuid.UUID
 UserGQLModel = typing.Annotated["UserGQLModel", strawberry.lazy(".externals")]
 GroupGQLModel = typing.Annotated["GroupGQLModel", strawberry.lazy(".externals")]
 from ._GraphPermissions import OnlyForAuthentized
-from src.Dataloaders import getUserFromInfo
+from src.Dataloaders import getUserFromInfo, markWrittenFromInfo
+from src.Outbox import recordOutbox
 
 
 @classmethod
@@ -76,18 +77,22 @@ async def resolve_changedby(self) -> typing.Optional["UserGQLModel"]:
 
 
 async def encapsulateUpdate(info, loader, entity, result):
+    markWrittenFromInfo(info)
     user = getUserFromInfo(info)
     entity.changedby = user["id"]
 
-    row = await loader.update(entity)
+    with recordOutbox():
+        row = await loader.update(entity)
     result.msg = "fail" if row is None else "ok"
     return result
 
 async def encapsulateInsert(info, loader, entity, result):
+    markWrittenFromInfo(info)
     user = getUserFromInfo(info)
     entity.createdby = user["id"]
     
-    row = await loader.insert(entity)
+    with recordOutbox():
+        row = await loader.insert(entity)
     result.msg = "ok"
     result.id = result.id if result.id else row.id       
     return result   
@@ -95,12 +100,14 @@ async def encapsulateInsert(info, loader, entity, result):
 import sqlalchemy.exc
 
 async def encapsulateDelete(info, loader, id, result):
+    markWrittenFromInfo(info)
     # try:
     #     await loader.delete(id)
     # except sqlalchemy.exc.IntegrityError as e:
     #     result.msg='fail'
     # return result
-    await loader.delete(id)
+    with recordOutbox():
+        await loader.delete(id)
     return result
     
 
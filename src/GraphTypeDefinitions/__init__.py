@@ -12,7 +12,11 @@ import strawberry
 from .externals import UserGQLModel, GroupGQLModel, EventGQLModel, FacilityGQLModel
 from .query import Query
 from .mutation import Mutation
+from .subscription import Subscription
+from ._GraphExtensions import PrimaryForMutations, MetricsExtension, SqlStatsExtension
+from ._GraphCost import QueryCostLimiter
 
 schema = strawberry.federation.Schema(
-    query=Query, mutation=Mutation, types=(UserGQLModel, GroupGQLModel, EventGQLModel, FacilityGQLModel)
+    query=Query, mutation=Mutation, subscription=Subscription, types=(UserGQLModel, GroupGQLModel, EventGQLModel, FacilityGQLModel),
+    extensions=[QueryCostLimiter, PrimaryForMutations, MetricsExtension, SqlStatsExtension]
 )
@@ -3,7 +3,10 @@ import datetime
 from typing import Union, Optional, List, Annotated
 from dataclasses import dataclass
 from uoishelpers.resolvers import createInputs
-from src.Dataloaders import getLoadersFromInfo, getUserFromInfo
+from src.Dataloaders import getLoadersFromInfo, getUserFromInfo, getLookupsFromInfo
+from src.Normalization import typeNormalizers
+from src.BloomFilter import negativeLookupCache
+from src.Tombstones import fetchChangesSince
 
 from ._GraphPermissions import OnlyForAuthentized
 from ._GraphResolvers import (
@@ -59,6 +62,10 @@ class ExternalIdGQLModel:
     def outer_id(self) -> Optional[str]:
         return self.outer_id
 
+    @strawberry.field(description="""Outer id normalized by rules of its type""")
+    def outer_id_normalized(self) -> Optional[str]:
+        return self.outer_id_normalized
+
     @strawberry.field(description="""Type of id""")
     async def type(self, info: strawberry.types.Info) -> Optional["ExternalIdTypeGQLModel"]:
         result = await ExternalIdTypeGQLModel.resolve_reference(info=info, id=self.typeid_id)
@@ -103,9 +110,8 @@ async def internal_id(
     typeid_id: IDType,
     outer_id: str,
 ) -> Optional[IDType]:
-    loader = ExternalIdGQLModel.getLoader(info)
-    rows = await loader.filter_by(outer_id=outer_id, typeid_id=typeid_id)
-    row = next(rows, None)
+    lookups = getLookupsFromInfo(info)
+    row = await lookups.internal_id.load((typeid_id, outer_id))
     if row is None:
         return None
     else:
@@ -120,12 +126,74 @@ async def external_ids(
     inner_id: IDType,
     typeid_id: Optional[IDType] = None,
 ) -> List[ExternalIdGQLModel]:
-    loader = ExternalIdGQLModel.getLoader(info)
-    if typeid_id is None:
-        rows = await loader.filter_by(inner_id=inner_id)
-    else:
-        rows = await loader.filter_by(inner_id=inner_id, typeid_id=typeid_id)
+    lookups = getLookupsFromInfo(info)
+    rows = await lookups.external_ids.load(inner_id)
+    if typeid_id is not None:
+        rows = [row for row in rows if row.typeid_id == typeid_id]
     return rows
+
+SEARCH_MAX_LIMIT = 100
+
+@strawberry.field(
+    description="""Returns external ids with outer id similar to text (fuzzy or substring match), the most similar first""",
+    permission_classes=[
+        OnlyForAuthentized
+    ]
+    )
+async def search_external_ids(
+    self,
+    info: strawberry.types.Info,
+    text: str,
+    typeid_id: Optional[IDType] = None,
+    limit: int = 10,
+) -> List[ExternalIdGQLModel]:
+    lookups = getLookupsFromInfo(info)
+    limit = max(0, min(limit, SEARCH_MAX_LIMIT))
+    return await lookups.search(text, typeid_id=typeid_id, limit=limit)
+
+@strawberry.type(description="""Change of external id, deleted rows keep their last values""")
+class ExternalIdChangeGQLModel:
+    id: IDType = strawberry.field(description="""Primary key of changed row""")
+    lastchange: datetime.datetime = strawberry.field(description="""Time of the change (of the deletion for deleted rows)""")
+    deleted: bool = strawberry.field(description="""True if the row has been deleted""")
+    typeid_id: Optional[IDType] = strawberry.field(description="""Type of id""")
+    inner_id: Optional[IDType] = strawberry.field(description="""Inner id""")
+    outer_id: Optional[str] = strawberry.field(description="""Outer id""")
+    outer_id_normalized: Optional[str] = strawberry.field(default=None, description="""Outer id normalized by rules of the type, null for deleted rows""")
+
+@strawberry.type(description="""Page of changes, next page continues after watermark""")
+class ExternalIdChangesGQLModel:
+    changes: List[ExternalIdChangeGQLModel] = strawberry.field(description="""Changes in (lastchange, id) order""")
+    watermark_lastchange: Optional[datetime.datetime] = strawberry.field(description="""lastchange of the last change, pass as since_lastchange""")
+    watermark_id: Optional[IDType] = strawberry.field(description="""id of the last change, pass as since_id""")
+    has_more: bool = strawberry.field(description="""True if more changes are available after the watermark""")
+
+CHANGED_SINCE_MAX_LIMIT = 10000
+
+@strawberry.field(
+    description="""Returns external ids changed (or deleted) after the watermark (since_lastchange, since_id), without watermark from the beginning""",
+    permission_classes=[
+        OnlyForAuthentized
+    ]
+    )
+async def external_ids_changed_since(
+    self,
+    info: strawberry.types.Info,
+    since_lastchange: Optional[datetime.datetime] = None,
+    since_id: Optional[IDType] = None,
+    limit: int = 1000,
+) -> ExternalIdChangesGQLModel:
+    lookups = getLookupsFromInfo(info)
+    limit = max(1, min(limit, CHANGED_SINCE_MAX_LIMIT))
+    async with lookups.asyncSessionMaker() as session:
+        changes, hasMore = await fetchChangesSince(session, lastchange=since_lastchange, id=since_id, limit=limit)
+    last = changes[-1] if len(changes) > 0 else None
+    return ExternalIdChangesGQLModel(
+        changes=[ExternalIdChangeGQLModel(**change._asdict()) for change in changes],
+        watermark_lastchange=since_lastchange if last is None else last.lastchange,
+        watermark_id=since_id if last is None else last.id,
+        has_more=hasMore
+    )
     
 from src.DBResolvers import DBResolvers
 external_ids_page = strawberry.field(
@@ -149,6 +217,7 @@ class ExternalIdInsertGQLModel:
     typeid_id: IDType = strawberry.field(default=None, description="Type of external id")
     outer_id: str = strawberry.field(default=None, description="Key used by other systems")
     id: Optional[IDType] = strawberry.field(default=None, description="Primary key of table row")
+    outer_id_normalized: strawberry.Private[str] = None
     changedby: strawberry.Private[IDType] = None
     createdby: strawberry.Private[IDType] = None
 
@@ -159,6 +228,7 @@ class ExternalIdUpdateGQLModel:
     inner_id: IDType = strawberry.field(default=None, description="Primary key of entity which new outeid is assigned")
     typeid_id: IDType = strawberry.field(default=None, description="Type of external id")
     outer_id: str = strawberry.field(default=None, description="Key used by other systems")
+    outer_id_normalized: strawberry.Private[str] = None
     changedby: strawberry.Private[IDType] = None
 
 @strawberry.type(description="")
@@ -181,19 +251,33 @@ class ExternalIdResultGQLModel:
     )
 async def externalid_insert(self, info: strawberry.types.Info, externalid: ExternalIdInsertGQLModel) -> Optional[ExternalIdResultGQLModel]:
     loader = ExternalIdGQLModel.getLoader(info)
-    rows = await loader.filter_by(inner_id = externalid.inner_id, typeid_id= externalid.typeid_id, outer_id=externalid.outer_id)
+    lookups = getLookupsFromInfo(info)
+    externalid.outer_id_normalized = await typeNormalizers.normalize(lookups.asyncSessionMaker, externalid.typeid_id, externalid.outer_id)
+    rows = await loader.filter_by(inner_id = externalid.inner_id, typeid_id= externalid.typeid_id, outer_id_normalized=externalid.outer_id_normalized)
     row = next(rows, None)
     if row is not None:
         return ExternalIdResultGQLModel(id=row.id, msg="fail")
 
-    return await encapsulateInsert(info, ExternalIdGQLModel.getLoader(info), externalid, ExternalIdResultGQLModel(id=externalid.id, msg="ok"))
+    result = await encapsulateInsert(info, ExternalIdGQLModel.getLoader(info), externalid, ExternalIdResultGQLModel(id=externalid.id, msg="ok"))
+    negativeLookupCache.add(externalid.typeid_id, externalid.outer_id_normalized)
+    return result
 
 @strawberry.mutation(
     description="update the external id for an entity",
     permission_classes=[OnlyForAuthentized]
     )
 async def externalid_update(self, info: strawberry.types.Info, externalid: ExternalIdUpdateGQLModel) -> ExternalIdResultGQLModel:
-    return await encapsulateUpdate(info, ExternalIdGQLModel.getLoader(info), externalid, ExternalIdResultGQLModel(id=externalid.id, msg="ok"))
+    if (externalid.outer_id is not None) or (externalid.typeid_id is not None):
+        row = await ExternalIdGQLModel.getLoader(info).load(externalid.id)
+        if row is not None:
+            lookups = getLookupsFromInfo(info)
+            typeid_id = row.typeid_id if externalid.typeid_id is None else externalid.typeid_id
+            outer_id = row.outer_id if externalid.outer_id is None else externalid.outer_id
+            externalid.outer_id_normalized = await typeNormalizers.normalize(lookups.asyncSessionMaker, typeid_id, outer_id)
+    result = await encapsulateUpdate(info, ExternalIdGQLModel.getLoader(info), externalid, ExternalIdResultGQLModel(id=externalid.id, msg="ok"))
+    if (result.msg == "ok") and (externalid.outer_id_normalized is not None):
+        negativeLookupCache.add(typeid_id, externalid.outer_id_normalized)
+    return result
 
 @strawberry.mutation(
     description="deletes the external id for an entity",
@@ -6,7 +6,10 @@ from dataclasses import dataclass
 from uoishelpers.resolvers import createInputs
 
 from .externalIdCategoryGQLModel import ExternalIdCategoryGQLModel
-from src.Dataloaders import getLoadersFromInfo, getUserFromInfo
+from src.Dataloaders import getLoadersFromInfo, getUserFromInfo, getLookupsFromInfo
+from src.Normalization import typeNormalizers, normalizationJobs, compileNormalization
+from src.BloomFilter import negativeLookupCache
+from src.ResidentIndex import residentIndex
 
 from ._GraphPermissions import OnlyForAuthentized
 from ._GraphResolvers import (
@@ -49,6 +52,10 @@ class ExternalIdTypeGQLModel:
     changed_by = resolve_changedby
     created_by = resolve_createdby
 
+    @strawberry.field(description="""Normalization rules of outer ids (json list of steps)""")
+    def normalization(self) -> Optional[str]:
+        return self.normalization
+
     @strawberry.field(description="""Category which belongs to""")
     async def category(self, info: strawberry.types.Info) -> Optional["ExternalIdCategoryGQLModel"]:
         return await ExternalIdCategoryGQLModel.resolve_reference(info, id=self.category_id)
@@ -95,6 +102,13 @@ externalidtype_by_id = strawberry.field(
 #####################################################################
 import datetime
 
+def isValidNormalization(rules):
+    try:
+        compileNormalization(rules)
+    except Exception:
+        return False
+    return True
+
 @strawberry.input(description="")
 class ExternalIdTypeInsertGQLModel:
     id: IDType = strawberry.field(default=None, description="Primary key")
@@ -103,6 +117,7 @@ class ExternalIdTypeInsertGQLModel:
     urlformat: Optional[str] = strawberry.field(default=None, description="Format for conversion of id into url link")
     id: Optional[IDType] = strawberry.field(default=None, description="Could be uuid primary key")
     category_id: Optional[IDType] = strawberry.field(default=None, description="Category of type")
+    normalization: Optional[str] = strawberry.field(default=None, description="Normalization rules of outer ids, json list of steps like [\"strip\", \"lower\"]")
     createdby: strawberry.Private[IDType] = None
 
 @strawberry.input(description="")
@@ -113,6 +128,7 @@ class ExternalIdTypeUpdateGQLModel:
     name_en: Optional[str] = strawberry.field(default=None, description="En name of type")
     urlformat: Optional[str] = strawberry.field(default=None, description="Format for conversion of id into url link")
     category_id: Optional[IDType] = strawberry.field(default=None, description="Category of type")
+    normalization: Optional[str] = strawberry.field(default=None, description="Normalization rules of outer ids, json list of steps like [\"strip\", \"lower\"]")
     changedby: strawberry.Private[IDType] = None
     
 @strawberry.type(description="")
@@ -130,14 +146,40 @@ class ExternalIdTypeResultGQLModel:
     permission_classes=[OnlyForAuthentized]
     )
 async def externaltypeid_insert(self, info: strawberry.types.Info, externaltypeid: ExternalIdTypeInsertGQLModel) -> ExternalIdTypeResultGQLModel:
-    return await encapsulateInsert(info, ExternalIdTypeGQLModel.getLoader(info), externaltypeid, ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="ok"))
+    if not isValidNormalization(externaltypeid.normalization):
+        return ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="fail")
+    result = await encapsulateInsert(info, ExternalIdTypeGQLModel.getLoader(info), externaltypeid, ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="ok"))
+    typeNormalizers.invalidate()
+    return result
 
 @strawberry.mutation(
     description="Update existing external type id for an entity",
     permission_classes=[OnlyForAuthentized]
     )
 async def externaltypeid_update(self, info: strawberry.types.Info, externaltypeid: ExternalIdTypeUpdateGQLModel) -> ExternalIdTypeResultGQLModel:
-    return await encapsulateUpdate(info, ExternalIdTypeGQLModel.getLoader(info), externaltypeid, ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="ok"))
+    if not isValidNormalization(externaltypeid.normalization):
+        return ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="fail")
+    result = await encapsulateUpdate(info, ExternalIdTypeGQLModel.getLoader(info), externaltypeid, ExternalIdTypeResultGQLModel(id=externaltypeid.id, msg="ok"))
+    if (result.msg == "ok") and (externaltypeid.normalization is not None):
+        # stored outer ids of the type are normalized again by the new rules in background (src.Normalization)
+        asyncSessionMaker = getLookupsFromInfo(info).asyncSessionMaker
+        typeNormalizers.invalidate()
+        getLookupsFromInfo(info).clear_all()
+        # filters contain keys normalized by the old rules
+        negativeLookupCache.suspend(externaltypeid.id)
+
+        async def normalized(typeid_id):
+            if negativeLookupCache.ready:
+                await negativeLookupCache.build(asyncSessionMaker)
+            negativeLookupCache.resume(typeid_id)
+            # forward keys of the index are hashes of values normalized by the old rules
+            if residentIndex.ready:
+                await residentIndex.rebuild(asyncSessionMaker)
+
+        normalizationJobs.start(
+            asyncSessionMaker, externaltypeid.id, externaltypeid.normalization,
+            settleDelay=typeNormalizers.ttl, onDone=normalized)
+    return result
 
 @strawberry.mutation(
     description="Update existing external type id for an entity",
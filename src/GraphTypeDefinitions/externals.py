@@ -1,8 +1,10 @@
+import uuid
 import strawberry
 from typing import List
 
 from .externalIdGQLModel import ExternalIdGQLModel
 from ._GraphResolvers import IDType
+from src.Dataloaders import getLookupsFromInfo
 def getLoadersFromInfo(info):
     return info.context["all"]
 
@@ -27,8 +29,10 @@ async def external_ids(
     self, info: strawberry.types.Info
 ) -> List["ExternalIdGQLModel"]:
 
-    loader = ExternalIdGQLModel.getLoader(info=info)
-    result = await loader.filter_by(inner_id=self.id)    
+    lookups = getLookupsFromInfo(info)
+    # representations from the federation carry id as a string
+    id = self.id if isinstance(self.id, uuid.UUID) else uuid.UUID(self.id)
+    result = await lookups.external_ids.load(id)
     return result
 
 @strawberry.federation.type(extend=True, keys=["id"])
@@ -0,0 +1,49 @@
+import strawberry
+import datetime
+from typing import Optional, AsyncGenerator
+from strawberry.scalars import JSON
+
+from src.Outbox import getOutboxFeed
+from ._GraphPermissions import OnlyForAuthentized
+from ._GraphResolvers import IDType
+
+###########################################################################################################################
+#
+# Proud zmen (outbox, viz src.Outbox) pro sluzby, ktere zrcadli tabulky, namisto pollingu external_ids_page
+#
+###########################################################################################################################
+
+@strawberry.type(description="""Change of an entity made by a mutation""")
+class OutboxEventGQLModel:
+    offset: int = strawberry.field(description="""Position in the change feed, replay continues after it""")
+    entity: str = strawberry.field(description="""Table name (externalids, externalidtypes, externalidcategories)""")
+    entity_id: Optional[IDType] = strawberry.field(description="""Primary key of changed entity""")
+    operation: str = strawberry.field(description="""insert, update or delete""")
+    payload: Optional[JSON] = strawberry.field(description="""Column values after the change (only id for delete)""")
+    created: Optional[datetime.datetime] = strawberry.field(description="""Time of the change""")
+
+    @classmethod
+    def fromRow(cls, row):
+        return cls(
+            offset=row.id, entity=row.entity, entity_id=row.entity_id,
+            operation=row.operation, payload=row.payload, created=row.created)
+
+
+def primarySessionMakerFromInfo(info: strawberry.types.Info):
+    sessionRouter = info.context["sessionRouter"]
+    return sessionRouter.primarySessionMaker
+
+
+@strawberry.subscription(
+    description="""Changes made by mutations, replayed from offset (exclusive) or live from now if offset is not given""",
+    permission_classes=[OnlyForAuthentized]
+    )
+async def entity_changes(
+    self,
+    info: strawberry.types.Info,
+    offset: Optional[int] = None,
+    entity: Optional[str] = None,
+) -> AsyncGenerator[OutboxEventGQLModel, None]:
+    feed = getOutboxFeed(primarySessionMakerFromInfo(info))
+    async for row in feed.events(offset=offset, entity=entity):
+        yield OutboxEventGQLModel.fromRow(row)
@@ -13,11 +13,15 @@ class Query:
     from .externalIdGQLModel import (
         internal_id, 
         external_ids, 
-        external_ids_page
+        external_ids_page,
+        search_external_ids,
+        external_ids_changed_since
         )
     external_ids = external_ids
     internal_id = internal_id
     external_ids_page = external_ids_page
+    search_external_ids = search_external_ids
+    external_ids_changed_since = external_ids_changed_since
 
     from .externalIdTypeGQLModel import (
         externalidtype_page,
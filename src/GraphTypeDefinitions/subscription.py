@@ -0,0 +1,14 @@
+import strawberry
+
+###########################################################################################################################
+#
+# zde definujte svuj Subscription model
+#
+###########################################################################################################################
+
+
+@strawberry.type(description="""Type for subscription root""")
+class Subscription:
+
+    from .outboxGQLModel import entity_changes
+    entity_changes = entity_changes
@@ -0,0 +1,211 @@
+"""Fast path for the hottest lookups (internal_id, external_ids and federated external_ids).
+
+The statements are built once at import time, so SQLAlchemy compiles them once (compiled cache hit)
+and asyncpg reuses its prepared statement. On postgres the keys are passed as a single array
+parameter (`= ANY($1)`), so the batch size does not change the statement text and does not multiply
+prepared statements. Other dialects (sqlite in tests) use expanding IN.
+Results are plain Rows (named tuples with attribute access), ORM hydration is skipped.
+"""
+import re
+import typing
+import uuid
+
+from aiodataloader import DataLoader
+from sqlalchemy import select, bindparam, any_, ARRAY, Uuid, String, Integer, func, or_
+
+from src.DBDefinitions import ExternalIdModel
+from src.BloomFilter import negativeLookupCache
+from src.ResidentIndex import residentIndex
+
+externalIdsTable = ExternalIdModel.__table__
+columns = externalIdsTable.c
+
+byInnerIds = {
+    "postgresql": select(externalIdsTable).where(
+        columns.inner_id == any_(bindparam("inner_ids", type_=ARRAY(Uuid)))),
+    None: select(externalIdsTable).where(
+        columns.inner_id.in_(bindparam("inner_ids", expanding=True))),
+}
+
+byOuterIds = {
+    "postgresql": select(externalIdsTable).where(
+        columns.outer_id_normalized == any_(bindparam("outer_ids", type_=ARRAY(String))),
+        columns.typeid_id == any_(bindparam("typeid_ids", type_=ARRAY(Uuid)))),
+    None: select(externalIdsTable).where(
+        columns.outer_id_normalized.in_(bindparam("outer_ids", expanding=True)),
+        columns.typeid_id.in_(bindparam("typeid_ids", expanding=True))),
+}
+
+
+def statementFor(statements, session):
+    return statements.get(session.bind.dialect.name, statements[None])
+
+
+async def fetchByInnerIds(session, inner_ids: typing.List[uuid.UUID]):
+    """returns rows of externalids having inner_id in inner_ids"""
+    statement = statementFor(byInnerIds, session)
+    result = await session.execute(statement, {"inner_ids": list(inner_ids)})
+    return result.all()
+
+
+async def fetchByOuterIds(session, keys: typing.List[typing.Tuple[uuid.UUID, str]]):
+    """returns rows of externalids matching (typeid_id, normalized outer_id) pairs in keys (see src.Normalization)"""
+    statement = statementFor(byOuterIds, session)
+    params = {
+        "typeid_ids": list({typeid_id for typeid_id, _ in keys}),
+        "outer_ids": list({outer_id for _, outer_id in keys}),
+    }
+    result = await session.execute(statement, params)
+    # the statement selects a superset (cross product of typeids and outerids), pairs are checked here
+    wanted = set(keys)
+    return [row for row in result.all() if (row.typeid_id, row.outer_id_normalized) in wanted]
+
+
+async def primeSession(session):
+    """Executes the hot statements with empty keys, asyncpg prepares (and caches) them on the connection"""
+    await fetchByInnerIds(session, [])
+    await fetchByOuterIds(session, [])
+
+
+#region search
+# Na postgresu je hledani podporovano trigramovym GIN indexem (pg_trgm, ix_externalids_outer_id_trgm),
+# vyhledava se podobnost (operator %) nebo podretezec (ILIKE), vysledky jsou razeny podle similarity.
+# Podretezec kratsi nez MIN_CONTAINS_LENGTH nema zadny cely trigram, ILIKE by prochazel cely index,
+# kratky text se proto hleda jen podle podobnosti.
+# Jine dialekty (sqlite v testech) pocitaji trigramy stejne jako pg_trgm, ale v pythonu nad vsemi radky.
+
+SIMILARITY_THRESHOLD = 0.3  # vychozi pg_trgm.similarity_threshold
+MIN_CONTAINS_LENGTH = 3
+
+searchText = bindparam("text", type_=String)
+similarityScore = func.similarity(columns.outer_id, searchText)
+
+def _searchStatement(withType, withContains):
+    condition = columns.outer_id.op("%")(searchText)
+    if withContains:
+        condition = or_(condition, columns.outer_id.ilike(bindparam("contains")))
+    statement = select(externalIdsTable).where(condition)
+    if withType:
+        statement = statement.where(columns.typeid_id == bindparam("typeid_id", type_=Uuid))
+    return statement.order_by(similarityScore.desc(), columns.outer_id).limit(bindparam("limit", type_=Integer))
+
+searchByOuterIdStatements = {
+    # [withType][withContains]
+    "postgresql": {
+        withType: {withContains: _searchStatement(withType, withContains) for withContains in (True, False)}
+        for withType in (True, False)
+    },
+    None: {
+        True: select(externalIdsTable).where(columns.typeid_id == bindparam("typeid_id")),
+        False: select(externalIdsTable),
+    },
+}
+
+
+def trigrams(value: str):
+    """trigrams of a string computed like pg_trgm (lowercase alphanumeric words padded by two spaces in front and one behind)"""
+    result = set()
+    for word in re.findall(r"[^\W_]+", value.lower()):
+        padded = f"  {word} "
+        result.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return result
+
+
+def similarity(a: str, b: str):
+    """same as pg_trgm similarity()"""
+    first, second = trigrams(a), trigrams(b)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+async def searchByOuterId(session, text: str, typeid_id: typing.Optional[uuid.UUID] = None, limit: int = 10):
+    """returns up to limit rows of externalids with outer_id similar to text or containing it, the most similar first,
+    texts shorter than MIN_CONTAINS_LENGTH are matched by similarity only
+    """
+    withType = typeid_id is not None
+    withContains = len(text) >= MIN_CONTAINS_LENGTH
+    params = {"typeid_id": typeid_id} if withType else {}
+    if session.bind.dialect.name == "postgresql":
+        params = {**params, "text": text, "limit": limit}
+        if withContains:
+            # backslash is the default LIKE escape character of postgres
+            escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params["contains"] = f"%{escaped}%"
+        result = await session.execute(searchByOuterIdStatements["postgresql"][withType][withContains], params)
+        return result.all()
+
+    result = await session.execute(searchByOuterIdStatements[None][withType], params)
+    lowered = text.lower()
+    scored = []
+    for row in result:
+        score = similarity(row.outer_id or "", text)
+        if (score >= SIMILARITY_THRESHOLD) or (withContains and (lowered in (row.outer_id or "").lower())):
+            scored.append((-score, row.outer_id or "", row))
+    scored.sort(key=lambda item: item[:2])
+    return [row for *_, row in scored[:limit]]
+#endregion
+
+
+class ExternalIdsByInnerIdLoader(DataLoader):
+    """inner_id -> list of externalids rows"""
+    def __init__(self, asyncSessionMaker, **kwargs):
+        super().__init__(**kwargs)
+        self.asyncSessionMaker = asyncSessionMaker
+
+    async def batch_load_fn(self, keys):
+        if residentIndex.ready:
+            await residentIndex.settle()
+            return [residentIndex.external(key) for key in keys]
+        async with self.asyncSessionMaker() as session:
+            rows = await fetchByInnerIds(session, keys)
+        grouped = {key: [] for key in keys}
+        for row in rows:
+            grouped[row.inner_id].append(row)
+        return [grouped[key] for key in keys]
+
+
+class ExternalIdByOuterIdLoader(DataLoader):
+    """(typeid_id, outer_id) -> externalids row or None"""
+    def __init__(self, asyncSessionMaker, **kwargs):
+        super().__init__(**kwargs)
+        self.asyncSessionMaker = asyncSessionMaker
+
+    async def batch_load_fn(self, keys):
+        from src.Normalization import typeNormalizers
+        normalizedKeys = [
+            (typeid_id, await typeNormalizers.normalize(self.asyncSessionMaker, typeid_id, outer_id))
+            for typeid_id, outer_id in keys]
+        if residentIndex.ready:
+            await residentIndex.settle()
+            return [residentIndex.internal(*key) for key in normalizedKeys]
+        # definite misses (see src.BloomFilter) are not queried
+        candidates = [key for key in normalizedKeys if not negativeLookupCache.definitelyMissing(*key)]
+        indexed = {}
+        if len(candidates) > 0:
+            async with self.asyncSessionMaker() as session:
+                rows = await fetchByOuterIds(session, candidates)
+            for row in rows:
+                indexed.setdefault((row.typeid_id, row.outer_id_normalized), row)
+            negativeLookupCache.falsePositives(len(set(candidates) - indexed.keys()))
+        return [indexed.get(key, None) for key in normalizedKeys]
+
+
+class Lookups:
+    def __init__(self, asyncSessionMaker):
+        from src.Metrics import instrumentLoader
+        self.asyncSessionMaker = asyncSessionMaker
+        self.external_ids = instrumentLoader(ExternalIdsByInnerIdLoader(asyncSessionMaker), "lookup_external_ids")
+        self.internal_id = instrumentLoader(ExternalIdByOuterIdLoader(asyncSessionMaker), "lookup_internal_id")
+
+    async def search(self, text, typeid_id=None, limit=10):
+        async with self.asyncSessionMaker() as session:
+            return await searchByOuterId(session, text, typeid_id=typeid_id, limit=limit)
+
+    def clear_all(self):
+        self.external_ids.clear_all()
+        self.internal_id.clear_all()
+
+
+def createLookups(asyncSessionMaker):
+    return Lookups(asyncSessionMaker)
@@ -0,0 +1,274 @@
+"""Prometheus metrics of the service.
+
+All metrics are registered in the default prometheus_client registry,
+which is exposed by the Instrumentator in main.py on /metrics.
+"""
+import contextvars
+import contextlib
+import os
+import time
+from functools import cache
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+METRIC_NAMESPACE = "gql_ug"
+
+#region DB pool
+poolSize = Gauge(
+    "db_pool_size", "Configured number of permanent connections in the pool",
+    ["engine"], namespace=METRIC_NAMESPACE)
+poolCheckedOut = Gauge(
+    "db_pool_checked_out", "Connections currently checked out from the pool",
+    ["engine"], namespace=METRIC_NAMESPACE)
+poolOverflow = Gauge(
+    "db_pool_overflow", "Connections opened above pool size (negative when pool is not filled yet)",
+    ["engine"], namespace=METRIC_NAMESPACE)
+poolWaitSeconds = Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a connection from the pool",
+    ["engine"], namespace=METRIC_NAMESPACE,
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+poolConnectSeconds = Histogram(
+    "db_pool_connect_seconds", "Time needed to establish a new DB connection",
+    ["engine"], namespace=METRIC_NAMESPACE,
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool which observes time needed for a checkout"""
+    engineLabel = "primary"
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            poolWaitSeconds.labels(self.engineLabel).observe(time.perf_counter() - start)
+
+
+@cache
+def createTimedPoolClass(engineLabel="primary"):
+    """Returns pool class bound to a label, the class survives pool.recreate()"""
+    return type(f"TimedAsyncAdaptedQueuePool_{engineLabel}", (TimedAsyncAdaptedQueuePool,), {"engineLabel": engineLabel})
+
+
+def _poolStat(asyncEngine, methodName):
+    def stat():
+        method = getattr(asyncEngine.sync_engine.pool, methodName, None)
+        return 0 if method is None else method()
+    return stat
+
+
+def instrumentEnginePool(asyncEngine, engineLabel="primary"):
+    """Exports live pool gauges and connect latency of the engine"""
+    poolSize.labels(engineLabel).set_function(_poolStat(asyncEngine, "size"))
+    poolCheckedOut.labels(engineLabel).set_function(_poolStat(asyncEngine, "checkedout"))
+    poolOverflow.labels(engineLabel).set_function(_poolStat(asyncEngine, "overflow"))
+
+    syncEngine = asyncEngine.sync_engine
+
+    @event.listens_for(syncEngine, "do_connect")
+    def receive_do_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info["connect_start"] = time.perf_counter()
+
+    @event.listens_for(syncEngine, "connect")
+    def receive_connect(dbapi_connection, connection_record):
+        start = connection_record.info.pop("connect_start", None)
+        if start is not None:
+            poolConnectSeconds.labels(engineLabel).observe(time.perf_counter() - start)
+
+    return asyncEngine
+
+#endregion
+
+#region GraphQL
+graphqlOperationSeconds = Histogram(
+    "graphql_operation_seconds", "Duration of GraphQL operations",
+    ["operation_name", "operation_type"], namespace=METRIC_NAMESPACE)
+graphqlErrors = Counter(
+    "graphql_errors_total", "Errors returned by GraphQL operations",
+    ["operation_name"], namespace=METRIC_NAMESPACE)
+graphqlResolverSeconds = Histogram(
+    "graphql_resolver_seconds", "Duration of asynchronous GraphQL resolvers",
+    ["field"], namespace=METRIC_NAMESPACE,
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+graphqlResolverErrors = Counter(
+    "graphql_resolver_errors_total", "Exceptions raised by GraphQL resolvers",
+    ["field"], namespace=METRIC_NAMESPACE)
+
+
+class BoundedLabel:
+    """Keeps label cardinality bounded, first `limit` distinct values are used as they are,
+    all other values are reported as `other`."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.seen = set()
+
+    def __call__(self, value):
+        if value in self.seen:
+            return value
+        if len(self.seen) < self.limit:
+            self.seen.add(value)
+            return value
+        return "other"
+
+
+operationNameLabel = BoundedLabel(int(os.environ.get("GQL_METRICS_MAX_OPERATIONS", "50")))
+#endregion
+
+#region Dataloaders
+dataloaderBatchSize = Histogram(
+    "dataloader_batch_size", "Number of keys in a dataloader batch",
+    ["loader"], namespace=METRIC_NAMESPACE,
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+dataloaderLoads = Counter(
+    "dataloader_loads_total", "Keys requested from a dataloader",
+    ["loader"], namespace=METRIC_NAMESPACE)
+dataloaderCacheHits = Counter(
+    "dataloader_cache_hits_total", "Keys served from the dataloader cache (hit ratio = hits / loads)",
+    ["loader"], namespace=METRIC_NAMESPACE)
+
+
+def instrumentLoader(loader, loaderLabel):
+    """Records batch sizes and cache hits of the loader instance"""
+    batchSize = dataloaderBatchSize.labels(loaderLabel)
+    loads = dataloaderLoads.labels(loaderLabel)
+    hits = dataloaderCacheHits.labels(loaderLabel)
+
+    batch_load_fn = loader.batch_load_fn
+    async def measured_batch_load_fn(keys):
+        batchSize.observe(len(keys))
+        return await batch_load_fn(keys)
+    loader.batch_load_fn = measured_batch_load_fn
+
+    load = loader.load
+    def measured_load(key):
+        loads.inc()
+        if loader.cache and loader.get_cache_key(key) in loader._cache:
+            hits.inc()
+        return load(key)
+    loader.load = measured_load
+    return loader
+#endregion
+
+#region SQL statements
+sqlStatements = Counter(
+    "db_statements_total", "Executed SQL statements",
+    ["engine"], namespace=METRIC_NAMESPACE)
+operationSqlStatements = Histogram(
+    "graphql_operation_sql_statements", "Number of SQL statements executed by a GraphQL operation",
+    ["operation_name"], namespace=METRIC_NAMESPACE,
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000))
+operationSqlSeconds = Histogram(
+    "graphql_operation_sql_seconds", "Total time of SQL statements executed by a GraphQL operation",
+    ["operation_name"], namespace=METRIC_NAMESPACE)
+
+
+class SqlStats:
+    """Accumulates SQL statements executed on behalf of one GraphQL request"""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.rows = 0
+
+    def add(self, duration, rows):
+        self.count += 1
+        self.duration += duration
+        self.rows += rows
+
+    def asDict(self):
+        return {"count": self.count, "duration": self.duration, "rows": self.rows}
+
+
+currentSqlStats = contextvars.ContextVar("currentSqlStats", default=None)
+
+
+def instrumentEngineStatements(asyncEngine, engineLabel="primary"):
+    """Attributes every statement executed on the engine to SqlStats of the current request (see currentSqlStats).
+    SQLAlchemy copies the context into its greenlets and dataloader tasks inherit it, so the contextvar is visible here.
+    """
+    statements = sqlStatements.labels(engineLabel)
+    syncEngine = asyncEngine.sync_engine
+
+    @event.listens_for(syncEngine, "before_cursor_execute")
+    def receive_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._statementStart = time.perf_counter()
+
+    @event.listens_for(syncEngine, "after_cursor_execute")
+    def receive_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.inc()
+        stats = currentSqlStats.get()
+        if stats is None:
+            return
+        duration = time.perf_counter() - context._statementStart
+        rows = cursor.rowcount
+        if rows < 0:
+            # selects report -1, async adapters have already buffered the rows
+            rows = len(getattr(cursor, "_rows", ()))
+        stats.add(duration, rows)
+
+    return asyncEngine
+#endregion
+
+
+#region Negative lookup cache (Bloom filter)
+bloomFilterBytes = Gauge(
+    "bloom_filter_bytes", "Memory of the negative lookup Bloom filter",
+    ["type"], namespace=METRIC_NAMESPACE)
+bloomFilterEstimatedFalsePositiveRate = Gauge(
+    "bloom_filter_estimated_false_positive_rate", "False positive rate estimated from size, hashes and inserted keys",
+    ["type"], namespace=METRIC_NAMESPACE)
+bloomFilterChecks = Counter(
+    "bloom_filter_checks_total", "internal_id keys checked by the Bloom filter (negative = answered without a query)",
+    ["result"], namespace=METRIC_NAMESPACE)
+bloomFilterFalsePositives = Counter(
+    "bloom_filter_false_positives_total", "Keys passed by the Bloom filter but not found in the database",
+    namespace=METRIC_NAMESPACE)
+bloomFilterBuildSeconds = Gauge(
+    "bloom_filter_build_seconds", "Duration of the last (re)build of the Bloom filters",
+    namespace=METRIC_NAMESPACE)
+#endregion
+
+
+#region Resident index
+residentIndexRows = Gauge(
+    "resident_index_rows", "Rows of the resident index (base arrays and overlay of later changes)",
+    ["part"], namespace=METRIC_NAMESPACE)
+residentIndexBytes = Gauge(
+    "resident_index_bytes", "Memory of the resident index arrays",
+    namespace=METRIC_NAMESPACE)
+residentIndexBuildSeconds = Gauge(
+    "resident_index_build_seconds", "Duration of the last (re)build of the resident index",
+    namespace=METRIC_NAMESPACE)
+residentIndexVerified = Counter(
+    "resident_index_verified_total", "Sampled keys of the resident index compared with the database",
+    ["result"], namespace=METRIC_NAMESPACE)
+#endregion
+
+
+#region Startup
+startupPhaseSeconds = Gauge(
+    "startup_phase_seconds", "Duration of startup phases of this process (engine, ddl, seed, ready)",
+    ["phase"], namespace=METRIC_NAMESPACE)
+
+processStart = time.perf_counter()
+
+
+@contextlib.contextmanager
+def measureStartupPhase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startupPhaseSeconds.labels(phase).set(time.perf_counter() - start)
+
+
+_ready = {}
+
+def markReady():
+    """Records time from process start to the first served request (only the first call counts)"""
+    if not _ready:
+        _ready["at"] = time.perf_counter()
+        startupPhaseSeconds.labels("ready").set(_ready["at"] - processStart)
+#endregion
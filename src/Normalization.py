@@ -0,0 +1,238 @@
+"""Canonical normalization of outer_id per external id type.
+
+Rules are stored with the type (ExternalIdTypeModel.normalization) as a json list of steps, e.g. for ORCID
+`["strip", {"regex": "(\\d{4}-\\d{4}-\\d{4}-\\d{3}[\\dXx])"}, "upper"]`. Supported steps are
+"strip", "lower", "upper", "nowhitespace", {"regex": pattern} (keeps group "id", first group or the whole match,
+a value which does not match is kept) and {"replace": [pattern, replacement]}.
+Types without rules keep outer_id as is.
+
+The normalized value is stored in the indexed column externalids.outer_id_normalized, lookups normalize the key
+with the same rules, so a lookup stays a single index probe.
+Compiled rules are cached by their text, rules of all types are loaded together and reloaded after NORMALIZATION_TTL
+seconds (or after a change of a type made by this process).
+
+After a change of rules the stored values of the type are normalized again by a background job (normalizationJobs)
+in keyset batches by id, every batch computes and writes the new values by the rules of the change, rows are never
+left without a value. Other processes may write values by the old rules until their rules expire, so the job makes
+a second pass after NORMALIZATION_TTL seconds. Rewritten rows get a new lastchange, so caches of other processes
+(src.BloomFilter, src.ResidentIndex) read them from the change feed.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import time
+import typing
+import uuid
+
+from sqlalchemy import select, update, bindparam, func
+
+from src.DBDefinitions import ExternalIdTypeModel, ExternalIdModel
+
+
+def identity(value):
+    return value
+
+
+def _regexStep(pattern):
+    compiled = re.compile(pattern)
+    group = "id" if "id" in compiled.groupindex else (1 if compiled.groups > 0 else 0)
+
+    def step(value):
+        match = compiled.search(value)
+        return value if match is None else match.group(group)
+    return step
+
+
+def _replaceStep(pattern, replacement):
+    compiled = re.compile(pattern)
+    return lambda value: compiled.sub(replacement, value)
+
+
+namedSteps = {
+    "strip": str.strip,
+    "lower": str.lower,
+    "upper": str.upper,
+    "nowhitespace": functools.partial(re.compile(r"\s+").sub, ""),
+}
+
+
+@functools.lru_cache(maxsize=256)
+def compileNormalization(rules: typing.Optional[str]):
+    """Returns function normalizing outer_id according to rules (json text), raises ValueError for invalid rules"""
+    if not rules:
+        return identity
+    parsed = json.loads(rules)
+    if not isinstance(parsed, list):
+        raise ValueError(f"normalization rules must be a list, got {rules}")
+    steps = []
+    for item in parsed:
+        if isinstance(item, str) and item in namedSteps:
+            steps.append(namedSteps[item])
+        elif isinstance(item, dict) and "regex" in item:
+            steps.append(_regexStep(item["regex"]))
+        elif isinstance(item, dict) and "replace" in item:
+            steps.append(_replaceStep(*item["replace"]))
+        else:
+            raise ValueError(f"unknown normalization step {item}")
+
+    def normalize(value):
+        if value is None:
+            return None
+        for step in steps:
+            value = step(value)
+        return value
+    return normalize
+
+
+async def loadNormalizers(asyncSessionMaker):
+    """Returns compiled normalization of all types as stored in the database"""
+    statement = select(ExternalIdTypeModel.id, ExternalIdTypeModel.normalization)
+    async with asyncSessionMaker() as session:
+        rows = (await session.execute(statement)).all()
+    byType = {}
+    for typeid_id, rules in rows:
+        try:
+            byType[typeid_id] = compileNormalization(rules)
+        except (ValueError, re.error) as e:
+            logging.warning(f"invalid normalization of type {typeid_id}: {e}")
+            byType[typeid_id] = identity
+    return byType
+
+
+class TypeNormalizers:
+    """Compiled normalization of all types, reloaded from the database after ttl seconds"""
+    def __init__(self, ttl=60.0):
+        self.ttl = ttl
+        self.byType = {}
+        self.loaded = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def stale(self):
+        return (self.loaded is None) or (time.monotonic() - self.loaded > self.ttl)
+
+    async def reload(self, asyncSessionMaker):
+        async with self.lock:
+            if not self.stale:
+                return
+            self.byType = await loadNormalizers(asyncSessionMaker)
+            self.loaded = time.monotonic()
+
+    async def normalizerFor(self, asyncSessionMaker, typeid_id):
+        if self.stale:
+            await self.reload(asyncSessionMaker)
+        return self.byType.get(typeid_id, identity)
+
+    async def normalize(self, asyncSessionMaker, typeid_id, outer_id):
+        normalize = await self.normalizerFor(asyncSessionMaker, typeid_id)
+        return normalize(outer_id)
+
+    def invalidate(self):
+        self.loaded = None
+
+
+typeNormalizers = TypeNormalizers(ttl=float(os.environ.get("NORMALIZATION_TTL", "60")))
+
+
+externalIdsTable = ExternalIdModel.__table__
+
+storeNormalized = (
+    update(externalIdsTable)
+    .where(externalIdsTable.c.id == bindparam("_id"))
+    # lastchange moves the rows into the change feed (src.Tombstones), other processes update their caches from it
+    .values(outer_id_normalized=bindparam("_normalized"), lastchange=func.now())
+)
+
+
+async def _normalizeBatches(asyncSessionMaker, condition, normalizerFor, batchSize):
+    """Walks rows matching condition in keyset batches by id, writes values which differ, returns number of updated rows"""
+    columns = externalIdsTable.c
+    statement = (
+        select(columns.id, columns.typeid_id, columns.outer_id, columns.outer_id_normalized)
+        .where(condition, columns.outer_id.is_not(None))
+        .order_by(columns.id)
+        .limit(batchSize)
+    )
+    count = 0
+    last = None
+    while True:
+        async with asyncSessionMaker() as session:
+            async with session.begin():
+                batch = statement if last is None else statement.where(columns.id > last)
+                rows = (await session.execute(batch)).all()
+                if len(rows) == 0:
+                    return count
+                params = []
+                for row in rows:
+                    normalized = normalizerFor(row.typeid_id)(row.outer_id)
+                    # a value which normalizes to None is stored as is
+                    normalized = row.outer_id if normalized is None else normalized
+                    if normalized != row.outer_id_normalized:
+                        params.append({"_id": row.id, "_normalized": normalized})
+                if params:
+                    await session.execute(storeNormalized, params)
+                count += len(params)
+                last = rows[-1].id
+
+
+async def normalizeOuterIds(asyncSessionMaker, batchSize=1000):
+    """Fills externalids.outer_id_normalized where it is missing (seeded rows, rows stored before normalization),
+    rules are read from the database. Returns number of updated rows.
+    """
+    byType = await loadNormalizers(asyncSessionMaker)
+    return await _normalizeBatches(
+        asyncSessionMaker, externalIdsTable.c.outer_id_normalized.is_(None),
+        lambda typeid_id: byType.get(typeid_id, identity), batchSize)
+
+
+async def renormalizeType(asyncSessionMaker, typeid_id: uuid.UUID, rules: typing.Optional[str], batchSize=1000):
+    """Normalizes stored outer ids of the type by rules (json text) again, returns number of updated rows"""
+    normalize = compileNormalization(rules)
+    return await _normalizeBatches(
+        asyncSessionMaker, externalIdsTable.c.typeid_id == typeid_id, lambda _: normalize, batchSize)
+
+
+class NormalizationJobs:
+    """Background renormalization of types after a change of their rules, at most one job per type,
+    a newer change of the type cancels the running job
+    """
+    def __init__(self):
+        self.tasks = {}
+
+    def start(self, asyncSessionMaker, typeid_id, rules, settleDelay=0.0, onDone=None):
+        """Starts the job, onDone(typeid_id) is awaited after it finishes"""
+        previous = self.tasks.get(typeid_id, None)
+        if previous is not None:
+            previous.cancel()
+        task = asyncio.get_running_loop().create_task(
+            self._run(asyncSessionMaker, typeid_id, rules, settleDelay, onDone))
+        self.tasks[typeid_id] = task
+        return task
+
+    async def _run(self, asyncSessionMaker, typeid_id, rules, settleDelay, onDone):
+        try:
+            count = await renormalizeType(asyncSessionMaker, typeid_id, rules)
+            if settleDelay > 0:
+                # values written meanwhile by processes with the old rules
+                await asyncio.sleep(settleDelay)
+                count += await renormalizeType(asyncSessionMaker, typeid_id, rules)
+            logging.info(f"type {typeid_id} normalized again, {count} rows updated")
+            if onDone is not None:
+                await onDone(typeid_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"normalization of type {typeid_id} failed {e}")
+        finally:
+            if self.tasks.get(typeid_id, None) is asyncio.current_task():
+                del self.tasks[typeid_id]
+
+    async def wait(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+
+normalizationJobs = NormalizationJobs()
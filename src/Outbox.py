@@ -0,0 +1,285 @@
+"""Transactional outbox of changes made by mutations.
+
+encapsulateInsert/Update/Delete run the loader call inside recordOutbox(). While it is active, ORM session events
+write one outbox row per inserted, updated or deleted entity. The rows go into the same transaction as the change.
+Inserts and updates are taken from the flush. Deletes are executed by a statement, so the affected ids
+are selected just before it runs.
+
+Consumers read the outbox from an offset (outbox.id) by OutboxFeed.events. This module backs the GraphQL subscription
+and the SSE endpoint in main.py. One task per process polls the head of the outbox and wakes the waiting consumers.
+
+Offsets come from a sequence, so a transaction which commits later than a newer one may get a lower offset. Rows are
+therefore read in the order of (txid, id), txid is the writing transaction (pg_current_xact_id), and only rows of
+transactions older than the oldest running one (pg_snapshot_xmin) are visible. Visible rows never get a new row
+before them, so a consumer keeps the cursor (txid, id) of its last row, an offset given by a client is translated
+to the cursor of its row. Other dialects have a single writer, txid is 0 there and rows are read in the order of offsets.
+"""
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import logging
+import os
+import uuid
+
+import sqlalchemy
+from sqlalchemy import event, select, insert, delete, func, tuple_, literal, literal_column, BigInteger
+from sqlalchemy.orm import Session
+
+from src.DBDefinitions import OutboxModel, ExternalIdModel, ExternalIdTypeModel, ExternalIdCategoryModel
+
+outboxTable = OutboxModel.__table__
+trackedModels = (ExternalIdModel, ExternalIdTypeModel, ExternalIdCategoryModel)
+
+outboxRecording = contextvars.ContextVar("outboxRecording", default=False)
+
+
+@contextlib.contextmanager
+def recordOutbox():
+    token = outboxRecording.set(True)
+    try:
+        yield
+    finally:
+        outboxRecording.reset(token)
+
+
+def jsonValue(value):
+    if isinstance(value, uuid.UUID):
+        return f"{value}"
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def entityPayload(instance):
+    """loaded column values of an ORM instance (expired server defaults are not loaded, no SQL is emitted)"""
+    state = sqlalchemy.inspect(instance)
+    loaded = state.dict
+    return {
+        column.key: jsonValue(loaded[column.key])
+        for column in state.mapper.column_attrs if column.key in loaded
+    }
+
+
+def outboxRow(instance, operation):
+    return {
+        "entity": instance.__tablename__,
+        "entity_id": instance.id,
+        "operation": operation,
+        "payload": entityPayload(instance),
+    }
+
+
+def currentTxid(dialect):
+    if dialect.name == "postgresql":
+        return literal_column("pg_current_xact_id()::text::bigint", BigInteger)
+    return literal(0, BigInteger)
+
+
+def visibleHorizon(dialect):
+    """rows with txid below the horizon are committed (or rolled back) and final, None when all rows are"""
+    if dialect.name == "postgresql":
+        return literal_column("pg_snapshot_xmin(pg_current_snapshot())::text::bigint", BigInteger)
+    return None
+
+
+def insertOutbox(connection, rows):
+    connection.execute(insert(outboxTable).values(txid=currentTxid(connection.dialect)), rows)
+
+
+@event.listens_for(Session, "after_flush")
+def recordFlush(session, flushContext):
+    if not outboxRecording.get():
+        return
+    rows = []
+    for instance in session.new:
+        if isinstance(instance, trackedModels):
+            rows.append(outboxRow(instance, "insert"))
+    for instance in session.dirty:
+        if isinstance(instance, trackedModels) and session.is_modified(instance):
+            rows.append(outboxRow(instance, "update"))
+    for instance in session.deleted:
+        if isinstance(instance, trackedModels):
+            rows.append(outboxRow(instance, "delete"))
+    if len(rows) > 0:
+        insertOutbox(session.connection(), rows)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def recordDeleteStatement(executeState):
+    if not (executeState.is_delete and outboxRecording.get()):
+        return
+    mapper = executeState.bind_mapper
+    if (mapper is None) or (not issubclass(mapper.class_, trackedModels)):
+        return
+    table = mapper.local_table
+    whereclause = executeState.statement.whereclause
+    statement = select(table.c.id)
+    if whereclause is not None:
+        statement = statement.where(whereclause)
+    ids = executeState.session.execute(statement, executeState.parameters).scalars().all()
+    rows = [
+        {"entity": table.name, "entity_id": id, "operation": "delete", "payload": {"id": f"{id}"}}
+        for id in ids
+    ]
+    if len(rows) > 0:
+        insertOutbox(executeState.session.connection(), rows)
+
+
+START = (0, 0)
+
+
+def _visible(statement, dialect):
+    horizon = visibleHorizon(dialect)
+    return statement if horizon is None else statement.where(outboxTable.c.txid < horizon)
+
+
+async def fetchOutbox(asyncSessionMaker, cursor=START, limit=100, entity=None):
+    """returns visible outbox rows after cursor (txid, id), in the order of cursors"""
+    columns = outboxTable.c
+    txid, id = cursor
+    statement = select(outboxTable).where(
+        tuple_(columns.txid, columns.id) > tuple_(literal(txid, BigInteger), literal(id, BigInteger)))
+    if entity is not None:
+        statement = statement.where(columns.entity == entity)
+    statement = statement.order_by(columns.txid, columns.id).limit(limit)
+    async with asyncSessionMaker() as session:
+        return (await session.execute(_visible(statement, session.bind.dialect))).all()
+
+
+async def outboxHead(asyncSessionMaker):
+    """cursor of the last visible row"""
+    columns = outboxTable.c
+    statement = select(columns.txid, columns.id).order_by(columns.txid.desc(), columns.id.desc()).limit(1)
+    async with asyncSessionMaker() as session:
+        row = (await session.execute(_visible(statement, session.bind.dialect))).first()
+    return START if row is None else (row.txid, row.id)
+
+
+async def offsetCursor(asyncSessionMaker, offset):
+    """cursor of the row with id offset, of the nearest older row when it has been pruned"""
+    columns = outboxTable.c
+    statement = select(columns.txid, columns.id).where(columns.id <= offset).order_by(columns.id.desc()).limit(1)
+    async with asyncSessionMaker() as session:
+        row = (await session.execute(statement)).first()
+    return START if row is None else (row.txid, row.id)
+
+
+async def pruneOutbox(asyncSessionMaker, retention: datetime.timedelta):
+    limit = datetime.datetime.now() - retention
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            await session.execute(delete(outboxTable).where(outboxTable.c.created < limit))
+
+
+class OutboxFeed:
+    """Polls the head of the outbox (one query per pollInterval for the whole process) and wakes waiting consumers"""
+    def __init__(self, asyncSessionMaker, pollInterval=1.0, retention=datetime.timedelta(days=7), pruneInterval=3600.0):
+        self.asyncSessionMaker = asyncSessionMaker
+        self.pollInterval = pollInterval
+        self.retention = retention
+        self.pruneInterval = pruneInterval
+        self.head = None
+        self.changed = None
+        self.task = None
+
+    def ensureStarted(self):
+        if (self.task is None) or self.task.done():
+            self.changed = asyncio.Event()
+            self.task = asyncio.create_task(self.poll())
+
+    async def poll(self):
+        pruned = None
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                head = await outboxHead(self.asyncSessionMaker)
+                if (self.head is None) or (head > self.head):
+                    self.head = head
+                    changed, self.changed = self.changed, asyncio.Event()
+                    changed.set()
+                if (pruned is None) or (loop.time() - pruned > self.pruneInterval):
+                    pruned = loop.time()
+                    await pruneOutbox(self.asyncSessionMaker, self.retention)
+            except Exception as e:
+                logging.warning(f"outbox poll failed {e}")
+            await asyncio.sleep(self.pollInterval)
+
+    async def waitBeyond(self, cursor):
+        while (self.head is None) or (self.head <= cursor):
+            await self.changed.wait()
+
+    async def events(self, offset=None, entity=None, batchSize=100):
+        """Yields outbox rows after offset (from the current head when offset is None), forever"""
+        self.ensureStarted()
+        if offset is None:
+            cursor = await outboxHead(self.asyncSessionMaker)
+        else:
+            cursor = await offsetCursor(self.asyncSessionMaker, offset)
+        while True:
+            head = self.head
+            rows = await fetchOutbox(self.asyncSessionMaker, cursor, limit=batchSize, entity=entity)
+            for row in rows:
+                yield row
+            if len(rows) > 0:
+                cursor = (rows[-1].txid, rows[-1].id)
+            if len(rows) < batchSize:
+                # rows up to head are final and the fetch has seen all of them,
+                # with entity filter the head grows also by rows of other entities
+                if (head is not None) and (head > cursor):
+                    cursor = head
+                await self.waitBeyond(cursor)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+_feeds = {}
+
+def getOutboxFeed(asyncSessionMaker):
+    """one feed per SessionMaker (and event loop)"""
+    key = (id(asyncSessionMaker), id(asyncio.get_running_loop()))
+    feed = _feeds.get(key, None)
+    if feed is None:
+        feed = _feeds[key] = OutboxFeed(
+            asyncSessionMaker,
+            pollInterval=float(os.environ.get("OUTBOX_POLL_INTERVAL", "1")),
+            retention=datetime.timedelta(days=float(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))),
+        )
+    return feed
+
+
+def outboxEventDict(row):
+    return {
+        "offset": row.id,
+        "entity": row.entity,
+        "entity_id": jsonValue(row.entity_id),
+        "operation": row.operation,
+        "payload": row.payload,
+        "created": jsonValue(row.created),
+    }
+
+
+async def sseStream(feed, offset=None, entity=None, heartbeat=15.0):
+    """Server sent events of the feed, event id is the offset (clients resume by Last-Event-ID)"""
+    import json
+    events = feed.events(offset=offset, entity=entity)
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(events.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=heartbeat)
+            if not done:
+                yield ": keep-alive\n\n"
+                continue
+            row = pending.result()
+            pending = None
+            yield f"id: {row.id}\nevent: {row.operation}\ndata: {json.dumps(outboxEventDict(row))}\n\n"
+    finally:
+        if pending is not None:
+            pending.cancel()
+            with contextlib.suppress(BaseException):
+                await pending
+        await events.aclose()
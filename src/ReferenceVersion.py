@@ -0,0 +1,183 @@
+"""Version of reference data (externalidtypes, externalidcategories) for conditional GQL requests.
+
+The version is max(lastchange) and count(*) of both tables. It is read at most once per REFERENCE_VERSION_TTL seconds
+and is dropped after a commit of this process which has written a type or a category (other processes are covered
+by the ttl). Row count catches deletes, which do not move max(lastchange).
+
+main.py answers queries touching only reference data (see isReferenceOnly) with an ETag derived from the version
+and the request, a matching If-None-Match gets 304 without execution. Such queries read the primary database,
+so the data can not be older than the version.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from graphql import (
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    InlineFragmentNode,
+    OperationDefinitionNode,
+    OperationType,
+    get_named_type,
+    parse,
+)
+from sqlalchemy import event, select, func
+from sqlalchemy.orm import Session
+
+from src.DBDefinitions import ExternalIdTypeModel, ExternalIdCategoryModel
+
+referenceModels = (ExternalIdTypeModel, ExternalIdCategoryModel)
+
+# fields which read only reference data, None allows all fields of the type
+referenceFields = {
+    "Query": {"externalidtypePage", "externalidtypeById", "externalidcategoryPage"},
+    "ExternalIdTypeGQLModel": None,
+    "ExternalIdCategoryGQLModel": None,
+    # changedBy, createdBy are stubs made from the row, external_ids would read externalids
+    "UserGQLModel": {"id"},
+}
+
+
+class _ReferenceSelection:
+    def __init__(self, schema, document):
+        self.schema = schema
+        self.fragments = {
+            definition.name.value: definition
+            for definition in document.definitions if isinstance(definition, FragmentDefinitionNode)
+        }
+        self.visited = set()
+
+    def allowed(self, parentType, selectionSet):
+        for selection in selectionSet.selections:
+            if isinstance(selection, FieldNode):
+                name = selection.name.value
+                if name == "__typename":
+                    continue
+                fields = referenceFields.get(parentType.name, False)
+                if (fields is False) or ((fields is not None) and (name not in fields)):
+                    return False
+                fieldDef = parentType.fields.get(name, None)
+                if fieldDef is None:
+                    return False
+                if selection.selection_set is not None:
+                    if not self.allowed(get_named_type(fieldDef.type), selection.selection_set):
+                        return False
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.fragments.get(name, None)
+                if fragment is None:
+                    return False
+                if (name, parentType.name) in self.visited:
+                    continue
+                self.visited.add((name, parentType.name))
+                if not self.allowed(self.schema.get_type(fragment.type_condition.name.value), fragment.selection_set):
+                    return False
+            elif isinstance(selection, InlineFragmentNode):
+                typeCondition = selection.type_condition
+                fragmentType = parentType if typeCondition is None else self.schema.get_type(typeCondition.name.value)
+                if (fragmentType is None) or (not self.allowed(fragmentType, selection.selection_set)):
+                    return False
+        return True
+
+
+def isReferenceOnly(schema, query, operationName=None):
+    """True when the selected operation is a query which reads only reference data (graphql-core schema)"""
+    try:
+        document = parse(query)
+    except GraphQLError:
+        return False
+    operations = [definition for definition in document.definitions if isinstance(definition, OperationDefinitionNode)]
+    if operationName is not None:
+        operations = [operation for operation in operations if (operation.name is not None) and (operation.name.value == operationName)]
+    if len(operations) != 1:
+        return False
+    operation = operations[0]
+    if operation.operation != OperationType.QUERY:
+        return False
+    return _ReferenceSelection(schema, document).allowed(schema.query_type, operation.selection_set)
+
+
+class ReferenceVersion:
+    """Cached version of reference data, the cache is per process"""
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self.value = None
+        self.loaded = None
+        self.generation = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def stale(self):
+        return (self.value is None) or (time.monotonic() - self.loaded > self.ttl)
+
+    async def read(self, asyncSessionMaker):
+        statements = [select(func.max(model.lastchange), func.count()).select_from(model) for model in referenceModels]
+        async with asyncSessionMaker() as session:
+            rows = [(await session.execute(statement)).one() for statement in statements]
+        return ";".join(f"{lastchange}|{count}" for lastchange, count in rows)
+
+    async def get(self, asyncSessionMaker):
+        if not self.stale:
+            return self.value
+        async with self.lock:
+            if self.stale:
+                generation = self.generation
+                value = await self.read(asyncSessionMaker)
+                if generation != self.generation:
+                    # written meanwhile, the value may predate the write
+                    return value
+                self.value, self.loaded = value, time.monotonic()
+            return self.value
+
+    def invalidate(self):
+        self.generation += 1
+        self.value = None
+
+
+referenceVersion = ReferenceVersion(ttl=float(os.environ.get("REFERENCE_VERSION_TTL", "5")))
+
+
+def requestETag(version, query, variables=None, operationName=None, user=None):
+    """weak ETag of the response, the user is included as resolvers may depend on permissions"""
+    userId = None if user is None else user.get("id", None)
+    key = json.dumps([version, query, variables or {}, operationName, f"{userId}"], sort_keys=True, default=str)
+    return f'W/"{hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]}"'
+
+
+def etagMatches(ifNoneMatch, etag):
+    if ifNoneMatch is None:
+        return False
+    candidates = [candidate.strip() for candidate in ifNoneMatch.split(",")]
+    # weak comparison
+    plain = etag.removeprefix("W/")
+    return ("*" in candidates) or any(candidate.removeprefix("W/") == plain for candidate in candidates)
+
+
+@event.listens_for(Session, "after_flush")
+def markReferenceWrite(session, flushContext):
+    if any(isinstance(instance, referenceModels) for instance in (*session.new, *session.dirty, *session.deleted)):
+        session.info["referenceWritten"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def markReferenceStatement(executeState):
+    if not (executeState.is_update or executeState.is_delete or executeState.is_insert):
+        return
+    mapper = executeState.bind_mapper
+    if (mapper is not None) and issubclass(mapper.class_, referenceModels):
+        executeState.session.info["referenceWritten"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidateAfterCommit(session):
+    if session.info.pop("referenceWritten", False):
+        referenceVersion.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def forgetAfterRollback(session):
+    session.info.pop("referenceWritten", None)
@@ -0,0 +1,539 @@
+"""Resident in-memory index of externalids serving internal_id and external_ids without a query.
+
+The whole table is kept in NumPy arrays (RESIDENT_INDEX=True). UUIDs are 16 byte rows of uint8 arrays,
+outer ids are utf-8 bytes with int64 offsets, timestamps are int64 microseconds, types and users are dictionary
+encoded. Two sorted key arrays point to row offsets and are searched by np.searchsorted:
+
+- forward: 64 bit blake2b of (type, normalized outer_id) -> rows, candidates are checked against stored values,
+- reverse: inner_id folded to 64 bits (xor of its halves) -> rows, candidates are checked byte by byte.
+
+Later changes are kept in an overlay of whole rows (ResidentRow by id), an overlay row (or None for a deleted row) hides
+the base row with the same id. The overlay is filled
+
+- by polling src.Tombstones.fetchChangesSince (writes of other processes, visible after its safety window),
+- after every commit of this process touching externalids (the rows are read again, lookups wait for it).
+
+A large overlay is folded into new arrays by a rebuild (full scan), the index is rebuilt also after this process
+changes normalization rules of a type. verify() compares a random sample
+of the index with the database, a mismatch schedules a rebuild.
+"""
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import random
+import time
+import typing
+import uuid
+
+import numpy
+
+from sqlalchemy import event, select, func, DateTime
+from sqlalchemy.orm import Session
+
+from src.DBDefinitions import ExternalIdModel
+
+externalIdsTable = ExternalIdModel.__table__
+columns = externalIdsTable.c
+
+NULL_TIME = numpy.iinfo(numpy.int64).min
+EPOCH = datetime.datetime(1970, 1, 1)
+NULL_UUID = bytes(16)
+
+rowColumns = (
+    columns.id, columns.typeid_id, columns.inner_id, columns.outer_id, columns.outer_id_normalized,
+    columns.created, columns.lastchange, columns.changedby, columns.createdby,
+)
+
+
+class ResidentRow(typing.NamedTuple):
+    """Columns of externalids used by the lookups (GQL ExternalIdGQLModel, /ids/resolve)"""
+    id: uuid.UUID
+    typeid_id: typing.Optional[uuid.UUID]
+    inner_id: typing.Optional[uuid.UUID]
+    outer_id: typing.Optional[str]
+    outer_id_normalized: typing.Optional[str]
+    created: typing.Optional[datetime.datetime]
+    lastchange: typing.Optional[datetime.datetime]
+    changedby: typing.Optional[uuid.UUID]
+    createdby: typing.Optional[uuid.UUID]
+
+
+def forwardHash(typeIndex: int, normalized: str) -> int:
+    digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=8, salt=typeIndex.to_bytes(16, "little")).digest()
+    return int.from_bytes(digest, "little")
+
+
+def foldUUIDs(uuids16: numpy.ndarray) -> numpy.ndarray:
+    """(N, 16) uint8 -> (N,) uint64"""
+    halves = numpy.ascontiguousarray(uuids16).view("<u8").reshape(-1, 2)
+    return halves[:, 0] ^ halves[:, 1]
+
+
+def foldUUID(value: uuid.UUID) -> int:
+    raw = value.bytes
+    return int.from_bytes(raw[:8], "little") ^ int.from_bytes(raw[8:], "little")
+
+
+def _micros(value):
+    if value is None:
+        return NULL_TIME
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None)
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return None if micros == NULL_TIME else EPOCH + datetime.timedelta(microseconds=int(micros))
+
+
+class StringColumn:
+    """utf-8 strings in one buffer, offsets has N + 1 items"""
+    def __init__(self, data: bytes, offsets: numpy.ndarray, nulls: numpy.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+
+    def get(self, index):
+        if self.nulls[index]:
+            return None
+        return self.data[self.offsets[index]:self.offsets[index + 1]].decode("utf-8")
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.offsets.nbytes + self.nulls.nbytes
+
+
+class _Dictionary:
+    """values -> dense int32 codes, -1 for None"""
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value, None)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _Builder:
+    """Collects batches of rows into numpy chunks, memory of python objects is bounded by one batch"""
+    def __init__(self):
+        self.types = _Dictionary()
+        self.users = _Dictionary()
+        self.chunks = {name: [] for name in ("ids", "typeIndex", "inner", "created", "lastchange", "changedby", "createdby", "forward")}
+        self.strings = {name: (bytearray(), [numpy.zeros(1, dtype=numpy.int64)], []) for name in ("outer", "normalized")}
+        self.count = 0
+
+    def _addStrings(self, name, values):
+        data, offsets, nulls = self.strings[name]
+        lengths = numpy.empty(len(values), dtype=numpy.int64)
+        for index, value in enumerate(values):
+            encoded = b"" if value is None else value.encode("utf-8")
+            data += encoded
+            lengths[index] = len(encoded)
+        offsets.append(offsets[-1][-1] + numpy.cumsum(lengths))
+        nulls.append(numpy.fromiter((value is None for value in values), dtype=bool, count=len(values)))
+
+    def add(self, rows):
+        if len(rows) == 0:
+            return
+        types, users = self.types, self.users
+        typeIndex = numpy.fromiter((types.encode(row.typeid_id) for row in rows), dtype=numpy.int32, count=len(rows))
+        self.chunks["ids"].append(numpy.frombuffer(b"".join(row.id.bytes for row in rows), dtype=numpy.uint8).reshape(-1, 16))
+        self.chunks["typeIndex"].append(typeIndex)
+        self.chunks["inner"].append(numpy.frombuffer(
+            b"".join(NULL_UUID if row.inner_id is None else row.inner_id.bytes for row in rows), dtype=numpy.uint8).reshape(-1, 16))
+        for name in ("created", "lastchange"):
+            self.chunks[name].append(numpy.fromiter((_micros(getattr(row, name)) for row in rows), dtype=numpy.int64, count=len(rows)))
+        for name in ("changedby", "createdby"):
+            self.chunks[name].append(numpy.fromiter((users.encode(getattr(row, name)) for row in rows), dtype=numpy.int32, count=len(rows)))
+        self.chunks["forward"].append(numpy.fromiter(
+            (0 if (row.outer_id_normalized is None) or (code < 0) else forwardHash(int(code), row.outer_id_normalized)
+             for code, row in zip(typeIndex, rows)), dtype=numpy.uint64, count=len(rows)))
+        self._addStrings("outer", [row.outer_id for row in rows])
+        self._addStrings("normalized", [row.outer_id_normalized for row in rows])
+        self.count += len(rows)
+
+    def build(self):
+        def concatenate(name, dtype, shape=(0,)):
+            chunks = self.chunks[name]
+            return numpy.concatenate(chunks) if chunks else numpy.zeros(shape, dtype=dtype)
+
+        def strings(name):
+            data, offsets, nulls = self.strings[name]
+            return StringColumn(bytes(data), numpy.concatenate(offsets), numpy.concatenate(nulls) if nulls else numpy.zeros(0, dtype=bool))
+
+        return MappingArrays(
+            types=self.types.values,
+            users=self.users.values,
+            ids=concatenate("ids", numpy.uint8, (0, 16)),
+            typeIndex=concatenate("typeIndex", numpy.int32),
+            inner=concatenate("inner", numpy.uint8, (0, 16)),
+            outer=strings("outer"),
+            normalized=strings("normalized"),
+            created=concatenate("created", numpy.int64),
+            lastchange=concatenate("lastchange", numpy.int64),
+            changedby=concatenate("changedby", numpy.int32),
+            createdby=concatenate("createdby", numpy.int32),
+            forward=concatenate("forward", numpy.uint64),
+        )
+
+
+class MappingArrays:
+    """Immutable arrays of one scan"""
+    def __init__(self, types, users, ids, typeIndex, inner, outer, normalized, created, lastchange, changedby, createdby, forward):
+        self.types = types
+        self.typeCodes = {typeid_id: code for code, typeid_id in enumerate(types)}
+        self.users = users
+        self.ids = ids
+        self.typeIndex = typeIndex
+        self.inner = inner
+        self.outer = outer
+        self.normalized = normalized
+        self.created = created
+        self.lastchange = lastchange
+        self.changedby = changedby
+        self.createdby = createdby
+
+        # rows without type or normalized value can not be found by internal_id
+        forwardRows = numpy.flatnonzero(~normalized.nulls & (typeIndex >= 0))
+        order = numpy.argsort(forward[forwardRows], kind="stable")
+        self.forwardRows = forwardRows[order]
+        self.forwardKeys = forward[self.forwardRows]
+
+        reverse = foldUUIDs(inner)
+        reverseRows = numpy.flatnonzero(inner.any(axis=1))
+        order = numpy.argsort(reverse[reverseRows], kind="stable")
+        self.reverseRows = reverseRows[order]
+        self.reverseKeys = reverse[self.reverseRows]
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        arrays = (self.ids, self.typeIndex, self.inner, self.created, self.lastchange, self.changedby, self.createdby,
+                  self.forwardRows, self.forwardKeys, self.reverseRows, self.reverseKeys)
+        return sum(array.nbytes for array in arrays) + self.outer.nbytes + self.normalized.nbytes
+
+    def row(self, index) -> ResidentRow:
+        innerBytes = self.inner[index].tobytes()
+        return ResidentRow(
+            id=uuid.UUID(bytes=self.ids[index].tobytes()),
+            typeid_id=None if self.typeIndex[index] < 0 else self.types[self.typeIndex[index]],
+            inner_id=None if innerBytes == NULL_UUID else uuid.UUID(bytes=innerBytes),
+            outer_id=self.outer.get(index),
+            outer_id_normalized=self.normalized.get(index),
+            created=_datetime(self.created[index]),
+            lastchange=_datetime(self.lastchange[index]),
+            changedby=None if self.changedby[index] < 0 else self.users[self.changedby[index]],
+            createdby=None if self.createdby[index] < 0 else self.users[self.createdby[index]],
+        )
+
+    def byForward(self, typeid_id, normalized):
+        code = self.typeCodes.get(typeid_id, None)
+        if code is None:
+            return []
+        key = numpy.uint64(forwardHash(code, normalized))
+        start = numpy.searchsorted(self.forwardKeys, key, side="left")
+        stop = numpy.searchsorted(self.forwardKeys, key, side="right")
+        return [
+            int(index) for index in self.forwardRows[start:stop]
+            if self.typeIndex[index] == code and self.normalized.get(index) == normalized
+        ]
+
+    def byInner(self, inner_id):
+        key = numpy.uint64(foldUUID(inner_id))
+        start = numpy.searchsorted(self.reverseKeys, key, side="left")
+        stop = numpy.searchsorted(self.reverseKeys, key, side="right")
+        raw = inner_id.bytes
+        return [int(index) for index in self.reverseRows[start:stop] if self.inner[index].tobytes() == raw]
+
+
+async def fetchRows(session, ids):
+    """ResidentRows of ids which exist"""
+    if len(ids) == 0:
+        return []
+    result = await session.execute(select(*rowColumns).where(columns.id.in_(list(ids))))
+    return [ResidentRow(*row) for row in result]
+
+
+class ResidentIndex:
+    def __init__(self, overlayLimit=100000):
+        self.overlayLimit = overlayLimit
+        self.arrays = None
+        self.overlay = {}
+        self.overlayForward = {}
+        self.overlayReverse = {}
+        self.watermark = None
+        self.pending = set()
+        self.touchedDuringBuild = None
+        self.rebuilding = None
+
+    @property
+    def ready(self):
+        return self.arrays is not None
+
+    #region build
+    async def build(self, asyncSessionMaker, batchSize=50000):
+        """Full scan into new arrays, the overlay is replaced by changes after the scan"""
+        from src.Metrics import residentIndexBuildSeconds
+        from src.Tombstones import SAFETY_SECONDS
+        start = time.perf_counter()
+        self.touchedDuringBuild = set()
+        builder = _Builder()
+        async with asyncSessionMaker() as session:
+            # changes committed during the scan may have lastchange up to the safety window before its start
+            # lastchange is timestamp without time zone, on postgres now() is timestamptz
+            current = func.localtimestamp(type_=DateTime) if session.bind.dialect.name == "postgresql" else func.now()
+            now = (await session.execute(select(current))).scalar()
+            watermark = (now - datetime.timedelta(seconds=SAFETY_SECONDS), None)
+            result = await session.stream(select(*rowColumns).execution_options(yield_per=batchSize))
+            async for rows in result.partitions(batchSize):
+                # hashing and encoding of a batch runs outside of the event loop
+                await asyncio.to_thread(lambda: builder.add([ResidentRow(*row) for row in rows]))
+        arrays = await asyncio.to_thread(builder.build)
+        touched, self.touchedDuringBuild = self.touchedDuringBuild, None
+        self.arrays = arrays
+        self.overlay, self.overlayForward, self.overlayReverse = {}, {}, {}
+        self.watermark = watermark
+        residentIndexBuildSeconds.set(time.perf_counter() - start)
+        # writes of this process during the scan are read again
+        await self.refreshIds(asyncSessionMaker, touched)
+        self.exportMetrics()
+
+    def exportMetrics(self):
+        from src.Metrics import residentIndexRows, residentIndexBytes
+        if self.arrays is None:
+            return
+        residentIndexRows.labels("base").set(len(self.arrays))
+        residentIndexRows.labels("overlay").set(len(self.overlay))
+        residentIndexBytes.set(self.arrays.nbytes)
+
+    def reset(self):
+        self.arrays = None
+        self.overlay, self.overlayForward, self.overlayReverse = {}, {}, {}
+        self.watermark = None
+
+    def scheduleRebuild(self, asyncSessionMaker):
+        if (self.rebuilding is None) or self.rebuilding.done():
+            self.rebuilding = asyncio.create_task(self.build(asyncSessionMaker))
+        return self.rebuilding
+
+    async def rebuild(self, asyncSessionMaker):
+        """Rebuild with a scan started after the call, a running rebuild (which may have read older rows) is awaited first"""
+        if (self.rebuilding is not None) and not self.rebuilding.done():
+            await asyncio.gather(self.rebuilding, return_exceptions=True)
+        await self.scheduleRebuild(asyncSessionMaker)
+    #endregion
+
+    #region overlay
+    def _unlinkOverlay(self, id):
+        row = self.overlay.get(id, None)
+        if row is None:
+            return
+        forwardKey = (row.typeid_id, row.outer_id_normalized)
+        self.overlayForward.get(forwardKey, set()).discard(id)
+        self.overlayReverse.get(row.inner_id, set()).discard(id)
+
+    def apply(self, id, row: typing.Optional[ResidentRow]):
+        """row is the current state of id, None when it has been deleted"""
+        self._unlinkOverlay(id)
+        self.overlay[id] = row
+        if row is not None:
+            if row.outer_id_normalized is not None:
+                self.overlayForward.setdefault((row.typeid_id, row.outer_id_normalized), set()).add(id)
+            if row.inner_id is not None:
+                self.overlayReverse.setdefault(row.inner_id, set()).add(id)
+        if self.touchedDuringBuild is not None:
+            self.touchedDuringBuild.add(id)
+
+    async def refreshIds(self, asyncSessionMaker, ids):
+        ids = set(ids)
+        if len(ids) == 0:
+            return
+        async with asyncSessionMaker() as session:
+            rows = await fetchRows(session, ids)
+        found = {row.id: row for row in rows}
+        for id in ids:
+            self.apply(id, found.get(id, None))
+
+    def refreshAfterCommit(self, asyncSessionMaker, ids):
+        """Called after a commit of this process, lookups wait for the refresh"""
+        task = asyncio.get_running_loop().create_task(self.refreshIds(asyncSessionMaker, ids))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def pollChanges(self, asyncSessionMaker, limit=10000):
+        """Applies changes after the watermark (src.Tombstones), returns number of changes"""
+        from src.Tombstones import fetchChangesSince
+        count = 0
+        while True:
+            lastchange, id = self.watermark
+            async with asyncSessionMaker() as session:
+                changes, hasMore = await fetchChangesSince(session, lastchange, id, limit=limit)
+                rows = {row.id: row for row in await fetchRows(session, [change.id for change in changes if not change.deleted])}
+            for change in changes:
+                self.apply(change.id, None if change.deleted else rows.get(change.id, None))
+            if len(changes) > 0:
+                self.watermark = (changes[-1].lastchange, changes[-1].id)
+            count += len(changes)
+            if not hasMore:
+                break
+        if len(self.overlay) > self.overlayLimit:
+            self.scheduleRebuild(asyncSessionMaker)
+        self.exportMetrics()
+        return count
+
+    async def refreshPeriodically(self, asyncSessionMaker, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.pollChanges(asyncSessionMaker)
+            except Exception as e:
+                logging.warning(f"resident index refresh failed {e}")
+    #endregion
+
+    #region lookups
+    async def settle(self):
+        """waits for refreshes after commits of this process (read your writes)"""
+        if self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+    def internal(self, typeid_id, normalized) -> typing.Optional[ResidentRow]:
+        """Row with (typeid_id, outer_id_normalized) or None"""
+        for id in self.overlayForward.get((typeid_id, normalized), ()):
+            return self.overlay[id]
+        arrays = self.arrays
+        for index in arrays.byForward(typeid_id, normalized):
+            row = arrays.row(index)
+            if row.id not in self.overlay:
+                return row
+        return None
+
+    def external(self, inner_id) -> typing.List[ResidentRow]:
+        """Rows with inner_id"""
+        arrays = self.arrays
+        rows = [row for row in map(arrays.row, arrays.byInner(inner_id)) if row.id not in self.overlay]
+        rows.extend(self.overlay[id] for id in self.overlayReverse.get(inner_id, ()))
+        return rows
+    #endregion
+
+    def _differs(self, inner_id, stored):
+        resident = {(row.id, row.typeid_id, row.outer_id, row.outer_id_normalized) for row in self.external(inner_id)}
+        if resident != stored:
+            return True
+        return any(
+            (normalized is not None) and (self.internal(typeid_id, normalized) is None)
+            for _, typeid_id, _, normalized in stored)
+
+    async def _stored(self, asyncSessionMaker, innerIds):
+        from src.Lookups import fetchByInnerIds
+        async with asyncSessionMaker() as session:
+            rows = await fetchByInnerIds(session, innerIds)
+        stored = {inner_id: set() for inner_id in innerIds}
+        for row in rows:
+            stored[row.inner_id].add((row.id, row.typeid_id, row.outer_id, row.outer_id_normalized))
+        return stored
+
+    async def verify(self, asyncSessionMaker, sampleSize=100, recheckDelay=None):
+        """Compares external_ids and internal_id of a sample of inner ids with the database.
+        Changes of other processes reach the index after the safety window of src.Tombstones, so mismatching keys
+        are compared again after recheckDelay seconds and a poll. Returns number of keys which still differ,
+        such a difference schedules a rebuild.
+        """
+        from src.Metrics import residentIndexVerified
+        from src.Tombstones import SAFETY_SECONDS
+        arrays = self.arrays
+        if (arrays is None) or (len(arrays.reverseRows) == 0):
+            return 0
+        await self.settle()
+        sample = random.sample(range(len(arrays.reverseRows)), min(sampleSize, len(arrays.reverseRows)))
+        innerIds = list({uuid.UUID(bytes=arrays.inner[arrays.reverseRows[position]].tobytes()) for position in sample})
+        stored = await self._stored(asyncSessionMaker, innerIds)
+        suspects = [inner_id for inner_id, rows in stored.items() if self._differs(inner_id, rows)]
+        if suspects:
+            await asyncio.sleep(SAFETY_SECONDS + 1 if recheckDelay is None else recheckDelay)
+            await self.pollChanges(asyncSessionMaker)
+            await self.settle()
+            stored = await self._stored(asyncSessionMaker, suspects)
+            suspects = [inner_id for inner_id, rows in stored.items() if self._differs(inner_id, rows)]
+        mismatches = len(suspects)
+        residentIndexVerified.labels("match").inc(len(innerIds) - mismatches)
+        residentIndexVerified.labels("mismatch").inc(mismatches)
+        if mismatches > 0:
+            logging.warning(f"resident index differs from the database for {mismatches} of {len(innerIds)} sampled keys, rebuilding")
+            self.scheduleRebuild(asyncSessionMaker)
+        return mismatches
+
+    async def verifyPeriodically(self, asyncSessionMaker, interval, sampleSize=100):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.verify(asyncSessionMaker, sampleSize=sampleSize)
+            except Exception as e:
+                logging.warning(f"resident index verification failed {e}")
+
+
+residentIndex = ResidentIndex(overlayLimit=int(os.environ.get("RESIDENT_INDEX_OVERLAY_LIMIT", "100000")))
+
+
+#region commits of this process
+@event.listens_for(Session, "after_flush")
+def collectFlushedIds(session, flushContext):
+    if not residentIndex.ready:
+        return
+    ids = session.info.setdefault("residentIndexIds", set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, ExternalIdModel):
+            ids.add(instance.id)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def collectStatementIds(executeState):
+    if not (residentIndex.ready and (executeState.is_update or executeState.is_delete)):
+        return
+    mapper = executeState.bind_mapper
+    if (mapper is None) or (not issubclass(mapper.class_, ExternalIdModel)):
+        return
+    statement = select(columns.id)
+    whereclause = executeState.statement.whereclause
+    if whereclause is not None:
+        statement = statement.where(whereclause)
+    ids = executeState.session.execute(statement, executeState.parameters).scalars().all()
+    executeState.session.info.setdefault("residentIndexIds", set()).update(ids)
+
+
+@event.listens_for(Session, "after_commit")
+def refreshCommittedIds(session):
+    ids = session.info.pop("residentIndexIds", None)
+    if ids and residentIndex.ready and (residentIndexSessionMaker is not None):
+        residentIndex.refreshAfterCommit(residentIndexSessionMaker, ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def forgetAfterRollback(session):
+    session.info.pop("residentIndexIds", None)
+
+
+residentIndexSessionMaker = None
+
+
+async def startResidentIndex(asyncSessionMaker, refreshInterval=1.0, verifyInterval=300.0, verifySample=100):
+    """Builds the index and returns its background tasks (refresh and verification)"""
+    global residentIndexSessionMaker
+    residentIndexSessionMaker = asyncSessionMaker
+    await residentIndex.build(asyncSessionMaker)
+    return [
+        asyncio.create_task(residentIndex.refreshPeriodically(asyncSessionMaker, refreshInterval)),
+        asyncio.create_task(residentIndex.verifyPeriodically(asyncSessionMaker, verifyInterval, sampleSize=verifySample)),
+    ]
+#endregion
@@ -0,0 +1,123 @@
+"""Bulk id resolution without GraphQL (POST /ids/resolve).
+
+Request body (json, or msgpack with Content-Type application/msgpack)::
+
+    {"internal": [{"typeid_id": "...", "outer_id": "..."}, ...],
+     "external": [{"inner_id": "...", "typeid_id": "..." (optional)}, ...]}
+
+Response (msgpack when requested by Accept)::
+
+    {"internal": ["<inner_id>" or null, ...], "external": [[{"id", "typeid_id", "inner_id", "outer_id"}, ...], ...]}
+
+Results are aligned with the request. Keys go to the same lookups (src.Lookups) as Query.internal_id and
+Query.external_ids, so normalization, the negative lookup cache and batching apply. Authorization is the same
+as for these fields (authenticated user only), checked in main.py.
+UUIDs are accepted as strings or 16 byte binaries (msgpack), returned as strings.
+"""
+import asyncio
+import json
+import os
+import uuid
+
+from src.Responses import dumps, orjson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+MAX_RESOLVE_KEYS = int(os.environ.get("RESOLVE_MAX_KEYS", "10000"))
+
+
+class ResolveRequestError(ValueError):
+    pass
+
+
+def isMsgpack(mediaType):
+    return (mediaType is not None) and (mediaType.split(";")[0].strip().lower() in MSGPACK_TYPES)
+
+
+def acceptsMsgpack(accept):
+    return (msgpack is not None) and (accept is not None) and any(isMsgpack(item) for item in accept.split(","))
+
+
+def decodeRequest(body: bytes, contentType=None):
+    if isMsgpack(contentType):
+        if msgpack is None:
+            raise ResolveRequestError("msgpack is not supported")
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise ResolveRequestError(f"invalid msgpack body: {e}")
+    try:
+        return orjson.loads(body) if orjson is not None else json.loads(body)
+    except ValueError as e:
+        raise ResolveRequestError(f"invalid json body: {e}")
+
+
+def encodeResponse(content, msgpackRequested=False):
+    """Returns (body, media type)"""
+    if msgpackRequested:
+        return msgpack.packb(content, use_bin_type=True), MSGPACK_TYPES[0]
+    return dumps(content), "application/json"
+
+
+def toUUID(value, name):
+    try:
+        if isinstance(value, (bytes, bytearray)):
+            return uuid.UUID(bytes=bytes(value))
+        return uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        raise ResolveRequestError(f"{name} must be uuid, got {value!r}")
+
+
+def parseRequest(payload):
+    """Returns (internal keys [(typeid_id, outer_id)], external keys [(inner_id, typeid_id or None)])"""
+    if not isinstance(payload, dict):
+        raise ResolveRequestError("request must be an object")
+    internal = payload.get("internal", None) or []
+    external = payload.get("external", None) or []
+    if not isinstance(internal, list) or not isinstance(external, list):
+        raise ResolveRequestError("internal and external must be lists")
+    if len(internal) + len(external) > MAX_RESOLVE_KEYS:
+        raise ResolveRequestError(f"request has {len(internal) + len(external)} keys, limit is {MAX_RESOLVE_KEYS}")
+    internalKeys = []
+    for item in internal:
+        if not isinstance(item, dict) or not isinstance(item.get("outer_id", None), str):
+            raise ResolveRequestError(f"internal item must have typeid_id and outer_id, got {item!r}")
+        internalKeys.append((toUUID(item.get("typeid_id", None), "typeid_id"), item["outer_id"]))
+    externalKeys = []
+    for item in external:
+        if not isinstance(item, dict):
+            raise ResolveRequestError(f"external item must have inner_id, got {item!r}")
+        typeid_id = item.get("typeid_id", None)
+        externalKeys.append((
+            toUUID(item.get("inner_id", None), "inner_id"),
+            None if typeid_id is None else toUUID(typeid_id, "typeid_id")
+        ))
+    return internalKeys, externalKeys
+
+
+def externalIdDict(row):
+    return {
+        "id": f"{row.id}",
+        "typeid_id": None if row.typeid_id is None else f"{row.typeid_id}",
+        "inner_id": None if row.inner_id is None else f"{row.inner_id}",
+        "outer_id": row.outer_id,
+    }
+
+
+async def resolveIds(lookups, internalKeys, externalKeys):
+    """Same results as Query.internal_id and Query.external_ids for every key"""
+    internalRows, externalRows = await asyncio.gather(
+        lookups.internal_id.load_many(internalKeys),
+        lookups.external_ids.load_many([inner_id for inner_id, _ in externalKeys]),
+    )
+    return {
+        "internal": [None if row is None else f"{row.inner_id}" for row in internalRows],
+        "external": [
+            [externalIdDict(row) for row in rows if (typeid_id is None) or (row.typeid_id == typeid_id)]
+            for (_, typeid_id), rows in zip(externalKeys, externalRows)
+        ],
+    }
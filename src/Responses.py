@@ -0,0 +1,100 @@
+"""Serialization of /gql responses.
+
+Results are encoded to bytes by orjson (UUID, datetime natively), objects it does not know (graphql nodes in error
+details) fall back to fastapi.encoders.jsonable_encoder, so the output matches the previous responses.
+Without orjson the standard json module is used.
+
+Bodies of at least GQL_COMPRESS_MIN_SIZE bytes are compressed by brotli (if installed) or gzip, as negotiated
+by Accept-Encoding. Encoding of results with query cost (QueryCostLimiter) of at least GQL_SERIALIZE_OFFLOAD_COST
+runs in a worker thread, so a large page does not block the event loop.
+"""
+import asyncio
+import gzip
+import json
+import os
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get("GQL_COMPRESS_MIN_SIZE", "2048"))
+COMPRESS_LEVEL = int(os.environ.get("GQL_COMPRESS_LEVEL", "5"))
+SERIALIZE_OFFLOAD_COST = int(os.environ.get("GQL_SERIALIZE_OFFLOAD_COST", "1000"))
+
+
+def _fallback(value):
+    return jsonable_encoder(value)
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_fallback, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def acceptedEncodings(acceptEncoding):
+    """codings of Accept-Encoding with nonzero quality, ordered by quality"""
+    if not acceptEncoding:
+        return []
+    codings = []
+    for position, part in enumerate(acceptEncoding.split(",")):
+        coding, *parameters = [item.strip() for item in part.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            codings.append((-quality, position, coding.lower()))
+    return [coding for _, _, coding in sorted(codings)]
+
+
+def negotiateEncoding(acceptEncoding):
+    for coding in acceptedEncodings(acceptEncoding):
+        if coding == "br" and brotli is not None:
+            return "br"
+        if coding == "gzip":
+            return "gzip"
+        if coding == "*":
+            return "br" if brotli is not None else "gzip"
+    return None
+
+
+def compress(body: bytes, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESS_LEVEL)
+    return gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+
+
+def encodeBody(content, acceptEncoding=None, minSize=COMPRESS_MIN_SIZE):
+    """Returns (body, content encoding or None)"""
+    body = dumps(content)
+    encoding = negotiateEncoding(acceptEncoding) if len(body) >= minSize else None
+    if encoding is None:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+async def gqlResponse(request, content, headers=None, status_code=200, cost=0):
+    """JSON response of /gql, content is serialized (and compressed) in a thread for expensive queries"""
+    acceptEncoding = request.headers.get("accept-encoding", None)
+    if cost >= SERIALIZE_OFFLOAD_COST:
+        body, encoding = await asyncio.to_thread(encodeBody, content, acceptEncoding)
+    else:
+        body, encoding = encodeBody(content, acceptEncoding)
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code=status_code, headers=headers, media_type="application/json")
@@ -0,0 +1,89 @@
+"""Routing of DB sessions between primary and read replicas.
+
+SessionRouter has the same interface as the SessionMaker (it is a callable returning AsyncSession),
+therefore it can be passed to loaders instead of the SessionMaker.
+A router is created per request. Until the request writes (mutation or encapsulateInsert/Update/Delete),
+sessions are taken from a healthy replica, afterwards all sessions are taken from the primary (read your writes).
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+from sqlalchemy import text
+
+lagStatement = text("SELECT EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))")
+
+
+class ReplicaLagMonitor:
+    """Watches replication lag of a single replica.
+    When maxLag is None, the replica is considered always healthy and no query is made.
+    """
+    def __init__(self, sessionMaker, maxLag=None, checkInterval=5.0):
+        self.sessionMaker = sessionMaker
+        self.maxLag = maxLag
+        self.checkInterval = checkInterval
+        self.lag = None
+        self.checked = None
+
+    @property
+    def healthy(self):
+        if self.maxLag is None:
+            return True
+        return (self.lag is not None) and (self.lag <= self.maxLag)
+
+    async def refresh(self):
+        if self.maxLag is None:
+            return
+        now = time.monotonic()
+        if (self.checked is not None) and (now - self.checked < self.checkInterval):
+            return
+        # set before await, concurrent requests do not stampede
+        self.checked = now
+        try:
+            async with self.sessionMaker() as session:
+                rows = await session.execute(lagStatement)
+                lag = rows.scalar()
+            # NULL means nothing has been replayed yet (or server is not a standby)
+            self.lag = 0.0 if lag is None else float(lag)
+        except Exception as e:
+            logging.warning(f"replica lag check failed {e}")
+            self.lag = None
+
+
+class ReplicaSet:
+    """Set of replica SessionMakers, picks healthy ones round robin"""
+    def __init__(self, sessionMakers=[], maxLag=None, checkInterval=5.0):
+        self.replicas = [ReplicaLagMonitor(sessionMaker, maxLag, checkInterval) for sessionMaker in sessionMakers]
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    async def refresh(self):
+        await asyncio.gather(*(replica.refresh() for replica in self.replicas))
+
+    def pick(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if len(healthy) == 0:
+            return None
+        return healthy[next(self._counter) % len(healthy)].sessionMaker
+
+
+class SessionRouter:
+    def __init__(self, primarySessionMaker, replicaSet=None):
+        self.primarySessionMaker = primarySessionMaker
+        self.replicaSet = replicaSet
+        self.written = False
+
+    def markWritten(self):
+        """All following sessions of the request go to the primary"""
+        self.written = True
+
+    def __call__(self):
+        if self.written or (self.replicaSet is None):
+            return self.primarySessionMaker()
+        replicaSessionMaker = self.replicaSet.pick()
+        if replicaSessionMaker is None:
+            return self.primarySessionMaker()
+        return replicaSessionMaker()
@@ -0,0 +1,153 @@
+"""Incremental synchronization of externalids.
+
+Deleted rows leave a tombstone (externalidtombstones) written in the same transaction as the delete. Both
+ORM deletes (flush) and delete statements (loader.delete) are covered.
+Changes are read in keyset order of (lastchange, id) for rows and (deleted, id) for tombstones. Both streams are merged,
+so a consumer keeps a single watermark and continues after it.
+
+lastchange is set by the database, by the server default on insert and by lastchangeFromDatabase on update (uoishelpers
+loaders set it from the application clock, which differs between workers). now() is the start of the transaction,
+so a transaction which commits later may write an older lastchange. Rows younger than CHANGED_SINCE_SAFETY_SECONDS are therefore not returned yet,
+the watermark never passes them. Rows without lastchange (imported before it was set) are filled by fillMissingLastchange.
+"""
+import datetime
+import os
+import typing
+import uuid
+
+from sqlalchemy import event, select, insert, update, delete, tuple_, func, literal, DateTime, Uuid
+from sqlalchemy.orm import Session
+
+from src.DBDefinitions import ExternalIdModel, ExternalIdTypeModel, ExternalIdCategoryModel, ExternalIdTombstoneModel
+
+externalIdsTable = ExternalIdModel.__table__
+tombstonesTable = ExternalIdTombstoneModel.__table__
+
+SAFETY_SECONDS = float(os.environ.get("CHANGED_SINCE_SAFETY_SECONDS", "5"))
+
+lastchangeModels = (ExternalIdModel, ExternalIdTypeModel, ExternalIdCategoryModel)
+
+
+@event.listens_for(Session, "before_flush")
+def lastchangeFromDatabase(session, flushContext, instances):
+    """updated rows get lastchange from the database clock, the models read it back by RETURNING (eager_defaults)"""
+    for instance in session.dirty:
+        if isinstance(instance, lastchangeModels) and session.is_modified(instance):
+            instance.lastchange = func.now()
+
+
+def _storeTombstones(connection, rows):
+    if len(rows) == 0:
+        return
+    ids = [row["id"] for row in rows]
+    # the same id may have been deleted before (and inserted again)
+    connection.execute(delete(tombstonesTable).where(tombstonesTable.c.id.in_(ids)))
+    connection.execute(insert(tombstonesTable), rows)
+
+
+@event.listens_for(Session, "after_flush")
+def tombstonesFromFlush(session, flushContext):
+    rows = [
+        {"id": instance.id, "typeid_id": instance.typeid_id, "inner_id": instance.inner_id, "outer_id": instance.outer_id}
+        for instance in session.deleted if isinstance(instance, ExternalIdModel)
+    ]
+    _storeTombstones(session.connection(), rows)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def tombstonesFromDeleteStatement(executeState):
+    if not executeState.is_delete:
+        return
+    mapper = executeState.bind_mapper
+    if (mapper is None) or (not issubclass(mapper.class_, ExternalIdModel)):
+        return
+    columns = externalIdsTable.c
+    statement = select(columns.id, columns.typeid_id, columns.inner_id, columns.outer_id)
+    whereclause = executeState.statement.whereclause
+    if whereclause is not None:
+        statement = statement.where(whereclause)
+    rows = executeState.session.execute(statement, executeState.parameters).mappings().all()
+    _storeTombstones(executeState.session.connection(), [dict(row) for row in rows])
+
+
+class Change(typing.NamedTuple):
+    id: uuid.UUID
+    lastchange: datetime.datetime
+    deleted: bool
+    typeid_id: typing.Optional[uuid.UUID]
+    inner_id: typing.Optional[uuid.UUID]
+    outer_id: typing.Optional[str]
+    # None for tombstones
+    outer_id_normalized: typing.Optional[str] = None
+
+
+def _changeKey(dialect, column):
+    """sqlite stores datetimes as text in varying formats (server default without fraction, python values with it),
+    the key is compared as a canonical datetime() text there
+    """
+    if dialect.name == "sqlite":
+        return func.datetime(column, type_=DateTime)
+    return column
+
+
+async def fetchChangesSince(session, lastchange=None, id=None, limit=1000, safetySeconds=None):
+    """Returns (changes, hasMore), changes are ordered by (lastchange, id) and are strictly after the watermark.
+    Without a watermark all rows (and tombstones) are returned.
+    """
+    if safetySeconds is None:
+        safetySeconds = SAFETY_SECONDS
+    safety = datetime.timedelta(seconds=safetySeconds)
+    dialect = session.bind.dialect
+    if dialect.name == "postgresql":
+        # compared in the database, lastchange is a timestamp in the session time zone
+        until = func.now() - safety
+    else:
+        until = (await session.execute(select(func.now()))).scalar() - safety
+
+    columns = externalIdsTable.c
+    rowsKey = _changeKey(dialect, columns.lastchange)
+    rowsStatement = (
+        select(columns.id, rowsKey.label("lastchange"), columns.typeid_id, columns.inner_id, columns.outer_id, columns.outer_id_normalized)
+        .where(rowsKey < _changeKey(dialect, until))
+        .order_by(rowsKey, columns.id).limit(limit + 1)
+    )
+    tombstones = tombstonesTable.c
+    tombstonesKey = _changeKey(dialect, tombstones.deleted)
+    tombstonesStatement = (
+        select(tombstones.id, tombstonesKey.label("deleted"), tombstones.typeid_id, tombstones.inner_id, tombstones.outer_id)
+        .where(tombstonesKey < _changeKey(dialect, until))
+        .order_by(tombstonesKey, tombstones.id).limit(limit + 1)
+    )
+    if lastchange is not None:
+        watermarkKey = _changeKey(dialect, literal(lastchange, DateTime))
+        watermarkId = literal(id if id is not None else uuid.UUID(int=0), Uuid)
+        watermark = tuple_(watermarkKey, watermarkId)
+        rowsStatement = rowsStatement.where(tuple_(rowsKey, columns.id) > watermark)
+        tombstonesStatement = tombstonesStatement.where(tuple_(tombstonesKey, tombstones.id) > watermark)
+
+    changes = [Change(row.id, row.lastchange, False, row.typeid_id, row.inner_id, row.outer_id, row.outer_id_normalized)
+        for row in (await session.execute(rowsStatement))]
+    changes.extend(Change(row.id, row.deleted, True, row.typeid_id, row.inner_id, row.outer_id)
+        for row in (await session.execute(tombstonesStatement)))
+    changes.sort(key=lambda change: (change.lastchange, change.id.hex))
+    return changes[:limit], len(changes) > limit
+
+
+async def fillMissingLastchange(asyncSessionMaker):
+    """Rows with lastchange NULL are never returned by fetchChangesSince, they get created (or now). Returns number of rows."""
+    columns = externalIdsTable.c
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            result = await session.execute(
+                update(externalIdsTable)
+                .where(columns.lastchange.is_(None))
+                .values(lastchange=func.coalesce(columns.created, func.now()))
+            )
+    return result.rowcount
+
+
+async def pruneTombstones(asyncSessionMaker, retention: datetime.timedelta):
+    limit = datetime.datetime.now() - retention
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            await session.execute(delete(tombstonesTable).where(tombstonesTable.c.deleted < limit))
@@ -0,0 +1,183 @@
+"""End-to-end load harness, drives main.app in-process through httpx.ASGITransport.
+
+Run as
+    python -m tests.benchmarks.bench_asgi --rows 10000 --concurrency 32 --duration 20
+    python -m tests.benchmarks.bench_asgi --mix internal_id=6,external_ids=3,external_ids_page=1 --output asgi.json
+
+The whole request path is measured: FastAPI routing, prometheus middleware, apollo_gql,
+the sentinel (JWT verification) and get_context. The JWT issuer is stubbed: an RSA key pair is generated,
+its public key is handed to the sentinel and every request carries a token signed by it.
+`--concurrency` workers replay the operation mix for `--duration` seconds, throughput,
+latency percentiles (overall and per operation) and event loop lag are reported.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import time
+import uuid
+
+# main.py requires these to be defined explicitly
+os.environ.setdefault("DEMO", "False")
+os.environ.setdefault("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+os.environ.setdefault("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+
+import httpx
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from tests.benchmarks.bench_suite import queries, sampleRows, summarize
+
+defaultMix = "internal_id=5,internal_id_miss=2,external_ids=3,external_ids_page=1,entities_user=1,externalid_insert=1"
+
+
+def createStubIssuer(user_id):
+    """returns (public key for the sentinel, Authorization header value)"""
+    privateKey = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    publicKey = privateKey.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    token = jwt.encode({"user_id": user_id}, privateKey, algorithm="RS256")
+    return publicKey, f"Bearer {token}"
+
+
+def parseMix(mix):
+    """parses "name=weight,..." (type of --mix), errors are reported by argparse"""
+    result = {}
+    for item in mix.split(","):
+        name, separator, weight = item.partition("=")
+        name = name.strip()
+        if not separator:
+            raise argparse.ArgumentTypeError(f"expected name=weight, found '{item}'")
+        if name not in queries:
+            raise argparse.ArgumentTypeError(f"unknown operation '{name}', known are {list(queries.keys())}")
+        try:
+            result[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"weight of {name} must be a number, found '{weight.strip()}'") from None
+        if not (0 <= result[name] < float("inf")):
+            raise argparse.ArgumentTypeError(f"weight of {name} must be a non negative number, found '{weight.strip()}'")
+    if sum(result.values()) <= 0:
+        raise argparse.ArgumentTypeError("at least one weight must be positive")
+    return result
+
+
+async def monitorLoopLag(lags, interval=0.01):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def run(dsn, rows, concurrency, duration, mix, pageLimit, seed):
+    import main
+    from src.DBFeeder import feedRandomExternalIds
+
+    main.connectionString = dsn
+    user_id = "2d9dc5ca-a4a2-11ed-b9df-0242ac120003"
+    publicKey, authorization = createStubIssuer(user_id)
+    main.sentinel.publickey = publicKey
+
+    async with main.lifespan(main.app):
+        asyncSessionMaker = await main.RunOnceAndReturnSessionMaker()
+        await feedRandomExternalIds(asyncSessionMaker, rows, seed=seed)
+        count, sample = await sampleRows(asyncSessionMaker, 1000, seed)
+
+        rng = random.Random(seed)
+        names = list(mix.keys())
+        weights = list(mix.values())
+        pick = lambda: sample[rng.randrange(len(sample))]
+        variablesFactories = {
+            "internal_id": lambda: (lambda row: {"typeid_id": f"{row.typeid_id}", "outer_id": row.outer_id})(pick()),
+            "internal_id_miss": lambda: {"typeid_id": f"{pick().typeid_id}", "outer_id": f"missing-{rng.random()}"},
+            "external_ids": lambda: {"inner_id": f"{pick().inner_id}"},
+            "external_ids_page": lambda: {"skip": rng.randrange(max(1, count - pageLimit)), "limit": pageLimit},
+            "entities_externalid": lambda: {"representations": [
+                {"__typename": "ExternalIdGQLModel", "id": f"{pick().id}"} for _ in range(50)]},
+            "entities_user": lambda: {"representations": [
+                {"__typename": "UserGQLModel", "id": f"{pick().inner_id}"} for _ in range(50)]},
+            "externalid_insert": lambda: {
+                "inner_id": f"{uuid.uuid4()}", "typeid_id": f"{pick().typeid_id}", "outer_id": f"load-{uuid.uuid4()}"},
+            "externalid_delete": lambda: {"id": f"{uuid.uuid4()}"},
+        }
+
+        latencies = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+        headers = {"Authorization": authorization}
+        transport = httpx.ASGITransport(app=main.app)
+
+        async def worker(client, deadline):
+            while time.perf_counter() < deadline:
+                [name] = rng.choices(names, weights=weights)
+                payload = {"query": queries[name], "variables": variablesFactories[name]()}
+                start = time.perf_counter()
+                response = await client.post("/gql", json=payload, headers=headers)
+                latencies[name].append(time.perf_counter() - start)
+                if (response.status_code != 200) or response.json().get("errors"):
+                    errors[name] += 1
+
+        lags = []
+        lagMonitor = asyncio.create_task(monitorLoopLag(lags))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            start = time.perf_counter()
+            deadline = start + duration
+            await asyncio.gather(*(worker(client, deadline) for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+        lagMonitor.cancel()
+
+    allLatencies = [latency for values in latencies.values() for latency in values]
+    overall = summarize(allLatencies)
+    overall["throughput_rps"] = len(allLatencies) / elapsed
+    overall["errors"] = sum(errors.values())
+    orderedLags = sorted(lags) or [0.0]
+    return {
+        "meta": {"dsn": dsn.split("@")[-1], "rows": count, "concurrency": concurrency, "duration_s": elapsed, "mix": mix},
+        "overall": overall,
+        "operations": {
+            name: {**summarize(values), "errors": errors[name]} for name, values in latencies.items() if len(values) > 0
+        },
+        "loop_lag": {
+            "mean_ms": statistics.fmean(orderedLags) * 1000,
+            "p99_ms": orderedLags[min(len(orderedLags) - 1, int(0.99 * len(orderedLags)))] * 1000,
+            "max_ms": orderedLags[-1] * 1000,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default="sqlite+aiosqlite:///:memory:")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--mix", type=parseMix, default=defaultMix)
+    parser.add_argument("--page-limit", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep stdout of the app (sentinel prints a lot)")
+    parser.add_argument("--output", default=None, help="JSON file with results")
+    args = parser.parse_args()
+
+    import logging
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    stdout = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with stdout:
+        result = asyncio.run(run(
+            args.dsn, args.rows, args.concurrency, args.duration, args.mix, args.page_limit, args.seed))
+
+    print(f"{'overall':>22}: " + " ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in result["overall"].items()))
+    for name, stats in result["operations"].items():
+        print(f"{name:>22}: " + " ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in stats.items()))
+    print(f"{'loop lag':>22}: " + " ".join(f"{key}={value:.3f}" for key, value in result["loop_lag"].items()))
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measures per-row overhead of field authorization on a large page.
+
+Run as
+    python -m tests.benchmarks.bench_permissions --rows 1000 --repeat 5
+
+The same page is queried twice, once with `id` only and once with the fields
+guarded by `OnlyForAuthentized` (lastchange, created, createdBy, changedBy).
+The difference divided by the number of rows is the per-row cost of those fields
+including their authorization.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from src.DBDefinitions import ExternalIdModel
+from src.GraphTypeDefinitions import schema
+from tests.shared import prepare_in_memory_sqllite, prepare_demodata, get_demodata, createContext
+
+plainQuery = "query($limit: Int!){ externalIdsPage(limit: $limit) { id } }"
+guardedQuery = """query($limit: Int!){ externalIdsPage(limit: $limit) {
+    id lastchange created createdBy { id } changedBy { id }
+} }"""
+
+
+async def insertRows(asyncSessionMaker, count):
+    typeid_id = get_demodata()["externalidtypes"][0]["id"]
+    user_id = uuid.uuid4()
+    rows = [
+        ExternalIdModel(
+            id=uuid.uuid4(), inner_id=uuid.uuid4(), outer_id=f"{index}", typeid_id=typeid_id,
+            createdby=user_id, changedby=user_id)
+        for index in range(count)
+    ]
+    async with asyncSessionMaker() as session:
+        async with session.begin():
+            session.add_all(rows)
+
+
+async def timeQuery(asyncSessionMaker, query, limit, repeat):
+    durations = []
+    for _ in range(repeat):
+        context_value = await createContext(asyncSessionMaker)
+        start = time.perf_counter()
+        resp = await schema.execute(query, context_value=context_value, variable_values={"limit": limit})
+        durations.append(time.perf_counter() - start)
+        assert resp.errors is None, resp.errors
+        assert len(resp.data["externalIdsPage"]) >= limit
+    return min(durations)
+
+
+async def run(rows, repeat):
+    asyncSessionMaker = await prepare_in_memory_sqllite()
+    await prepare_demodata(asyncSessionMaker)
+    await insertRows(asyncSessionMaker, rows)
+
+    plain = await timeQuery(asyncSessionMaker, plainQuery, rows, repeat)
+    guarded = await timeQuery(asyncSessionMaker, guardedQuery, rows, repeat)
+    result = {
+        "rows": rows,
+        "plain_s": plain,
+        "guarded_s": guarded,
+        "per_row_overhead_us": (guarded - plain) / rows * 1e6,
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    result = asyncio.run(run(args.rows, args.repeat))
+    for key, value in result.items():
+        print(f"{key:>22}: {value:.6f}" if isinstance(value, float) else f"{key:>22}: {value}")
+
+
+if __name__ == "__main__":
+    main()
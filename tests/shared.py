@@ -27,6 +27,18 @@ async def prepare_in_memory_sqllite():
     return async_session_maker
 
 
+import os
+
+# tests of postgres only features run against TEST_POSTGRES_URL (postgresql+asyncpg://...), its tables are dropped
+TEST_POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL", None)
+requires_postgres = pytest.mark.skipif(TEST_POSTGRES_URL is None, reason="TEST_POSTGRES_URL is not set")
+
+
+async def prepare_postgres():
+    from src.DBDefinitions import startEngine
+    return await startEngine(TEST_POSTGRES_URL, makeDrop=True, makeUp=True)
+
+
 from src.DBFeeder import get_demodata
 
 
@@ -45,6 +57,12 @@ async def prepare_demodata(async_session_maker):
         data,
     )
 
+    from src.Normalization import normalizeOuterIds, typeNormalizers
+    # rules are cached per process, each test has its own database
+    typeNormalizers.invalidate()
+    await typeNormalizers.reload(async_session_maker)
+    await normalizeOuterIds(async_session_maker)
+
 
 from src.Dataloaders import createLoadersContext
 
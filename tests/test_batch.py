@@ -0,0 +1,136 @@
+import dataclasses
+import pytest
+import sqlalchemy
+
+from src.Batch import checkBatch, executeBatch, BatchRejected, MAX_BATCH_SIZE
+from src.GraphTypeDefinitions import schema
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+@dataclasses.dataclass
+class Item:
+    """same attributes as main.Item"""
+    query: str
+    variables: dict = dataclasses.field(default_factory=dict)
+    operationName: str = None
+
+
+def test_check_batch():
+    query = Item(query="{ externalidtypePage { id } }")
+    mutation = Item(query='mutation { externalidDelete(id: "d5d5286d-50d2-4b07-97de-7407c62c21c0") { msg } }')
+    assert checkBatch(schema._schema, [query, query]) is False
+    assert checkBatch(schema._schema, [query, mutation]) is True
+    with pytest.raises(BatchRejected):
+        checkBatch(schema._schema, [])
+    with pytest.raises(BatchRejected):
+        checkBatch(schema._schema, [query] * (MAX_BATCH_SIZE + 1))
+    expensive = Item(query="{ externalIdsPage(limit: 10000) { id type { id category { id } } } }")
+    with pytest.raises(BatchRejected):
+        checkBatch(schema._schema, [expensive] * 5)
+
+
+@pytest.mark.asyncio
+async def test_batch_shares_loaders():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    type_id = f"{get_demodata()['externalidtypes'][0]['id']}"
+    items = [
+        Item(query="query($id: UUID!) { externalidtypeById(id: $id) { id name } }", variables={"id": type_id})
+        for _ in range(5)
+    ]
+
+    statements = []
+    engine = async_session_maker.kw["bind"].sync_engine
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    sqlalchemy.event.listen(engine, "before_cursor_execute", listener)
+    try:
+        context_value = await createContext(async_session_maker)
+
+        async def execute(item):
+            return await schema.execute(item.query, variable_values=item.variables, context_value=context_value)
+
+        results = await executeBatch(execute, items)
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", listener)
+
+    assert [result.errors for result in results] == [None] * len(items)
+    assert [result.data["externalidtypeById"]["id"] for result in results] == [type_id] * len(items)
+    # one load for all operations
+    assert len([statement for statement in statements if "FROM externalidtypes" in statement]) == 1
+
+
+@pytest.mark.asyncio
+async def test_execute_item_reports_exception(monkeypatch):
+    monkeypatch.setenv("DEMO", "True")
+    monkeypatch.setenv("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+    monkeypatch.setenv("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+    import main
+
+    async def execute(*args, **kwargs):
+        raise ValueError("broken operation")
+    monkeypatch.setattr(main.schema, "execute", execute)
+
+    schemaresult, failure = await main.executeItem({}, Item(query="{ __typename }"))
+    assert schemaresult is None
+    assert failure == {"data": None, "errors": [{"ValueError": "broken operation"}]}
+
+
+def postRequest():
+    from starlette.requests import Request
+    return Request({"type": "http", "method": "POST", "path": "/gql", "headers": []})
+
+
+@pytest.mark.asyncio
+async def test_batch_context_failure_aligned(monkeypatch):
+    import json
+    monkeypatch.setenv("DEMO", "False")
+    monkeypatch.setenv("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+    monkeypatch.setenv("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+    import main
+
+    checks = []
+
+    async def sentinel(request, item):
+        checks.append(item.query)
+        return None
+    monkeypatch.setattr(main, "sentinel", sentinel)
+
+    async def get_context(request):
+        raise RuntimeError("database unavailable")
+    monkeypatch.setattr(main, "get_context", get_context)
+
+    items = [main.Item(query="{ __typename }") for _ in range(3)]
+    response = await main.apollo_gql(postRequest(), items)
+    failure = {"data": None, "errors": [{"RuntimeError": "database unavailable"}]}
+    assert json.loads(response.body) == [failure] * 3
+    # one authentication for the whole batch
+    assert checks == ["{ __typename }"]
+
+    # a single operation gets the same error from the shared helper
+    async def referenceETag(request, item):
+        return None
+    monkeypatch.setattr(main, "referenceETag", referenceETag)
+    assert await main.apollo_gql(postRequest(), main.Item(query="{ __typename }")) == failure
+
+
+@pytest.mark.asyncio
+async def test_batch_authorized_by_protected_operation(monkeypatch):
+    monkeypatch.setenv("DEMO", "False")
+    monkeypatch.setenv("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+    monkeypatch.setenv("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+    import main
+
+    rejected = main.JSONResponse({"data": None, "errors": ["Unauthenticated"]}, status_code=401)
+
+    async def sentinel(request, item):
+        return None if item.query in main.queriesWOAuthentization else rejected
+    monkeypatch.setattr(main, "sentinel", sentinel)
+
+    items = [main.Item(query=main.apolloQuery), main.Item(query="{ __typename }")]
+    assert await main.apollo_gql(postRequest(), items) is rejected
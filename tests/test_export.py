@@ -0,0 +1,98 @@
+import asyncio
+import io
+import uuid
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+import pytest
+
+from src.DBFeeder import feedRandomExternalIds
+from src.Export import exportSnapshot, streamSnapshot, prefetched
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    prepare_postgres,
+    requires_postgres,
+    get_demodata,
+)
+
+
+@pytest.mark.asyncio
+async def test_export_snapshot():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    await feedRandomExternalIds(async_session_maker, 2500)
+    total = len(get_demodata()['externalids']) + 2500
+
+    sink = io.BytesIO()
+    assert await exportSnapshot(async_session_maker, sink, format="parquet", batchSize=1000) == total
+    table = pyarrow.parquet.read_table(io.BytesIO(sink.getvalue()))
+    assert table.num_rows == total
+    # every batch is a row group
+    assert pyarrow.parquet.ParquetFile(io.BytesIO(sink.getvalue())).num_row_groups == 3
+    assert table.schema.field("id").type == pyarrow.binary(16)
+
+    row = get_demodata()['externalids'][0]
+    exported = {uuid.UUID(bytes=item["id"]): item for item in table.to_pylist()}
+    item = exported[uuid.UUID(f"{row['id']}")]
+    assert uuid.UUID(bytes=item["inner_id"]) == uuid.UUID(f"{row['inner_id']}")
+    assert item["outer_id"] == row['outer_id']
+    assert item["type_name"] is not None
+
+    chunks = [chunk async for chunk in streamSnapshot(async_session_maker, format="arrow", batchSize=1000)]
+    assert len(chunks) >= 3
+    streamed = pyarrow.ipc.open_stream(b"".join(chunks)).read_all()
+    assert streamed.num_rows == total
+    assert sorted(streamed.column("id").to_pylist()) == sorted(table.column("id").to_pylist())
+
+    with pytest.raises(ValueError):
+        await exportSnapshot(async_session_maker, io.BytesIO(), format="csv")
+
+
+@pytest.mark.asyncio
+async def test_prefetched_reads_ahead():
+    events = []
+
+    async def batches():
+        for index in range(3):
+            events.append(f"read {index}")
+            yield index
+
+    async for index in prefetched(batches()):
+        await asyncio.sleep(0.01)
+        events.append(f"write {index}")
+    assert events.index("read 1") < events.index("write 0")
+    assert events[-1] == "write 2"
+
+    async def failing():
+        yield 0
+        raise ValueError("read failed")
+
+    with pytest.raises(ValueError):
+        async for _ in prefetched(failing()):
+            pass
+
+
+@requires_postgres
+@pytest.mark.asyncio
+async def test_export_snapshot_postgres():
+    async_session_maker = await prepare_postgres()
+    await prepare_demodata(async_session_maker)
+    await feedRandomExternalIds(async_session_maker, 2500)
+    total = len(get_demodata()['externalids']) + 2500
+
+    sink = io.BytesIO()
+    assert await exportSnapshot(async_session_maker, sink, format="arrow", batchSize=1000) == total
+    table = pyarrow.ipc.open_stream(sink.getvalue()).read_all()
+    assert table.num_rows == total
+
+    row = get_demodata()['externalids'][0]
+    exported = {uuid.UUID(bytes=item["id"]): item for item in table.to_pylist()}
+    item = exported[uuid.UUID(f"{row['id']}")]
+    assert uuid.UUID(bytes=item["inner_id"]) == uuid.UUID(f"{row['inner_id']}")
+    assert uuid.UUID(bytes=item["typeid_id"]) == uuid.UUID(f"{row['typeid_id']}")
+    assert item["outer_id"] == row['outer_id']
+    assert item["type_name"] is not None
+    assert item["lastchange"] is not None
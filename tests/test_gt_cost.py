@@ -0,0 +1,77 @@
+import pytest
+
+from src.GraphTypeDefinitions import schema
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    createContext,
+)
+
+
+@pytest.mark.asyncio
+async def test_cost_reported():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    query = '''query($limit: Int!){ externalIdsPage(limit: $limit) { id type { id category { id } } } }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values={"limit": 100})
+    assert resp.errors is None
+    # 100 * (page item + type + category)
+    assert resp.extensions["cost"] == {"cost": 400, "depth": 4, "aliases": 0}
+
+
+@pytest.mark.asyncio
+async def test_alias_amplification_rejected():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    selections = " ".join(f"a{index}: externalIdsPage(limit: 1000) {{ id type {{ category {{ id }} }} }}" for index in range(200))
+    query = "query {" + selections + "}"
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value)
+    assert resp.data is None
+    messages = [error.message for error in resp.errors]
+    assert any("aliases" in message for message in messages), messages
+    assert any("cost" in message for message in messages), messages
+    # nothing has been resolved, no statement was issued
+    assert "__authorized" not in context_value
+
+
+@pytest.mark.asyncio
+async def test_introspection_query_allowed(monkeypatch):
+    monkeypatch.setenv("DEMO", "True")
+    monkeypatch.setenv("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+    monkeypatch.setenv("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+    import main
+    async_session_maker = await prepare_in_memory_sqllite()
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(main.graphiQLQuery, context_value=context_value)
+    assert resp.errors is None
+    assert resp.extensions["cost"] == {"cost": 0, "depth": 13, "aliases": 0}
+
+
+@pytest.mark.asyncio
+async def test_aliased_introspection_rejected():
+    async_session_maker = await prepare_in_memory_sqllite()
+    selections = " ".join(f"a{index}: __schema {{ types {{ name fields {{ name }} }} }}" for index in range(300))
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute("query {" + selections + "}", context_value=context_value)
+    assert resp.data is None
+    assert [error.extensions["aliases"] for error in resp.errors] == [300]
+    assert any("aliases" in error.message for error in resp.errors)
+
+
+@pytest.mark.asyncio
+async def test_deep_introspection_rejected():
+    async_session_maker = await prepare_in_memory_sqllite()
+    nested = "name"
+    for _ in range(10):
+        nested = f"ofType {{ {nested} }}"
+    query = "query { __schema { types { fields { type { " + nested + " } } } } }"
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value)
+    assert resp.data is None
+    assert [error.extensions["depth"] for error in resp.errors] == [15]
+    assert any("introspection depth" in error.message for error in resp.errors)
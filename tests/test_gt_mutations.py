@@ -62,7 +62,46 @@ async def test_externalid_mutation():
     respdata = resp.data["result"]
     assert respdata is not None
     assert respdata["msg"] == "fail", f"something bad {resp}"
-    
+
+
+@pytest.mark.asyncio
+async def test_externaltypeid_update_lastchange_from_database(monkeypatch):
+    import datetime
+    import sqlalchemy
+    import uoishelpers.dataloaders
+    from src.DBDefinitions import ExternalIdTypeModel
+
+    class ApplicationClock(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime(2000, 1, 1)
+    monkeypatch.setattr(uoishelpers.dataloaders.datetime, "datetime", ApplicationClock)
+
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    row = get_demodata()["externalidtypes"][0]
+    async with async_session_maker() as session:
+        lastchange = (await session.execute(
+            sqlalchemy.select(ExternalIdTypeModel.lastchange).where(ExternalIdTypeModel.id == row["id"]))).scalar()
+
+    query = '''mutation($id: UUID! $lastchange: DateTime!) {
+        result: externaltypeidUpdate(externaltypeid: {id: $id lastchange: $lastchange name: "updated"}) {
+            msg externaltypeid { lastchange }
+        }
+    }'''
+    context_value = await createContext(async_session_maker)
+    variable_values = {"id": f"{row['id']}", "lastchange": lastchange.isoformat()}
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+    assert resp.errors is None, f"got errors {resp.errors}"
+    assert resp.data["result"]["msg"] == "ok"
+    updated = datetime.datetime.fromisoformat(resp.data["result"]["externaltypeid"]["lastchange"])
+    assert updated.year > 2000
+
+    async with async_session_maker() as session:
+        stored = (await session.execute(
+            sqlalchemy.select(ExternalIdTypeModel.lastchange).where(ExternalIdTypeModel.id == row["id"]))).scalar()
+    assert stored == updated
+
 # @pytest.mark.asyncio
 # async def test_externalid_delete():
 #     async_session_maker = await prepare_in_memory_sqllite()
@@ -0,0 +1,29 @@
+import pytest
+
+from src.GraphTypeDefinitions import schema
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    createContext,
+)
+
+
+@pytest.mark.asyncio
+async def test_authorization_is_memoized():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    query = '''query { externalidtypePage { id name nameEn lastchange created createdBy { id } } }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value)
+    assert resp.errors is None, resp.errors
+    assert len(resp.data["externalidtypePage"]) > 0
+
+    assert context_value["__authorized"] is True
+    user = context_value["__user"]
+    assert f"{user['id']}" == context_value["user"]["id"]
+
+    resp = await schema.execute(query, context_value=context_value)
+    assert resp.errors is None, resp.errors
+    assert context_value["__user"] is user
@@ -0,0 +1,288 @@
+import pytest
+
+from src.GraphTypeDefinitions import schema
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+@pytest.mark.asyncio
+async def test_internal_ids_batched():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    row = get_demodata()['externalids'][0]
+    query = '''query($id: String! $type_id: UUID!){
+        a: internalId(outerId: $id typeidId: $type_id)
+        b: internalId(outerId: "unknown" typeidId: $type_id)
+        c: internalId(outerId: $id typeidId: $type_id)
+    }'''
+    variable_values = {"id": f"{row['outer_id']}", "type_id": f"{row['typeid_id']}"}
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+
+    assert resp.errors is None
+    assert resp.data == {"a": f"{row['inner_id']}", "b": None, "c": f"{row['inner_id']}"}
+
+
+@pytest.mark.asyncio
+async def test_representation_user_external_ids():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    row = get_demodata()['externalids'][0]
+    query = '''query($id: UUID!) {
+        _entities(representations: [{ __typename: "UserGQLModel", id: $id }]) {
+            ...on UserGQLModel { id externalIds { innerId outerId typeName } }
+        }
+    }'''
+    variable_values = {"id": f"{row['inner_id']}"}
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+
+    assert resp.errors is None
+    externalIds = resp.data['_entities'][0]['externalIds']
+    assert externalIds[0]['innerId'] == f"{row['inner_id']}"
+    assert externalIds[0]['outerId'] == f"{row['outer_id']}"
+
+
+@pytest.mark.asyncio
+async def test_representation_user_string_id():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    row = get_demodata()['externalids'][0]
+    query = '''query($representations: [_Any!]!) {
+        _entities(representations: $representations) {
+            ...on UserGQLModel { id externalIds { outerId } }
+        }
+    }'''
+    variable_values = {"representations": [{"__typename": "UserGQLModel", "id": f"{row['inner_id']}"}]}
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+
+    assert resp.errors is None, resp.errors
+    assert resp.data['_entities'][0]['externalIds'][0]['outerId'] == f"{row['outer_id']}"
+
+
+@pytest.mark.asyncio
+async def test_search_external_ids():
+    from src.DBFeeder import feedRandomExternalIds
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    await feedRandomExternalIds(async_session_maker, 200)
+
+    query = '''query($text: String! $type_id: UUID) {
+        searchExternalIds(text: $text typeidId: $type_id limit: 3) { outerId type { id } }
+    }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values={"text": "00000001"})
+    assert resp.errors is None
+    found = resp.data['searchExternalIds']
+    assert len(found) == 3
+    assert all("00000001" in item['outerId'] for item in found)
+
+    # typo, nothing contains the text, trigram similarity still finds it
+    row = get_demodata()['externalids'][0]
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value,
+        variable_values={"text": row["outer_id"] + "7", "type_id": f"{row['typeid_id']}"})
+    assert resp.errors is None
+    assert resp.data['searchExternalIds'][0]['outerId'] == row['outer_id']
+    assert resp.data["searchExternalIds"][0]["type"]["id"] == f"{row['typeid_id']}"
+
+    # a short text is not searched as a substring (the trigram index can not be used for it)
+    from src.Lookups import searchByOuterId
+    async with async_session_maker() as session:
+        assert await searchByOuterId(session, "1", limit=3) == []
+
+
+def test_similarity_matches_pg_trgm():
+    from src.Lookups import trigrams, similarity
+    assert trigrams("cat") == {"  c", " ca", "cat", "at "}
+    assert similarity("0000-0002-1825-0097", "0000-0002-1825-0097") == 1.0
+    assert similarity("abc", "xyz") == 0.0
+
+
+def test_compile_normalization():
+    import json
+    from src.Normalization import compileNormalization
+    orcid = compileNormalization(json.dumps(["strip", {"regex": r"(\d{4}-\d{4}-\d{4}-\d{3}[\dXx])"}, "upper"]))
+    assert orcid(" https://orcid.org/0000-0002-1825-009x ") == "0000-0002-1825-009X"
+    assert orcid("0000-0002-1825-0097") == "0000-0002-1825-0097"
+    assert compileNormalization(None)("As Is") == "As Is"
+    with pytest.raises(ValueError):
+        compileNormalization(json.dumps(["unknown"]))
+
+
+@pytest.mark.asyncio
+async def test_normalized_internal_id(monkeypatch):
+    import json
+    from src.Normalization import typeNormalizers, normalizationJobs
+    # no second pass of the background normalization
+    monkeypatch.setattr(typeNormalizers, "ttl", 0)
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    typeRow = get_demodata()['externalidtypes'][0]
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute('''query($id: UUID!) { externalidtypeById(id: $id) { lastchange } }''',
+        context_value=context_value, variable_values={"id": f"{typeRow['id']}"})
+    lastchange = resp.data['externalidtypeById']['lastchange']
+
+    rules = json.dumps(["strip", {"regex": r"orcid\.org/(?P<id>.+)$"}, "upper"])
+    mutation = '''mutation($id: UUID! $lastchange: DateTime! $rules: String!) {
+        externaltypeidUpdate(externaltypeid: {id: $id lastchange: $lastchange normalization: $rules}) { msg }
+    }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(mutation, context_value=context_value,
+        variable_values={"id": f"{typeRow['id']}", "lastchange": lastchange, "rules": rules})
+    assert resp.errors is None
+    assert resp.data['externaltypeidUpdate']['msg'] == "ok"
+    await normalizationJobs.wait()
+
+    inner_id = "cd85ef7c-ad44-11ed-9bd8-0242ac110002"
+    mutation = '''mutation($inner_id: UUID! $type_id: UUID! $outer_id: String!) {
+        externalidInsert(externalid: {innerId: $inner_id typeidId: $type_id outerId: $outer_id}) { msg }
+    }'''
+    variables = {"inner_id": inner_id, "type_id": f"{typeRow['id']}", "outer_id": "https://orcid.org/0000-0002-1825-009x"}
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(mutation, context_value=context_value, variable_values=variables)
+    assert resp.data['externalidInsert']['msg'] == "ok"
+
+    # the same id written differently is a duplicate
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(mutation, context_value=context_value,
+        variable_values={**variables, "outer_id": " 0000-0002-1825-009X"})
+    assert resp.data['externalidInsert']['msg'] == "fail"
+
+    query = '''query($type_id: UUID! $outer_id: String!) { internalId(typeidId: $type_id outerId: $outer_id) }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value,
+        variable_values={"type_id": f"{typeRow['id']}", "outer_id": "http://orcid.org/0000-0002-1825-009X"})
+    assert resp.errors is None
+    assert resp.data['internalId'] == inner_id
+
+
+@pytest.mark.asyncio
+async def test_renormalize_type():
+    import json
+    from sqlalchemy import select
+    from src.DBDefinitions import ExternalIdModel
+    from src.Normalization import normalizationJobs
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    row = get_demodata()['externalids'][0]
+    done = []
+
+    async def onDone(typeid_id):
+        done.append(typeid_id)
+
+    normalizationJobs.start(async_session_maker, row['typeid_id'], json.dumps([{"replace": ["\\d", "x"]}]), onDone=onDone)
+    await normalizationJobs.wait()
+    assert done == [row['typeid_id']]
+
+    statement = select(ExternalIdModel.typeid_id, ExternalIdModel.outer_id, ExternalIdModel.outer_id_normalized)
+    async with async_session_maker() as session:
+        rows = (await session.execute(statement)).all()
+    for typeid_id, outer_id, outer_id_normalized in rows:
+        if typeid_id == row['typeid_id']:
+            assert outer_id_normalized == "".join("x" if char.isdigit() else char for char in outer_id)
+        else:
+            assert outer_id_normalized == outer_id
+
+
+@pytest.mark.asyncio
+async def test_negative_lookup_cache_concurrent_writes(monkeypatch):
+    import uuid
+    import src.Tombstones
+    from sqlalchemy import insert
+    from src.DBDefinitions import ExternalIdModel
+    from src.BloomFilter import negativeLookupCache
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    typeid_id = get_demodata()['externalids'][0]['typeid_id']
+
+    # a key written by this process during the scan is kept after the swap
+    scan = negativeLookupCache._scan
+    async def scanWithWrite(asyncSessionMaker, batchSize):
+        result = await scan(asyncSessionMaker, batchSize)
+        negativeLookupCache.add(typeid_id, "written during build")
+        return result
+    monkeypatch.setattr(negativeLookupCache, "_scan", scanWithWrite)
+    try:
+        await negativeLookupCache.build(async_session_maker)
+        assert not negativeLookupCache.definitelyMissing(typeid_id, "written during build")
+
+        # a key written by another process comes from the change feed
+        async with async_session_maker() as session:
+            async with session.begin():
+                await session.execute(insert(ExternalIdModel).values(
+                    id=uuid.uuid4(), typeid_id=typeid_id, inner_id=uuid.uuid4(),
+                    outer_id="other worker", outer_id_normalized="other worker"))
+        assert negativeLookupCache.definitelyMissing(typeid_id, "other worker")
+        monkeypatch.setattr(src.Tombstones, "SAFETY_SECONDS", -5)
+        assert await negativeLookupCache.pollChanges(async_session_maker) > 0
+        assert not negativeLookupCache.definitelyMissing(typeid_id, "other worker")
+    finally:
+        negativeLookupCache.reset()
+
+
+def test_bloom_filter():
+    from src.BloomFilter import BloomFilter
+    bloomFilter = BloomFilter(1000, fpRate=0.01)
+    keys = [f"{index:010d}" for index in range(1000)]
+    for key in keys:
+        bloomFilter.add(key)
+    assert all(key in bloomFilter for key in keys)
+    falsePositives = sum(1 for index in range(1000, 11000) if f"{index:010d}" in bloomFilter)
+    assert falsePositives < 300
+    assert 0 < bloomFilter.estimatedFalsePositiveRate < 0.02
+
+
+@pytest.mark.asyncio
+async def test_negative_lookup_cache():
+    from src.BloomFilter import negativeLookupCache
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    sessions = []
+    def countingSessionMaker():
+        sessions.append(1)
+        return async_session_maker()
+
+    row = get_demodata()['externalids'][0]
+    query = '''query($type_id: UUID! $outer_id: String!) { internalId(typeidId: $type_id outerId: $outer_id) }'''
+    await negativeLookupCache.build(async_session_maker)
+    try:
+        context_value = await createContext(countingSessionMaker)
+        resp = await schema.execute(query, context_value=context_value,
+            variable_values={"type_id": f"{row['typeid_id']}", "outer_id": "unknown"})
+        assert resp.data['internalId'] is None
+        assert len(sessions) == 0
+
+        context_value = await createContext(countingSessionMaker)
+        resp = await schema.execute(query, context_value=context_value,
+            variable_values={"type_id": f"{row['typeid_id']}", "outer_id": row['outer_id']})
+        assert resp.data['internalId'] == f"{row['inner_id']}"
+
+        # inserted keys are added to the filter
+        mutation = '''mutation($inner_id: UUID! $type_id: UUID! $outer_id: String!) {
+            externalidInsert(externalid: {innerId: $inner_id typeidId: $type_id outerId: $outer_id}) { msg }
+        }'''
+        variables = {"inner_id": f"{row['inner_id']}", "type_id": f"{row['typeid_id']}", "outer_id": "new"}
+        context_value = await createContext(async_session_maker)
+        resp = await schema.execute(mutation, context_value=context_value, variable_values=variables)
+        assert resp.data['externalidInsert']['msg'] == "ok"
+
+        context_value = await createContext(async_session_maker)
+        resp = await schema.execute(query, context_value=context_value,
+            variable_values={"type_id": f"{row['typeid_id']}", "outer_id": "new"})
+        assert resp.data['internalId'] == f"{row['inner_id']}"
+    finally:
+        negativeLookupCache.reset()
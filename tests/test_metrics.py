@@ -0,0 +1,76 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from src.GraphTypeDefinitions import schema
+from src.Metrics import BoundedLabel
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+def sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_operation_and_loader_metrics():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    row = get_demodata()['externalids'][0]
+
+    query = '''query MetricsTest($id: UUID!){
+        a: externalIds(innerId: $id) { id }
+        b: externalIds(innerId: $id) { id }
+    }'''
+    before = sample("gql_ug_graphql_operation_seconds_count", {"operation_name": "MetricsTest", "operation_type": "query"})
+    loadsBefore = sample("gql_ug_dataloader_loads_total", {"loader": "lookup_external_ids"})
+    batchesBefore = sample("gql_ug_dataloader_batch_size_count", {"loader": "lookup_external_ids"})
+
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values={"id": f"{row['inner_id']}"})
+    assert resp.errors is None
+
+    assert sample("gql_ug_graphql_operation_seconds_count", {"operation_name": "MetricsTest", "operation_type": "query"}) == before + 1
+    assert sample("gql_ug_graphql_resolver_seconds_count", {"field": "Query.externalIds"}) >= 2
+    # attribute fields are not timed
+    assert sample("gql_ug_graphql_resolver_seconds_count", {"field": "ExternalIdGQLModel.id"}) == 0
+    assert sample("gql_ug_dataloader_loads_total", {"loader": "lookup_external_ids"}) == loadsBefore + 2
+    assert sample("gql_ug_dataloader_batch_size_count", {"loader": "lookup_external_ids"}) == batchesBefore + 1
+
+
+@pytest.mark.asyncio
+async def test_error_metrics():
+    async_session_maker = await prepare_in_memory_sqllite()
+    before = sample("gql_ug_graphql_errors_total", {"operation_name": "Broken"})
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute("query Broken { notAField }", context_value=context_value)
+    assert resp.errors is not None
+    assert sample("gql_ug_graphql_errors_total", {"operation_name": "Broken"}) == before + 1
+
+
+def test_bounded_label():
+    label = BoundedLabel(2)
+    assert [label("a"), label("b"), label("c"), label("a")] == ["a", "b", "other", "a"]
+
+
+@pytest.mark.asyncio
+async def test_sql_stats_in_extensions():
+    from src.DBDefinitions import startEngine
+    async_session_maker = await startEngine("sqlite+aiosqlite:///:memory:", makeDrop=True, makeUp=True)
+    await prepare_demodata(async_session_maker)
+    row = get_demodata()['externalids'][0]
+
+    query = '''query SqlStatsTest($id: UUID!){ externalIds(innerId: $id) { id type { id } } }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(query, context_value=context_value, variable_values={"id": f"{row['inner_id']}"})
+    assert resp.errors is None
+
+    sql = resp.extensions["sql"]
+    # externalids lookup + type loader
+    assert sql["count"] == 2
+    assert sql["rows"] == 2
+    assert sample("gql_ug_graphql_operation_sql_statements_count", {"operation_name": "SqlStatsTest"}) >= 1
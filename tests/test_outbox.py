@@ -0,0 +1,198 @@
+import asyncio
+import sqlalchemy
+import pytest
+
+from src.GraphTypeDefinitions import schema
+from src.DBDefinitions import OutboxModel
+from src.Outbox import OutboxFeed, sseStream, insertOutbox
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    prepare_postgres,
+    requires_postgres,
+    get_demodata,
+    createContext,
+)
+
+
+async def insertExternalId(async_session_maker, outer_id):
+    row = get_demodata()['externalids'][0]
+    mutation = '''mutation($inner_id: UUID! $type_id: UUID! $outer_id: String!) {
+        externalidInsert(externalid: {innerId: $inner_id typeidId: $type_id outerId: $outer_id}) { id msg }
+    }'''
+    variables = {"inner_id": f"{row['inner_id']}", "type_id": f"{row['typeid_id']}", "outer_id": outer_id}
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(mutation, context_value=context_value, variable_values=variables)
+    assert resp.errors is None
+    return resp.data['externalidInsert']['id']
+
+
+@pytest.mark.asyncio
+async def test_outbox_records_mutations():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+
+    # seeding does not go through encapsulate*, outbox is empty
+    async with async_session_maker() as session:
+        assert (await session.execute(sqlalchemy.select(OutboxModel))).all() == []
+
+    id = await insertExternalId(async_session_maker, "outbox1")
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute('''mutation($id: UUID!) { externalidDelete(id: $id) { msg } }''',
+        context_value=context_value, variable_values={"id": id})
+    assert resp.errors is None
+
+    async with async_session_maker() as session:
+        rows = (await session.execute(sqlalchemy.select(OutboxModel).order_by(OutboxModel.id))).scalars().all()
+    assert [(row.entity, f"{row.entity_id}", row.operation) for row in rows] == [
+        ("externalids", id, "insert"), ("externalids", id, "delete")]
+    assert rows[0].payload["outer_id"] == "outbox1"
+
+
+@pytest.mark.asyncio
+async def test_outbox_feed_replay_and_live():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    await insertExternalId(async_session_maker, "first")
+
+    feed = OutboxFeed(async_session_maker, pollInterval=0.01)
+    try:
+        events = feed.events(offset=0)
+        first = await asyncio.wait_for(events.__anext__(), 1)
+        assert first.payload["outer_id"] == "first"
+
+        pending = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        await insertExternalId(async_session_maker, "second")
+        second = await asyncio.wait_for(pending, 1)
+        assert second.payload["outer_id"] == "second"
+        assert second.id > first.id
+        await events.aclose()
+
+        # resumable stream, event id is the offset
+        stream = sseStream(feed, offset=first.id, heartbeat=1)
+        message = await asyncio.wait_for(stream.__anext__(), 1)
+        assert message.startswith(f"id: {second.id}\nevent: insert\ndata: ")
+        await stream.aclose()
+    finally:
+        feed.stop()
+
+
+@requires_postgres
+@pytest.mark.asyncio
+async def test_outbox_feed_commits_out_of_order():
+    async_session_maker = await prepare_postgres()
+
+    def outboxRows(operation):
+        return lambda session: insertOutbox(session.connection(),
+            [{"entity": "externalids", "entity_id": None, "operation": operation, "payload": {}}])
+
+    feed = OutboxFeed(async_session_maker, pollInterval=0.01)
+    events = feed.events(offset=0)
+    try:
+        async with async_session_maker() as older, async_session_maker() as newer:
+            # the older transaction gets the lower offset but commits as the second one
+            await older.run_sync(outboxRows("older"))
+            await newer.run_sync(outboxRows("newer"))
+            await newer.commit()
+
+            pending = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0.1)
+            assert not pending.done()
+            await older.commit()
+
+        first = await asyncio.wait_for(pending, 1)
+        second = await asyncio.wait_for(events.__anext__(), 1)
+        assert [first.operation, second.operation] == ["older", "newer"]
+        assert first.id < second.id
+    finally:
+        await events.aclose()
+        feed.stop()
+
+
+@pytest.mark.asyncio
+async def test_entity_changes_subscription():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    await insertExternalId(async_session_maker, "subscribed")
+
+    context_value = await createContext(async_session_maker)
+    subscription = await schema.subscribe(
+        '''subscription { entityChanges(offset: 0) { offset entity operation payload } }''',
+        context_value=context_value)
+    try:
+        result = await asyncio.wait_for(subscription.__anext__(), 1)
+        assert result.errors is None
+        assert result.data['entityChanges']['operation'] == "insert"
+        assert result.data['entityChanges']['payload']['outer_id'] == "subscribed"
+    finally:
+        await subscription.aclose()
+        from src.Outbox import getOutboxFeed
+        getOutboxFeed(async_session_maker).stop()
+
+
+@pytest.mark.asyncio
+async def test_external_ids_changed_since(monkeypatch):
+    import src.Tombstones
+    monkeypatch.setattr(src.Tombstones, "SAFETY_SECONDS", -5)
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    first = await insertExternalId(async_session_maker, "changed1")
+    second = await insertExternalId(async_session_maker, "changed2")
+
+    query = '''query($lastchange: DateTime $id: UUID) {
+        externalIdsChangedSince(sinceLastchange: $lastchange sinceId: $id limit: 2) {
+            changes { id deleted outerId }
+            watermarkLastchange watermarkId hasMore
+        }
+    }'''
+
+    async def sync(watermark):
+        result = []
+        while True:
+            context_value = await createContext(async_session_maker)
+            resp = await schema.execute(query, context_value=context_value, variable_values=watermark)
+            assert resp.errors is None
+            page = resp.data['externalIdsChangedSince']
+            result.extend(page['changes'])
+            watermark = {"lastchange": page['watermarkLastchange'], "id": page['watermarkId']}
+            if not page['hasMore']:
+                return result, watermark
+
+    changes, watermark = await sync({})
+    total = len(get_demodata()['externalids']) + 2
+    assert len(changes) == total
+    assert len({change['id'] for change in changes}) == total
+
+    # nothing new after the watermark
+    assert (await sync(watermark))[0] == []
+
+    # deletion is reported by a tombstone, sqlite timestamps have whole seconds
+    await asyncio.sleep(1.1)
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute('''mutation($id: UUID!) { externalidDelete(id: $id) { msg } }''',
+        context_value=context_value, variable_values={"id": first})
+    assert resp.errors is None
+    changes, _ = await sync(watermark)
+    assert changes == [{"id": first, "deleted": True, "outerId": "changed1"}]
+
+
+@pytest.mark.asyncio
+async def test_websocket_context_requires_authentication(monkeypatch):
+    monkeypatch.setenv("DEMO", "False")
+    monkeypatch.setenv("JWTPUBLICKEYURL", "http://localhost:8000/oauth/publickey")
+    monkeypatch.setenv("JWTRESOLVEUSERPATHURL", "http://localhost:8000/oauth/userinfo")
+    import main
+    from fastapi import WebSocketException
+    from starlette.requests import HTTPConnection
+
+    async def sentinel(request, item):
+        return main.JSONResponse({"data": None, "errors": ["Unauthenticated"]}, status_code=401)
+    monkeypatch.setattr(main, "sentinel", sentinel)
+
+    connection = HTTPConnection({"type": "websocket", "path": "/gql", "headers": []})
+    with pytest.raises(WebSocketException) as info:
+        await main.get_context(connection)
+    assert info.value.code == 1008
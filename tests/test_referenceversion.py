@@ -0,0 +1,62 @@
+import uuid
+import pytest
+import sqlalchemy
+
+from src.DBDefinitions import ExternalIdTypeModel
+from src.GraphTypeDefinitions import schema
+from src.ReferenceVersion import isReferenceOnly, referenceVersion, requestETag, etagMatches
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    createContext,
+)
+
+
+def test_is_reference_only():
+    graphqlSchema = schema._schema
+    assert isReferenceOnly(graphqlSchema, "{ externalidtypePage { id name category { id name } changedBy { id } } }")
+    assert isReferenceOnly(graphqlSchema, """
+        query types { ...T }
+        fragment T on Query { externalidcategoryPage { __typename id nameEn } }
+    """, "types")
+    # externalIds of a user read externalids
+    assert not isReferenceOnly(graphqlSchema, "{ externalidtypePage { changedBy { externalIds { id } } } }")
+    assert not isReferenceOnly(graphqlSchema, "{ externalidtypePage { id } externalIdsPage { id } }")
+    assert not isReferenceOnly(graphqlSchema, "mutation { externaltypeidDelete(id: \"d00ec0b6-f27c-497b-8fc8-ddb4e2460717\") { msg } }")
+    assert not isReferenceOnly(graphqlSchema, "query a { externalidtypePage { id } } query b { externalIdsPage { id } }")
+    assert not isReferenceOnly(graphqlSchema, "{ externalidtypePage { id ")
+
+
+def test_etag_matches():
+    etag = requestETag("v1", "{ externalidtypePage { id } }", user={"id": "u"})
+    assert etag.startswith('W/"')
+    assert etagMatches(etag, etag)
+    assert etagMatches(f'"x", {etag.removeprefix("W/")}', etag)
+    assert etagMatches("*", etag)
+    assert not etagMatches(None, etag)
+    assert etag != requestETag("v2", "{ externalidtypePage { id } }", user={"id": "u"})
+    assert etag != requestETag("v1", "{ externalidtypePage { id } }", user={"id": "v"})
+
+
+@pytest.mark.asyncio
+async def test_reference_version_invalidated_by_mutation():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    referenceVersion.invalidate()
+    before = await referenceVersion.get(async_session_maker)
+    assert before == await referenceVersion.get(async_session_maker)
+
+    mutation = '''mutation($name: String!) { externaltypeidInsert(externaltypeid: {name: $name}) { id msg } }'''
+    context_value = await createContext(async_session_maker)
+    resp = await schema.execute(mutation, context_value=context_value, variable_values={"name": "etag type"})
+    assert resp.errors is None
+    assert referenceVersion.value is None
+    after = await referenceVersion.get(async_session_maker)
+    assert after != before
+
+    # delete does not move max(lastchange), the count does
+    async with async_session_maker() as session:
+        await session.execute(sqlalchemy.delete(ExternalIdTypeModel).where(ExternalIdTypeModel.id == uuid.UUID(resp.data['externaltypeidInsert']['id'])))
+        await session.commit()
+    assert await referenceVersion.get(async_session_maker) != after
@@ -0,0 +1,150 @@
+import uuid
+
+import pytest
+import sqlalchemy
+
+import src.ResidentIndex
+import src.Tombstones
+from src.DBDefinitions import ExternalIdModel
+from src.DBFeeder import feedRandomExternalIds
+from src.GraphTypeDefinitions import schema
+from src.ResidentIndex import residentIndex, MappingArrays
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+@pytest.fixture
+def resident():
+    yield residentIndex
+    residentIndex.reset()
+
+
+async def graphqlLookup(async_session_maker, typeid_id, outer_id, inner_id):
+    query = '''query($typeid_id: UUID! $outer_id: String! $inner_id: UUID!) {
+        internalId(typeidId: $typeid_id outerId: $outer_id)
+        externalIds(innerId: $inner_id) { id outerId }
+    }'''
+    variables = {"typeid_id": f"{typeid_id}", "outer_id": outer_id, "inner_id": f"{inner_id}"}
+    resp = await schema.execute(query, context_value=await createContext(async_session_maker), variable_values=variables)
+    assert resp.errors is None
+    return resp.data
+
+
+@pytest.mark.asyncio
+async def test_resident_index_matches_database(resident):
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    await feedRandomExternalIds(async_session_maker, 3000)
+    async with async_session_maker() as session:
+        rows = (await session.execute(sqlalchemy.select(ExternalIdModel.__table__))).all()
+
+    await resident.build(async_session_maker, batchSize=1000)
+    assert isinstance(resident.arrays, MappingArrays)
+    assert len(resident.arrays) == len(rows)
+    for row in rows[:500]:
+        found = resident.internal(row.typeid_id, row.outer_id_normalized)
+        assert (found.typeid_id, found.outer_id_normalized) == (row.typeid_id, row.outer_id_normalized)
+        assert row.id in {item.id for item in resident.external(row.inner_id)}
+    assert resident.internal(rows[0].typeid_id, "missing outer id") is None
+    assert resident.external(uuid.uuid4()) == []
+    assert await resident.verify(async_session_maker, sampleSize=100, recheckDelay=0) == 0
+
+    # lookups are answered from the index
+    row = get_demodata()['externalids'][0]
+    data = await graphqlLookup(async_session_maker, row['typeid_id'], row['outer_id'], row['inner_id'])
+    assert data["internalId"] == f"{row['inner_id']}"
+    assert [item["id"] for item in data["externalIds"]] == [f"{row['id']}"]
+
+
+@pytest.mark.asyncio
+async def test_resident_index_follows_changes(resident, monkeypatch):
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    monkeypatch.setattr(src.ResidentIndex, "residentIndexSessionMaker", async_session_maker)
+    await resident.build(async_session_maker)
+    row = get_demodata()['externalids'][0]
+    typeid_id, inner_id = uuid.UUID(f"{row['typeid_id']}"), uuid.UUID(f"{row['inner_id']}")
+
+    # commits of this process are visible to the next lookup
+    mutation = '''mutation($inner_id: UUID! $type_id: UUID! $outer_id: String!) {
+        externalidInsert(externalid: {innerId: $inner_id typeidId: $type_id outerId: $outer_id}) { id msg }
+    }'''
+    variables = {"inner_id": f"{inner_id}", "type_id": f"{typeid_id}", "outer_id": "resident1"}
+    resp = await schema.execute(mutation, context_value=await createContext(async_session_maker), variable_values=variables)
+    assert resp.errors is None
+    id = resp.data['externalidInsert']['id']
+    data = await graphqlLookup(async_session_maker, typeid_id, "resident1", inner_id)
+    assert data["internalId"] == f"{inner_id}"
+    assert id in {item["id"] for item in data["externalIds"]}
+
+    resp = await schema.execute('''mutation($id: UUID!) { externalidDelete(id: $id) { msg } }''',
+        context_value=await createContext(async_session_maker), variable_values={"id": id})
+    assert resp.errors is None
+    data = await graphqlLookup(async_session_maker, typeid_id, "resident1", inner_id)
+    assert data["internalId"] is None
+    assert id not in {item["id"] for item in data["externalIds"]}
+
+    # writes of other processes come by polling
+    monkeypatch.setattr(src.ResidentIndex, "residentIndexSessionMaker", None)
+    monkeypatch.setattr(src.Tombstones, "SAFETY_SECONDS", -5)
+    variables["outer_id"] = "resident2"
+    resp = await schema.execute(mutation, context_value=await createContext(async_session_maker), variable_values=variables)
+    assert resp.errors is None
+    assert resident.internal(typeid_id, "resident2") is None
+    assert await resident.pollChanges(async_session_maker) > 0
+    assert resident.internal(typeid_id, "resident2").id == uuid.UUID(resp.data['externalidInsert']['id'])
+
+
+@pytest.mark.asyncio
+async def test_resident_index_follows_normalization(resident, monkeypatch):
+    import json
+    from src.Normalization import typeNormalizers, normalizationJobs, renormalizeType
+    from src.ResidentIndex import ResidentIndex
+    # no second pass of the background normalization
+    monkeypatch.setattr(typeNormalizers, "ttl", 0)
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    monkeypatch.setattr(src.ResidentIndex, "residentIndexSessionMaker", async_session_maker)
+    row = get_demodata()['externalids'][0]
+    typeid_id, inner_id = uuid.UUID(f"{row['typeid_id']}"), uuid.UUID(f"{row['inner_id']}")
+
+    mutation = '''mutation($inner_id: UUID! $type_id: UUID! $outer_id: String!) {
+        externalidInsert(externalid: {innerId: $inner_id typeidId: $type_id outerId: $outer_id}) { id msg }
+    }'''
+    variables = {"inner_id": f"{inner_id}", "type_id": f"{typeid_id}", "outer_id": "666"}
+    resp = await schema.execute(mutation, context_value=await createContext(async_session_maker), variable_values=variables)
+    assert resp.errors is None
+    await resident.build(async_session_maker)
+    # index of another process
+    other = ResidentIndex()
+    await other.build(async_session_maker)
+
+    query = '''query($id: UUID!) { externalidtypeById(id: $id) { lastchange } }'''
+    resp = await schema.execute(query, context_value=await createContext(async_session_maker), variable_values={"id": f"{typeid_id}"})
+    lastchange = resp.data['externalidtypeById']['lastchange']
+    mutation = '''mutation($id: UUID! $lastchange: DateTime! $rules: String!) {
+        externaltypeidUpdate(externaltypeid: {id: $id lastchange: $lastchange normalization: $rules}) { msg }
+    }'''
+    rules = json.dumps([{"replace": ["\\d", "x"]}])
+    resp = await schema.execute(mutation, context_value=await createContext(async_session_maker),
+        variable_values={"id": f"{typeid_id}", "lastchange": lastchange, "rules": rules})
+    assert resp.errors is None
+    assert resp.data['externaltypeidUpdate']['msg'] == "ok"
+    await normalizationJobs.wait()
+
+    # "666" is normalized to "xxx" now, the index of this process has been rebuilt
+    assert resident.internal(typeid_id, "xxx").inner_id == inner_id
+    data = await graphqlLookup(async_session_maker, typeid_id, "666", inner_id)
+    assert data["internalId"] == f"{inner_id}"
+
+    # the other process reads the rewritten rows from the change feed
+    assert other.internal(typeid_id, "xxx") is None
+    monkeypatch.setattr(src.Tombstones, "SAFETY_SECONDS", -5)
+    assert await other.pollChanges(async_session_maker) > 0
+    assert other.internal(typeid_id, "xxx").inner_id == inner_id
+    assert other.internal(typeid_id, "666") is None
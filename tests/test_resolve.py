@@ -0,0 +1,67 @@
+import uuid
+
+import msgpack
+import pytest
+
+from src.GraphTypeDefinitions import schema
+from src.Resolve import decodeRequest, parseRequest, resolveIds, encodeResponse, acceptsMsgpack, ResolveRequestError
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+def test_parse_request():
+    typeid_id = uuid.uuid4()
+    payload = msgpack.packb({
+        "internal": [{"typeid_id": typeid_id.bytes, "outer_id": "1"}],
+        "external": [{"inner_id": f"{typeid_id}"}],
+    }, use_bin_type=True)
+    internalKeys, externalKeys = parseRequest(decodeRequest(payload, "application/msgpack"))
+    assert internalKeys == [(typeid_id, "1")]
+    assert externalKeys == [(typeid_id, None)]
+
+    for invalid in [[], {"internal": [{"typeid_id": "x", "outer_id": "1"}]}, {"external": [{"typeid_id": f"{typeid_id}"}]}]:
+        with pytest.raises(ResolveRequestError):
+            parseRequest(invalid)
+    with pytest.raises(ResolveRequestError):
+        decodeRequest(b"{", "application/json")
+    assert acceptsMsgpack("application/json, application/msgpack")
+    assert not acceptsMsgpack("application/json")
+
+
+@pytest.mark.asyncio
+async def test_resolve_ids_matches_graphql():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    row = get_demodata()['externalids'][0]
+    typeid_id, inner_id = uuid.UUID(f"{row['typeid_id']}"), uuid.UUID(f"{row['inner_id']}")
+
+    context_value = await createContext(async_session_maker)
+    result = await resolveIds(
+        context_value["lookups"],
+        [(typeid_id, row['outer_id']), (typeid_id, "missing")],
+        [(inner_id, None), (inner_id, uuid.uuid4()), (uuid.uuid4(), None)],
+    )
+
+    query = '''query($typeid_id: UUID! $outer_id: String! $inner_id: UUID!) {
+        internalId(typeidId: $typeid_id outerId: $outer_id)
+        externalIds(innerId: $inner_id) { id type { id } innerId outerId }
+    }'''
+    variables = {"typeid_id": f"{typeid_id}", "outer_id": row['outer_id'], "inner_id": f"{inner_id}"}
+    resp = await schema.execute(query, context_value=await createContext(async_session_maker), variable_values=variables)
+    assert resp.errors is None
+
+    assert result["internal"] == [resp.data["internalId"], None]
+    assert result["external"][0] == [
+        {"id": item["id"], "typeid_id": item["type"]["id"], "inner_id": item["innerId"], "outer_id": item["outerId"]}
+        for item in resp.data["externalIds"]
+    ]
+    assert result["external"][1:] == [[], []]
+
+    body, mediaType = encodeResponse(result, msgpackRequested=True)
+    assert mediaType == "application/msgpack"
+    assert msgpack.unpackb(body) == result
@@ -0,0 +1,62 @@
+import datetime
+import gzip
+import json
+import uuid
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from src.GraphTypeDefinitions import schema
+from src.Responses import dumps, acceptedEncodings, negotiateEncoding, encodeBody, gqlResponse
+
+
+class FakeRequest:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_dumps_matches_jsonable_encoder():
+    content = {
+        "data": {"rows": [{"id": uuid.uuid4(), "lastchange": datetime.datetime(2024, 1, 2, 3, 4, 5, 6), "name": "žluťoučký"}]},
+    }
+    assert json.loads(dumps(content)) == jsonable_encoder(content)
+
+
+@pytest.mark.asyncio
+async def test_dumps_of_graphql_errors():
+    result = await schema.execute("{ externalIdsPage { id unknownField } }")
+    assert result.errors
+    content = {"errors": [
+        {"msg": error.message, "locations": error.locations, "path": error.path, "nodes": error.nodes, "source": error.source}
+        for error in result.errors
+    ]}
+    assert json.loads(dumps(content)) == jsonable_encoder(content)
+
+
+def test_negotiate_encoding():
+    assert acceptedEncodings("gzip;q=0.5, br, identity;q=0") == ["br", "gzip"]
+    assert negotiateEncoding(None) is None
+    assert negotiateEncoding("identity") is None
+    assert negotiateEncoding("gzip, deflate") == "gzip"
+    assert negotiateEncoding("gzip;q=0") is None
+
+
+def test_encode_body_compresses_large_bodies():
+    content = {"data": [{"id": f"{uuid.UUID(int=index)}"} for index in range(200)]}
+    body, encoding = encodeBody(content, "gzip", minSize=1024)
+    assert encoding == "gzip"
+    assert json.loads(gzip.decompress(body)) == content
+
+    body, encoding = encodeBody({"data": None}, "gzip", minSize=1024)
+    assert encoding is None
+    assert body == b'{"data":null}'
+
+
+@pytest.mark.asyncio
+async def test_gql_response_offloaded():
+    content = {"data": [{"id": uuid.UUID(int=index)} for index in range(1000)]}
+    response = await gqlResponse(FakeRequest({"accept-encoding": "gzip"}), content, headers={"ETag": 'W/"x"'}, cost=10 ** 6)
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == 'W/"x"'
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(response.body)) == jsonable_encoder(content)
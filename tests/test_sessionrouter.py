@@ -0,0 +1,58 @@
+import pytest
+
+from src.GraphTypeDefinitions import schema
+from src.SessionRouter import SessionRouter, ReplicaSet
+
+from .shared import (
+    prepare_demodata,
+    prepare_in_memory_sqllite,
+    get_demodata,
+    createContext,
+)
+
+
+def test_router_prefers_replica_until_written():
+    primary = lambda: "primary"
+    replica = lambda: "replica"
+
+    router = SessionRouter(primary, ReplicaSet([replica]))
+    assert router() == "replica"
+    router.markWritten()
+    assert router() == "primary"
+
+    assert SessionRouter(primary, ReplicaSet([])).__call__() == "primary"
+    assert SessionRouter(primary, None).__call__() == "primary"
+
+
+@pytest.mark.asyncio
+async def test_lagging_replica_is_skipped():
+    replicaSessionMaker = await prepare_in_memory_sqllite()
+    replicaSet = ReplicaSet([replicaSessionMaker], maxLag=1.0)
+    # sqlite cannot report lag, replica is considered unhealthy
+    await replicaSet.refresh()
+    assert replicaSet.pick() is None
+
+    router = SessionRouter(lambda: "primary", replicaSet)
+    assert router() == "primary"
+
+
+@pytest.mark.asyncio
+async def test_mutation_is_routed_to_primary():
+    async_session_maker = await prepare_in_memory_sqllite()
+    await prepare_demodata(async_session_maker)
+    data = get_demodata()
+
+    context_value = await createContext(async_session_maker)
+    sessionRouter = context_value["sessionRouter"]
+
+    query = '''query($id: UUID!){ externalIds(innerId: $id) { id } }'''
+    variable_values = {"id": f"{data['externalids'][0]['inner_id']}"}
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+    assert resp.errors is None
+    assert sessionRouter.written is False
+
+    query = '''mutation($id: UUID!){ externalidDelete(id: $id) { msg } }'''
+    variable_values = {"id": f"{data['externalids'][0]['id']}"}
+    resp = await schema.execute(query, context_value=context_value, variable_values=variable_values)
+    assert resp.errors is None
+    assert sessionRouter.written is True